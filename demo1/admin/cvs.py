@@ -13,7 +13,7 @@ from schema.cvinfo_schema import CVOriginSchema
 from schema.page_schema import PageInfo
 from services.service_cvinfo import CvInfoService
 from tools.rest_result import restResult
-from backgroup_task.main import cv_pdf_split_and_embedding, abstract_cv
+from backgroup_task.main import cv_pdf_split_and_embedding, abstract_cv, fair_scheduler
 
 
 admin_cvs_router = APIRouter(prefix="/adm/cv", tags=["admin"], dependencies=[Depends(depend.admin_user)])
@@ -169,7 +169,7 @@ async def origins_cvs_embedding_start(
         return restResult.not_found("请求资源不存在")
     cv_pdf_split_and_embedding.apply_async(kwargs={"cv_id": origin_cv_id, "cv_gs_path": origin.save_path})
     cvs = [{"cv_id": origin_cv_id, "gcs_path": origin.save_path}]
-    abstract_cv.apply_async(kwargs={"cvs": cvs})
+    await fair_scheduler.submit_async(None, abstract_cv, {"cvs": cvs})
     return restResult.success()
 
 
@@ -12,7 +12,8 @@ from model import JobDataModel, JobDataCVSearchTaskModel, CVInfoModel, CVInfoAna
 from schema.page_schema import PageInfo
 from schema.user_schemas import AdminUser
 from tools.rest_result import restResult
-from backgroup_task.main import analytic_cv, analytic_jd
+from backgroup_task.context_cache import context_cache
+from backgroup_task.main import analytic_cv, analytic_jd, drop_jd_context_cache, fair_scheduler
 
 admin_jd_router = APIRouter(prefix="/adm/jd", tags=["admin"], dependencies=[Depends(depend.admin_user)])
 
@@ -47,6 +48,8 @@ async def user_disable(
     session.delete(jd)
     jd_info = f"{jd}"
     session.commit()
+    if context_cache.enable:
+        drop_jd_context_cache.apply_async(kwargs={"jd_id": jd_id})
     logger.info(f"{admin_user}删除岗位{jd_info}成功.")
     return restResult.success()
 
@@ -125,7 +128,8 @@ async def analytic_job_cvs(
         CVInfoModel.search_task_id == st_id, CVInfoModel.analyze_status == -1).all()
     if not non_analyzed_cvs:
         return restResult.fail("该任务下没有未分析的简历")
-    analytic_cv.apply_async(kwargs={"task_id": st_id, "jd_id": task.jd_id, "quota": quota})
+    await fair_scheduler.submit_async(
+        await fair_scheduler.jd_tenant_async(task.jd_id, session), analytic_cv, {"task_id": st_id, "jd_id": task.jd_id, "quota": quota})
     return restResult.success()
 
 
@@ -145,7 +149,8 @@ async def analytic_job_cvs(
         return restResult.fail("该JD下没有未分析的简历")
     for st_id, non_analyzed_cvs_count in grouped_data:
         if non_analyzed_cvs_count > 0:
-            analytic_cv.apply_async(kwargs={"task_id": st_id, "jd_id": jd_id, "quota": non_analyzed_cvs_count})
+            await fair_scheduler.submit_async(
+                jd.company_id, analytic_cv, {"task_id": st_id, "jd_id": jd_id, "quota": non_analyzed_cvs_count})
     return restResult.success()
 
 
@@ -157,7 +162,7 @@ async def analytic_job_cvs(
     jd = session.query(JobDataModel).filter(JobDataModel.id == jd_id).first()
     if not jd:
         return restResult.not_found(msg="请求资源错误")
-    analytic_jd.apply_async(kwargs={"jd_id": jd_id})
+    await fair_scheduler.submit_async(jd.company_id, analytic_jd, {"jd_id": jd_id})
     return restResult.success()
 
 
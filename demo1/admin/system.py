@@ -0,0 +1,85 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.orm import Session
+
+import depend
+from backgroup_task.call_policy import call_policies_stats
+from backgroup_task.context_cache import context_cache
+from backgroup_task.embedding_batcher import embedding_batchers_stats
+from backgroup_task.embedding_cache import embedding_cache
+from backgroup_task.main import abstract_cv_batcher, ai_analytic_chat_manager, fair_scheduler
+from backgroup_task.model_registry import model_registry
+from backgroup_task.rate_limiter import vertex_rate_limiter
+from backgroup_task.result_cache import result_cache
+from model.vector_compact import compact_vector_stats
+from model.vector_index import vector_index_stats
+from tools.jd_vector_cache import jd_vector_cache
+from tools.rest_result import restResult
+
+admin_system_router = APIRouter(prefix="/adm/sys", tags=["admin"], dependencies=[Depends(depend.admin_user)])
+
+
+@admin_system_router.get("/model-registry", description="获取当前进程Vertex模型句柄缓存的命中情况")
+async def model_registry_stats():
+    return restResult.success(data=model_registry.stats())
+
+
+@admin_system_router.get("/embedding-cache", description="获取当前进程Embedding缓存的命中情况")
+async def embedding_cache_stats():
+    return restResult.success(data={**embedding_cache.stats(), "micro_batchers": embedding_batchers_stats()})
+
+
+@admin_system_router.get("/result-cache", description="获取当前进程大模型分析结果缓存的命中情况")
+async def result_cache_stats():
+    return restResult.success(data=result_cache.stats())
+
+
+@admin_system_router.post("/result-cache/invalidate/{prompt_name}", description="修改prompt后使对应的分析结果缓存失效")
+async def result_cache_invalidate(prompt_name: str):
+    if prompt_name not in ("jd_model", "cv_model", "cv_abstract_model"):
+        return restResult.fail("prompt_name仅支持jd_model、cv_model、cv_abstract_model")
+    return restResult.success(data={"prompt_name": prompt_name, "generation": result_cache.invalidate(prompt_name)})
+
+
+@admin_system_router.get("/context-cache", description="获取当前进程Vertex上下文缓存的使用情况")
+async def context_cache_stats():
+    return restResult.success(data=context_cache.stats())
+
+
+@admin_system_router.get("/rate-limiter", description="获取当前进程Vertex调用的自适应并发及限流情况")
+async def rate_limiter_stats():
+    return restResult.success(data=vertex_rate_limiter.stats())
+
+
+@admin_system_router.get("/fair-scheduler", description="获取大模型任务公平调度的各租户队列深度及运行数量")
+async def fair_scheduler_stats():
+    return restResult.success(data=fair_scheduler.stats())
+
+
+@admin_system_router.get("/call-policy", description="获取当前进程各模型调用策略的重试、对冲及耗时情况")
+async def call_policy_stats():
+    return restResult.success(data=call_policies_stats())
+
+
+@admin_system_router.get("/abstract-cv-batcher", description="获取简历信息提取请求聚合缓冲区中各租户的简历数量")
+async def abstract_cv_batcher_stats():
+    return restResult.success(data=abstract_cv_batcher.stats())
+
+
+@admin_system_router.get("/chat-session", description="获取会话筛选在Redis中保存的会话数量")
+async def chat_session_stats():
+    return restResult.success(data=ai_analytic_chat_manager.stats())
+
+
+@admin_system_router.get("/vector-index", description="获取向量表ANN索引的大小、状态及创建进度")
+async def vector_index_state(session: Session = Depends(depend.get_db)):
+    return restResult.success(data=vector_index_stats(session))
+
+
+@admin_system_router.get("/jd-vector-cache", description="获取当前进程的岗位向量缓存统计")
+async def jd_vector_cache_state():
+    return restResult.success(data=jd_vector_cache.stats())
+
+
+@admin_system_router.get("/vector-compact", description="获取向量表紧凑存储列的回填进度及平均占用字节数")
+async def vector_compact_state(session: Session = Depends(depend.get_db)):
+    return restResult.success(data=compact_vector_stats(session))
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import typing
+
+import redis
+
+from backgroup_task.fair_scheduler import FairScheduler
+
+
+class AbstractCvBatcher:
+    """
+    简历信息提取(abstract_cv)请求聚合
+    1、上传接口只把简历写入Redis缓冲区(按公司区分)，攒够max_size份或等待max_wait秒后合并为一个abstract_cv任务，
+       一次模型请求处理整批简历，结果按简历ID拆分保存
+    2、缓冲区第一份简历写入时投递一个延迟max_wait秒的flush任务，到期时不足max_size份也会发出
+    3、聚合关闭或Redis异常时直接投递单份简历的任务
+    4、任务中未返回提取结果的简历通过resubmit重新投递，最多重试max_retries次
+    """
+    PREFIX = "AbstractCvBatcher:"
+    BUFFER_PREFIX = PREFIX + "Buffer:"
+    TIMER_PREFIX = PREFIX + "Timer:"
+
+    def __init__(
+        self,
+        scheduler: FairScheduler,
+        redis_url: str,
+        task_name: str,
+        flush_task_name: str,
+        max_size: int = 20,
+        max_wait: float = 30,
+        max_retries: int = 1,
+        enable: bool = True,
+    ):
+        self.scheduler = scheduler
+        self.app = scheduler.app
+        self.task_name = task_name
+        self.flush_task_name = flush_task_name
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.enable = enable
+        self.redis_client = redis.from_url(redis_url, decode_responses=True)
+
+    @property
+    def task(self):
+        return self.app.tasks[self.task_name]
+
+    def _tenant(self, tenant) -> str:
+        return str(tenant or self.scheduler.DEFAULT_TENANT)
+
+    def add(self, tenant: typing.Optional[str], cvs: typing.List[dict]):
+        if not self.enable:
+            return self.scheduler.submit(tenant, self.task, {"cvs": cvs, "tenant": tenant})
+        tenant = self._tenant(tenant)
+        try:
+            size = self.redis_client.rpush(
+                self.BUFFER_PREFIX + tenant, *[json.dumps(item, default=str) for item in cvs])
+            if size >= self.max_size:
+                self.flush(tenant, full_only=True)
+            else:
+                self._schedule_flush(tenant)
+        except redis.RedisError as e:
+            print(f"【AbstractCvBatcher】简历写入缓冲区异常，直接投递，{e}")
+            self.scheduler.submit(tenant, self.task, {"cvs": cvs, "tenant": tenant})
+
+    async def add_async(self, tenant: typing.Optional[str], cvs: typing.List[dict]):
+        return await asyncio.to_thread(self.add, tenant, cvs)
+
+    def resubmit(self, tenant: typing.Optional[str], cvs: typing.List[dict], retry: int) -> bool:
+        """重新投递未返回提取结果的简历，retry为已重试次数，超过max_retries时放弃"""
+        if not cvs or retry >= self.max_retries:
+            return False
+        self.scheduler.submit(tenant, self.task, {"cvs": cvs, "tenant": tenant, "retry": retry + 1})
+        return True
+
+    def _pop(self, tenant: str) -> typing.List[dict]:
+        key = self.BUFFER_PREFIX + tenant
+        pipe = self.redis_client.pipeline()
+        pipe.lrange(key, 0, self.max_size - 1)
+        pipe.ltrim(key, self.max_size, -1)
+        values, _ = pipe.execute()
+        cvs = {}
+        for value in values:
+            item = json.loads(value)
+            # 同一份简历在窗口内重复提交时只保留最后一次
+            cvs[str(item["cv_id"])] = item
+        return list(cvs.values())
+
+    def _schedule_flush(self, tenant: str):
+        if self.redis_client.set(self.TIMER_PREFIX + tenant, 1, nx=True, ex=int(self.max_wait * 2) + 60):
+            self.app.send_task(self.flush_task_name, kwargs={"tenant": tenant}, countdown=self.max_wait)
+
+    def flush(self, tenant: str, full_only: bool = False) -> int:
+        """
+        把缓冲区中的简历按max_size分批投递，返回投递的任务数
+        :param full_only: 只投递满max_size份的批次，剩余简历等待计时器到期
+        """
+        tenant = self._tenant(tenant)
+        key = self.BUFFER_PREFIX + tenant
+        count = 0
+        try:
+            while not full_only or self.redis_client.llen(key) >= self.max_size:
+                cvs = self._pop(tenant)
+                if not cvs:
+                    break
+                print(f"【AbstractCvBatcher】投递简历信息提取任务，公司：{tenant}，简历数量：{len(cvs)}")
+                self.scheduler.submit(tenant, self.task, {"cvs": cvs, "tenant": tenant})
+                count += 1
+            if not full_only:
+                self.redis_client.delete(self.TIMER_PREFIX + tenant)
+            # 删除计时器前又有简历写入时，补投一个flush任务
+            if self.redis_client.llen(key):
+                self._schedule_flush(tenant)
+        except redis.RedisError as e:
+            print(f"【AbstractCvBatcher】投递缓冲区简历异常，{e}")
+        return count
+
+    def stats(self):
+        tenants = {}
+        for key in self.redis_client.scan_iter(self.BUFFER_PREFIX + "*"):
+            tenants[key[len(self.BUFFER_PREFIX):]] = self.redis_client.llen(key)
+        return {"enable": self.enable, "max_size": self.max_size, "max_wait": self.max_wait, "buffered": tenants}
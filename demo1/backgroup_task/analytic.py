@@ -1,16 +1,47 @@
 import mimetypes
 import re
 import traceback
-from json import JSONDecodeError
-from vertexai.generative_models import GenerativeModel, Part
+import typing
+from vertexai.generative_models import Part
 import json
 
-from vertexai.language_models import TextEmbeddingModel, TextEmbeddingInput
-
 from backgroup_task.analytic_base import AnalyticBase
+from backgroup_task.batch_executor import BatchExecutor
+from backgroup_task.call_policy import get_call_policy
+from backgroup_task.context_cache import context_cache
+from backgroup_task.model_registry import model_registry
+from backgroup_task.rate_limiter import vertex_rate_limiter
+from backgroup_task.result_cache import result_cache, text_hash
+from backgroup_task.stream_parser import JsonRecordStreamParser
+from backgroup_task.token_planner import TokenBudgetPlanner
+from settings import setting
+
+cv_token_planner = TokenBudgetPlanner(
+    max_input_tokens=getattr(setting, "ANALYTIC_CV_MAX_INPUT_TOKENS", 200000),
+    output_tokens_per_cv=getattr(setting, "ANALYTIC_CV_OUTPUT_TOKENS_PER_CV", 600),
+    pdf_input_tokens=getattr(setting, "ANALYTIC_CV_PDF_INPUT_TOKENS", 3000),
+)
+# 简历信息提取一次请求输出全部简历的JSON数组，按输出token预算切分，避免截断后整批解析失败
+cv_abstract_token_planner = TokenBudgetPlanner(
+    max_input_tokens=getattr(setting, "ANALYTIC_CV_MAX_INPUT_TOKENS", 200000),
+    output_tokens_per_cv=getattr(setting, "ABSTRACT_CV_OUTPUT_TOKENS_PER_CV", 800),
+    pdf_input_tokens=getattr(setting, "ANALYTIC_CV_PDF_INPUT_TOKENS", 3000),
+)
+cv_analytic_executor = BatchExecutor(
+    max_workers=getattr(setting, "ANALYTIC_CV_CONCURRENCY", 4),
+    max_retries=1,
+)
+# 简历信息提取的模型请求已由cv_abstract调用策略重试，子批次不再整体重试
+cv_abstract_executor = BatchExecutor(
+    max_workers=getattr(setting, "ANALYTIC_CV_CONCURRENCY", 4),
+    max_retries=0,
+)
 
 
 class Analytic(AnalyticBase):
+    # 子批次输出被截断后对半拆分重新分析的最大次数
+    TRUNCATED_RETRY_DEPTH = 3
+
     jd_model_prompt = """
     #角色：您是专门负责招聘的专员，公司会提供岗位名称、岗位要求、岗位工作内容、岗位职责给您，您需要将为岗位做对应的总结信息并且对岗位信息总结成一句话，以便于进行embedding分析, 下方会有一则招聘内容，请帮忙进行总结招聘信息、一句话总结（体现出岗位的技能要求、职责要求等关键字）
     #前提：
@@ -155,43 +186,37 @@ class Analytic(AnalyticBase):
     你是一名专业的面试官，我将给你一个面试评价模板，你的任务是根据面试者的面试内容和简历面试模板，生成一份面试评价报告，并以markdown格式输出
     """
 
-    def __init__(self):
-        super().__init__()
-        self.jd_model = GenerativeModel(
-            self.model_name,
-            system_instruction=[self.jd_model_prompt]
-        )
-        self.cv_model = GenerativeModel(
-            self.model_name,
-            system_instruction=[self.cv_model_prompt]
-        )
-        self.jd_resolve_model1 = GenerativeModel(
-            self.model_name,
-            system_instruction=[self.jd_resolve_prompt_1]
-        )
-        self.jd_resolve_model2 = GenerativeModel(
-            self.model_name,
-            system_instruction=[self.jd_resolve_prompt_2]
-        )
-        self.cv_abstract_model = GenerativeModel(
-            self.model_name,
-            system_instruction=[self.cv_abstract_prompt]
-        )
+    @property
+    def jd_model(self):
+        return model_registry.generative_model(self.model_name, [self.jd_model_prompt])
 
-        self.sentence_summary_abstract_model = GenerativeModel(
-            self.model_name,
-            system_instruction=[self.sentence_abstract_prompt]
-        )
+    @property
+    def cv_model(self):
+        return model_registry.generative_model(self.model_name, [self.cv_model_prompt])
 
-        self.split_pdf_model = GenerativeModel(
-            self.model_name,
-            system_instruction=[self.split_pdf_prompt]
-        )
+    @property
+    def jd_resolve_model1(self):
+        return model_registry.generative_model(self.model_name, [self.jd_resolve_prompt_1])
 
-        self.interview_eva_model = GenerativeModel(
-            self.model_name,
-            system_instruction=[self.interview_eva_prompt]
-        )
+    @property
+    def jd_resolve_model2(self):
+        return model_registry.generative_model(self.model_name, [self.jd_resolve_prompt_2])
+
+    @property
+    def cv_abstract_model(self):
+        return model_registry.generative_model(self.model_name, [self.cv_abstract_prompt])
+
+    @property
+    def sentence_summary_abstract_model(self):
+        return model_registry.generative_model(self.model_name, [self.sentence_abstract_prompt])
+
+    @property
+    def split_pdf_model(self):
+        return model_registry.generative_model(self.model_name, [self.split_pdf_prompt])
+
+    @property
+    def interview_eva_model(self):
+        return model_registry.generative_model(self.model_name, [self.interview_eva_prompt])
 
     @staticmethod
     def get_mime_type(file_name):
@@ -199,82 +224,174 @@ class Analytic(AnalyticBase):
         mime_type, _ = mimetypes.guess_type(file_name)
         return mime_type or 'application/octet-stream'  # 默认返回 binary 数据类型
 
+    def result_cache_version(self, prompt_name: str, prompt: str):
+        return result_cache.prompt_version(prompt_name, prompt, self.generation_config)
+
+    def cv_result_cache_keys(self, prompt_name: str, prompt: str, cvs, *parts):
+        if not result_cache.enable:
+            return [None] * len(cvs)
+        version = self.result_cache_version(prompt_name, prompt)
+        return [
+            result_cache.make_key(version, self.model_name, *parts, content_hash) if content_hash else None
+            for content_hash in result_cache.cv_content_hashes(cvs)
+        ]
+
     def analytic_jd(self, jd_info):
         print("start")
-        loop = 3
-        for retry in range(loop):
-            try:
-                responses = self.jd_model.generate_content(
-                    [jd_info],
-                    generation_config=self.generation_config,
-                    safety_settings=self.safety_settings,
-                    stream=False,
-                )
-                result = responses.candidates[0].content.parts[0].text
-                print(result)
-                t = result.split("---split---")
-                job_summary = t[0]
-                keyword_summary = t[1].split("```json")[1].split("```")[0]
-                keyword_summary = json.loads(keyword_summary)["keyword_summary"]
-                return {
-                    "keyword_summary": keyword_summary,
-                    "job_summary": job_summary,
-                }
-            except Exception as e:
-                print(f"分析JD异常，即将重试，{e}")
-
-    def analytic_cv(self, job_info, cvs):
-        content = ["岗位信息\n{}".format(job_info)]
-        for item in cvs:
-            origin = item["origin"]
-            if origin == "boss":
-                content.append("\nID: {}, 简历:".format(item["cv_id"]))
-                content.append(Part.from_text(item["meta_json"]))
+        cache_key = None
+        if result_cache.enable:
+            version = self.result_cache_version("jd_model", self.jd_model_prompt)
+            cache_key = result_cache.make_key(version, self.model_name, text_hash(jd_info))
+            cached = result_cache.get(cache_key)
+            if cached:
+                print("岗位信息未变化，命中JD分析结果缓存")
+                return cached
+        try:
+            # 输出格式不符合预期时同样按退避策略重试
+            result = get_call_policy("analytic_jd", retryable=(ValueError, IndexError, KeyError)).call(
+                self._analytic_jd_once, jd_info)
+        except Exception as e:
+            print(f"分析JD异常，{e}")
+            return None
+        result_cache.set(cache_key, result)
+        return dict(result)
+
+    def _analytic_jd_once(self, jd_info, timeout: float = None):
+        responses = self.generate_content(
+            self.jd_model,
+            [jd_info],
+            generation_config=self.generation_config,
+            safety_settings=self.safety_settings,
+            stream=False,
+            timeout=timeout,
+        )
+        result = responses.candidates[0].content.parts[0].text
+        print(result)
+        t = result.split("---split---")
+        job_summary = t[0]
+        keyword_summary = t[1].split("```json")[1].split("```")[0]
+        keyword_summary = json.loads(keyword_summary)["keyword_summary"]
+        return {
+            "keyword_summary": keyword_summary,
+            "job_summary": job_summary,
+        }
+
+    def build_cv_contents(self, item):
+        return ["\nID: {}, 简历:".format(item["cv_id"]), self.build_cv_part(item)]
+
+    def count_cv_tokens(self, item):
+        with vertex_rate_limiter.limit(f"{self.model_name}:count_tokens"):
+            return self.cv_model.count_tokens(self.build_cv_contents(item)).total_tokens
+
+    def analytic_cv(self, job_info, cvs, on_result: typing.Callable[[list], None] = None, scope: str = None):
+        """
+        按token预算把简历切分为若干子批次，保证每个子批次的评估结果不会超出max_output_tokens，子批次并发分析后合并结果
+        :param on_result: 每个子批次分析完成后的回调，可用于逐批保存结果
+        :param scope: 岗位ID，用于岗位更新或删除时清理上下文缓存
+        """
+        self.attach_cv_texts(cvs)
+        # 先查询结果缓存，同一岗位信息下已评估过的相同简历不再请求模型
+        keys = self.cv_result_cache_keys("cv_model", self.cv_model_prompt, cvs, text_hash(job_info))
+        key_map = {str(item["cv_id"]): key for item, key in zip(cvs, keys)}
+        cached_result, pending = [], []
+        for item, value in zip(cvs, result_cache.get_many(keys)):
+            if isinstance(value, dict):
+                value["cv_id"] = str(item["cv_id"])
+                cached_result.append(value)
             else:
-                content.append("\nID: {}, 简历:".format(item["cv_id"]))
-                content.append(Part.from_uri(
-                    mime_type="application/pdf",
-                    uri=item["gcs_path"]))
+                pending.append(item)
+        if cached_result:
+            print(f"命中简历分析结果缓存，数量：{len(cached_result)}/{len(cvs)}")
+            if on_result:
+                on_result(cached_result)
+        if not pending:
+            return cached_result
+
+        batches = cv_token_planner.plan(
+            pending,
+            prefix_tokens=cv_token_planner.estimate_text_tokens(job_info),
+            count_tokens=self.count_cv_tokens if getattr(setting, "ANALYTIC_CV_COUNT_TOKENS", False) else None,
+        )
+        print(f"获取到cvs数量：{len(cvs)}，按token预算切分为{len(batches)}个子批次：{[len(i) for i in batches]}")
+
+        def run(batch, depth=0):
+            batch_result, truncated = self.analytic_cv_batch(job_info, batch, scope=scope)
+            if batch_result is None:
+                return None
+            if batch_result:
+                result_cache.set_many({
+                    key_map.get(i["cv_id"]): {k: v for k, v in i.items() if k != "cv_id"} for i in batch_result
+                })
+                if on_result:
+                    on_result(batch_result)
+            returned = {i["cv_id"] for i in batch_result}
+            missing = [i for i in batch if str(i["cv_id"]) not in returned]
+            if truncated and missing and depth < self.TRUNCATED_RETRY_DEPTH:
+                # 输出被截断时，未返回结果的简历对半拆分后在当前线程中重新分析
+                half = (len(missing) + 1) // 2
+                print(f"子批次输出被截断，重新分析未返回结果的简历：{[i['cv_id'] for i in missing]}")
+                for sub_batch in (missing[:half], missing[half:]):
+                    if sub_batch:
+                        batch_result.extend(run(sub_batch, depth + 1) or [])
+            return batch_result
+
+        results = cv_analytic_executor.map(run, batches)
+        result = cached_result
+        for idx, batch_result in enumerate(results):
+            if batch_result is None:
+                print(f"子批次{idx}分析失败，简历：{[i['cv_id'] for i in batches[idx]]}")
+                continue
+            result.extend(batch_result)
+        print(f"Get analyze result count: {len(result)}")
+        return result
+
+    def analytic_cv_batch(self, job_info, cvs, on_record: typing.Callable[[dict], None] = None, scope: str = None):
+        """
+        :return: (评估结果, 输出是否被截断)，请求或解析异常时评估结果为None
+        """
+        job_content = "岗位信息\n{}".format(job_info)
+        # 岗位信息足够长时使用上下文缓存，每个子批次不再重复发送岗位信息
+        model = context_cache.get_model(self.model_name, [self.cv_model_prompt], [job_content], scope=scope)
+        content = [] if model else [job_content]
+        model = model or self.cv_model
+        for item in cvs:
+            content.extend(self.build_cv_contents(item))
 
         content.append("""\n请输出评估结果""")
-        print(f"获取到cvs数量：{len(cvs)}")
+        print(f"子批次cvs数量：{len(cvs)}")
 
         try:
-            responses = self.cv_model.generate_content(
+            responses = self.generate_content(
+                model,
                 content,
                 generation_config=self.generation_config,
                 safety_settings=self.safety_settings,
-                stream=False,
+                stream=True,
             )
-            # print(responses)
-            data = responses.candidates[0].content.parts[0].text
-            try:
-                analytic_result = json.loads(data.replace("```json", "").replace("```", "").strip())
-            # 有可能超出max_token，导致responses.candidates[0].content.parts[0].text不是一个完整的json字符串，此时使用正则来获取有效的结果
-            except JSONDecodeError:
-                analytic_result = []
-                for i in re.findall(r"\{\s+\"key\".*?\"result\":\s+\{.*?}\s+}", data, re.DOTALL):
-                    analytic_result.append(json.loads(i))
-            # print(analytic_result)
-            print(f"解析分析结果成功，数量：{len(analytic_result)}")
-            if len(analytic_result) == 0:
-                print(f"解析分析结果成功，数量：0, ResultText: {data}")
+            # 逐条解析评估结果，输出被max_token截断时仍能保留已完整输出的记录
+            parser = JsonRecordStreamParser(record_key="key")
             result = []
-            for item in analytic_result:
-                t_ = item["result"]
-                cv_id = item["key"]
+            for item in parser.parse(response.text for response in responses):
+                t_ = item.get("result")
+                cv_id = str(item["key"])
+                if not isinstance(t_, dict):
+                    continue
                 t_["cv_id"] = cv_id
                 if re.match(r"^\w+-\w+-\w+-\w+-\w+$", cv_id) or re.match(r"^\w{32}$", cv_id):
                     result.append(t_)
-            # print("=========================================")
+                    if on_record:
+                        on_record(t_)
+            print(f"解析分析结果成功，数量：{parser.records}，输出是否被截断：{parser.truncated}")
+            if parser.records == 0:
+                print(f"解析分析结果成功，数量：0, ResultText: {parser.text}")
             print(f"Get analyze result count: {len(result)}")
-            return result
+            return result, parser.truncated
         except Exception as e:
             print(traceback.format_exc())
             print(f"分析简历发生异常：{e}")
-            return []
+            return None, False
 
-    def resolve_jd(self, jd_info: str = None, jd_file_stream: bytes = None, index=1):
+    def build_resolve_jd_request(self, jd_info: str = None, jd_file_stream: bytes = None, index=1):
         content = ["请分析一下岗位信息:\n"]
         if jd_info:
             content.append(jd_info)
@@ -284,60 +401,92 @@ class Analytic(AnalyticBase):
             model = self.jd_resolve_model1
         else:
             model = self.jd_resolve_model2
-        response = model.generate_content(
+        return model, content
+
+    @staticmethod
+    def parse_resolve_jd_response(response):
+        result = response.candidates[0].content.parts[0].text
+        result = json.loads(result.replace("```json", "").replace("```", "").strip())
+        return result
+
+    def resolve_jd(self, jd_info: str = None, jd_file_stream: bytes = None, index=1):
+        model, content = self.build_resolve_jd_request(jd_info, jd_file_stream, index)
+        response = self.generate_content(
+            model,
             content,
             generation_config=self.generation_config,
             safety_settings=self.safety_settings,
             stream=False,
+            policy="resolve_jd",
         )
-        result = response.candidates[0].content.parts[0].text
-        result = json.loads(result.replace("```json", "").replace("```", "").strip())
-        return result
-
-    def embedding_texts(self, texts):
-        try:
-            model = TextEmbeddingModel.from_pretrained(self.embedding_model_id)
-            inputs = [TextEmbeddingInput(text, "RETRIEVAL_QUERY") for text in texts]
-            embeddings = model.get_embeddings(texts=inputs, output_dimensionality=768)
-            return [embedding.values for embedding in embeddings]
-        except Exception as e:
-            print(traceback.format_exc())
-            print(e)
-            return []
+        return self.parse_resolve_jd_response(response)
 
-    def embedding_text(self, msg):
-        try:
-            model = TextEmbeddingModel.from_pretrained(self.embedding_model_id)
-            inputs = [TextEmbeddingInput(msg, "RETRIEVAL_QUERY")]
-            embeddings = model.get_embeddings(texts=inputs, output_dimensionality=768)
-            return embeddings[0].values
-        except Exception as e:
-            print(traceback.format_exc())
-            print(e)
-            return None
+    async def resolve_jd_async(self, jd_info: str = None, jd_file_stream: bytes = None, index=1, timeout: float = None):
+        """
+        resolve_jd的异步版本，供FastAPI路由使用，等待模型响应期间不阻塞事件循环
+        :param timeout: 超时时间(秒)，超时抛出asyncio.TimeoutError
+        """
+        model, content = self.build_resolve_jd_request(jd_info, jd_file_stream, index)
+        response = await self.generate_content_async(model, content, timeout=timeout, policy="resolve_jd")
+        return self.parse_resolve_jd_response(response)
 
     def cv_abstract(self, cvs):
+        """
+        按输出token预算把简历切分为若干子批次并发提取，合并各子批次的结果
+        :return: 提取结果列表，全部失败时为None
+        """
+        self.attach_cv_texts(cvs)
+        keys = self.cv_result_cache_keys("cv_abstract_model", self.cv_abstract_prompt, cvs)
+        key_map = {str(item["cv_id"]): key for item, key in zip(cvs, keys)}
+        cached_result, pending = [], []
+        for item, value in zip(cvs, result_cache.get_many(keys)):
+            if isinstance(value, dict):
+                value["key"] = str(item["cv_id"])
+                cached_result.append(value)
+            else:
+                pending.append(item)
+        if cached_result:
+            print(f"【Abstract-CV】命中简历信息提取结果缓存，数量：{len(cached_result)}/{len(cvs)}")
+        if not pending:
+            return cached_result
+
+        batches = cv_abstract_token_planner.plan(pending)
+        print(f"【Abstract-CV】按token预算切分为{len(batches)}个子批次：{[len(i) for i in batches]}")
+        result = cached_result
+        for idx, batch_result in enumerate(cv_abstract_executor.map(
+                lambda batch: self.cv_abstract_batch(batch, key_map), batches)):
+            if batch_result is None:
+                print(f"【Abstract-CV】子批次{idx}提取失败，简历：{[i['cv_id'] for i in batches[idx]]}")
+                continue
+            result.extend(batch_result)
+        return result or None
+
+    def cv_abstract_batch(self, cvs, key_map: dict):
+        """
+        :return: 提取结果列表，请求或解析异常时为None
+        """
         content = []
         for item in cvs:
-            origin = item["origin"]
-            if origin == "boss":
-                content.append("\nID: {}, 简历:".format(item["cv_id"]))
-                content.append(Part.from_text(item["meta_json"]))
-            else:
-                content.append("\nID: {}, 简历:".format(item["cv_id"]))
-                content.append(Part.from_uri(
-                    mime_type="application/pdf",
-                    uri=item["gcs_path"]))
+            content.extend(self.build_cv_contents(item))
         content.append("请输出结果")
         try:
-            response = self.cv_abstract_model.generate_content(
+            response = self.generate_content(
+                self.cv_abstract_model,
                 content,
                 generation_config=self.generation_config,
                 safety_settings=self.safety_settings,
                 stream=False,
+                policy="cv_abstract",
             )
             result = response.candidates[0].content.parts[0].text
             result = json.loads(result.replace("```json", "").replace("```", "").strip())
+            if not isinstance(result, list):
+                print(f"【Abstract-CV】提取结果格式异常：{result}")
+                return None
+            result = [i for i in result if isinstance(i, dict)]
+            result_cache.set_many({
+                key_map.get(str(i.get("key"))): {k: v for k, v in i.items() if k != "key"} for i in result
+            })
             return result
         except Exception as e:
             print(traceback.format_exc())
@@ -347,11 +496,13 @@ class Analytic(AnalyticBase):
     def sentence_summary_abstract(self, sentence):
         content = ["句子\n", sentence, "请输出结果"]
         try:
-            response = self.sentence_summary_abstract_model.generate_content(
+            response = self.generate_content(
+                self.sentence_summary_abstract_model,
                 content,
                 generation_config=self.generation_config,
                 safety_settings=self.safety_settings,
                 stream=False,
+                policy="sentence_summary_abstract",
             )
             result = response.candidates[0].content.parts[0].text
             result = json.loads(result.replace("```json", "").replace("```", "").strip())
@@ -364,11 +515,13 @@ class Analytic(AnalyticBase):
     def split_pdf(self, gcs_path: str):
         content = ["简历:", Part.from_uri(mime_type="application/pdf", uri=gcs_path), "\n请输出结果"]
         try:
-            response = self.split_pdf_model.generate_content(
+            response = self.generate_content(
+                self.split_pdf_model,
                 content,
                 generation_config=self.generation_config,
                 safety_settings=self.safety_settings,
                 stream=False,
+                policy="split_pdf",
             )
             result = response.candidates[0].content.parts[0].text
             result = json.loads(result.replace("```json", "").replace("```", "").strip())
@@ -382,10 +535,12 @@ class Analytic(AnalyticBase):
         content = ["面评模板:", Part.from_uri(mime_type=self.get_mime_type(template_save_path), uri=template_save_path),
                    "面试内容:", Part.from_uri(mime_type=self.get_mime_type(content_save_path), uri=content_save_path), "\n请输出结果"]
         try:
-            response = self.interview_eva_model.generate_content(
+            response = self.generate_content(
+                self.interview_eva_model,
                 content,
                 generation_config=self.generation_config,
                 safety_settings=self.safety_settings,
+                policy="interview_evaluation",
             )
             result = response.candidates[0].content.parts[0].text
             return result
@@ -1,16 +1,39 @@
-import vertexai
-from vertexai.generative_models import SafetySetting
+import asyncio
+import json
+import os
+import threading
+import time
+import traceback
+import typing
+
+import redis
+from cachetools import LRUCache
+from vertexai.generative_models import Part, SafetySetting
+from vertexai.language_models import TextEmbeddingInput
 from google.oauth2.service_account import Credentials
 
+from settings import setting
+from backgroup_task.call_policy import get_call_policy
+from backgroup_task.cv_text_store import cv_text_store
+from backgroup_task.embedding_batcher import get_embedding_batcher
+from backgroup_task.embedding_cache import embedding_cache
+from backgroup_task.model_registry import model_registry, generate_content_with_timeout, get_embeddings_with_timeout
+from backgroup_task.rate_limiter import vertex_rate_limiter
+
 
 class AnalyticBase:
     def __init__(self):
         self.model_name = "gemini-1.5-pro-002"
-        cren = Credentials.from_service_account_info({...})
         self.project_id = "wonder-ai1"
         self.region = "us-central1"
         self.embedding_model_id = "text-multilingual-embedding-002"
-        vertexai.init(project=self.project_id, location=self.region, credentials=cren)
+        self.embedding_task_type = "RETRIEVAL_QUERY"
+        self.embedding_dimensionality = 768
+        model_registry.init_vertexai(
+            project=self.project_id,
+            location=self.region,
+            credentials_factory=lambda: Credentials.from_service_account_info({...})
+        )
         self.generation_config = {
             "max_output_tokens": 8192,
             "temperature": 0.5,
@@ -36,29 +59,243 @@ class AnalyticBase:
             ),
         ]
 
-
-class AnalyticSessionChatManager:
-    SESSION = {}
-
     @staticmethod
-    def register_session(session_id, session, owner: str, **kwargs):
-        AnalyticSessionChatManager.SESSION[session_id] = {
-            "instance": session,
-            "owner": owner
-        }
+    def attach_cv_texts(cvs, backfill: bool = None):
+        """开启CV_PDF_TEXT_MODE时为PDF简历批量加载上传时提取的文本，backfill=False时不下载PDF补提取"""
+        return cv_text_store.attach(cvs, backfill=backfill)
 
     @staticmethod
-    def get_session(session_id):
-        s = AnalyticSessionChatManager.SESSION
-        if session_id in s:
-            return AnalyticSessionChatManager.SESSION[session_id]["instance"]
+    def build_cv_part(item):
+        """boss简历及已提取文本的PDF简历以文本发送，文本层为空的PDF简历发送原文件"""
+        if item.get("origin") == "boss":
+            return Part.from_text(item["meta_json"])
+        if item.get("text"):
+            return Part.from_text(item["text"])
+        return Part.from_uri(mime_type="application/pdf", uri=item["gcs_path"])
+
+    def generate_content(self, model, contents, stream: bool = False, policy: str = None, timeout: float = None,
+                         **kwargs):
+        """
+        请求模型，所有调用经过集群限流
+        stream=True时返回生成器，在响应被完整消费(或生成器关闭)之前一直占用并发名额
+        :param policy: 调用策略名称(见call_policy.DEFAULT_CALL_POLICIES)，为空时不重试；流式调用不支持
+        :param timeout: 未指定policy时的请求超时(秒)，指定policy时由策略按deadline设置
+        """
+        kwargs.setdefault("generation_config", self.generation_config)
+        kwargs.setdefault("safety_settings", self.safety_settings)
+        if stream:
+            return self._generate_content_stream(model, contents, **kwargs)
+        if policy:
+            return get_call_policy(policy).call(self._generate_content_once, model, contents, **kwargs)
+        return self._generate_content_once(model, contents, timeout=timeout, **kwargs)
+
+    def _generate_content_once(self, model, contents, timeout: float = None, **kwargs):
+        with vertex_rate_limiter.limit(self.model_name):
+            if timeout is None:
+                return model.generate_content(contents, stream=False, **kwargs)
+            return generate_content_with_timeout(model, contents, timeout, **kwargs)
+
+    def _generate_content_stream(self, model, contents, **kwargs):
+        with vertex_rate_limiter.limit(self.model_name):
+            yield from model.generate_content(contents, stream=True, **kwargs)
+
+    async def generate_content_async(self, model, contents, timeout: float = None, policy: str = None, **kwargs):
+        """异步请求模型，超过timeout秒未返回时取消请求并抛出asyncio.TimeoutError"""
+        kwargs.setdefault("generation_config", self.generation_config)
+        kwargs.setdefault("safety_settings", self.safety_settings)
+        if policy:
+            return await get_call_policy(policy).call_async(
+                self._generate_content_once_async, model, contents, timeout=timeout, **kwargs)
+        return await asyncio.wait_for(self._generate_content_once_async(model, contents, **kwargs), timeout)
+
+    async def _generate_content_once_async(self, model, contents, **kwargs):
+        async with vertex_rate_limiter.limit_async(self.model_name):
+            return await model.generate_content_async(contents, **kwargs)
+
+    @property
+    def embedding_model(self):
+        return model_registry.embedding_model(self.embedding_model_id)
+
+    def embedding_texts(self, texts):
+        try:
+            return embedding_cache.get_or_compute(
+                self.embedding_model_id,
+                self.embedding_task_type,
+                self.embedding_dimensionality,
+                texts,
+                self.batched_get_embeddings,
+            )
+        except Exception as e:
+            print(traceback.format_exc())
+            print(e)
+            return []
+
+    def embedding_text(self, msg):
+        values = self.embedding_texts([msg])
+        if values:
+            return values[0]
         return None
 
-    @staticmethod
-    def delete_session(session_id, owner: str):
-        s = AnalyticSessionChatManager.SESSION
-        if session_id in s and s[session_id]["owner"] == owner:
-            s.pop(session_id)
+    def batched_get_embeddings(self, texts):
+        """经过进程内微批服务合并后请求远端Embedding接口"""
+        if not getattr(setting, "EMBEDDING_MICRO_BATCH_ENABLE", True):
+            return self.get_embeddings(texts)
+        batcher = get_embedding_batcher(
+            (self.embedding_model_id, self.embedding_task_type, self.embedding_dimensionality),
+            self.get_embeddings,
+            window=getattr(setting, "EMBEDDING_MICRO_BATCH_WINDOW", 0.005),
+            max_batch_size=getattr(setting, "EMBEDDING_MICRO_BATCH_MAX_SIZE", 250),
+            # 已按EMBEDDING_BATCH_SIZE切好的分片直接请求，保持分片之间的并发
+            bypass_size=getattr(setting, "EMBEDDING_BATCH_SIZE", 150),
+            concurrency=getattr(setting, "EMBEDDING_MICRO_BATCH_CONCURRENCY", 4),
+        )
+        return batcher.embed(texts)
+
+    def get_embeddings(self, texts):
+        """直接请求远端Embedding接口，不经过缓存"""
+        return get_call_policy("embedding").call(self._get_embeddings_once, texts)
+
+    def _get_embeddings_once(self, texts, timeout: float = None):
+        inputs = [TextEmbeddingInput(text, self.embedding_task_type) for text in texts]
+        with vertex_rate_limiter.limit(self.embedding_model_id):
+            if timeout is None:
+                embeddings = self.embedding_model.get_embeddings(
+                    texts=inputs, output_dimensionality=self.embedding_dimensionality)
+            else:
+                embeddings = get_embeddings_with_timeout(
+                    self.embedding_model, inputs, timeout, output_dimensionality=self.embedding_dimensionality)
+        return [embedding.values for embedding in embeddings]
+
+    def warmup(self):
+        """预热当前实例用到的所有模型句柄；预热失败只记录日志，首次使用时再创建，不影响服务及Worker启动"""
+        models = []
+        for name in dir(type(self)):
+            if "_model" in name and isinstance(getattr(type(self), name), property):
+                try:
+                    models.append(getattr(self, name))
+                except Exception as e:
+                    print(f"【ModelRegistry】预热模型句柄{name}失败，{e}")
+        print(f"【ModelRegistry】预热模型句柄完成，{model_registry.stats()}")
+        return models
+
+
+class AnalyticSessionChatManager:
+    """
+    会话筛选的会话存储
+    1、会话状态(所属用户、岗位信息、筛选模式、对话历史)序列化到Redis，每次访问续期ttl秒，API服务及任意Worker进程都能继续同一会话
+    2、会话数超过max_sessions时淘汰最久未访问的会话(LRU)；对话历史只保留最近max_history_turns轮，且序列化后不超过max_history_bytes字节
+    3、进程内按LRU缓存最近使用的会话对象，Redis中的版本号未变化时直接复用，否则由factory根据状态及历史重建
+    4、会话只能由创建者读取、更新及删除
+    """
+    PREFIX = "AnalyticChat:Session:"
+    INDEX = "AnalyticChat:Sessions"
+
+    def __init__(
+        self,
+        redis_url: str,
+        factory: typing.Callable[[dict, list], typing.Any] = None,
+        ttl: int = 1800,
+        max_sessions: int = 1000,
+        max_history_turns: int = 5,
+        max_history_bytes: int = 1024 * 1024,
+        local_size: int = 64,
+    ):
+        self.factory = factory
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_history_turns = max_history_turns
+        self.max_history_bytes = max_history_bytes
+        self.local_size = local_size
+        self.redis_client = redis.from_url(redis_url, decode_responses=True)
+        self._local = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def key(self, session_id: str) -> str:
+        return self.PREFIX + session_id
+
+    @property
+    def local(self) -> LRUCache:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._local = LRUCache(maxsize=self.local_size)
+                self._pid = os.getpid()
+            return self._local
+
+    def register_session(self, session_id, session, owner: str, **kwargs):
+        """保存会话，session需实现to_state(max_history_turns, max_history_bytes) -> (state, history)"""
+        owner = str(owner)
+        key = self.key(session_id)
+        current_owner = self.redis_client.hget(key, "owner")
+        if current_owner is not None and current_owner != owner:
+            print(f"【SessionChat】会话{session_id}不属于{owner}，拒绝保存")
+            return
+        state, history = session.to_state(self.max_history_turns, self.max_history_bytes)
+        pipe = self.redis_client.pipeline()
+        pipe.hset(key, mapping={
+            "owner": owner,
+            "state": json.dumps(state, ensure_ascii=False),
+            "history": json.dumps(history, ensure_ascii=False),
+        })
+        pipe.hincrby(key, "version", 1)
+        pipe.expire(key, self.ttl)
+        pipe.zadd(self.INDEX, {session_id: time.time()})
+        version = pipe.execute()[1]
+        self.local[session_id] = (version, session)
+        self._evict()
+
+    def get_session(self, session_id, owner: str = None):
+        key = self.key(session_id)
+        current_owner, state, version = self.redis_client.hmget(key, "owner", "state", "version")
+        if current_owner is None:
+            self.local.pop(session_id, None)
+            return None
+        if owner is not None and current_owner != str(owner):
+            print(f"【SessionChat】会话{session_id}不属于{owner}")
+            return None
+        pipe = self.redis_client.pipeline()
+        pipe.expire(key, self.ttl)
+        pipe.zadd(self.INDEX, {session_id: time.time()})
+        pipe.execute()
+        version = int(version or 0)
+        cached = self.local.get(session_id)
+        if cached and cached[0] == version:
+            return cached[1]
+        history = json.loads(self.redis_client.hget(key, "history") or "[]")
+        session = self.factory(json.loads(state), history)
+        self.local[session_id] = (version, session)
+        return session
+
+    def delete_session(self, session_id, owner: str):
+        key = self.key(session_id)
+        if self.redis_client.hget(key, "owner") != str(owner):
+            return
+        pipe = self.redis_client.pipeline()
+        pipe.delete(key)
+        pipe.zrem(self.INDEX, session_id)
+        pipe.execute()
+        self.local.pop(session_id, None)
+
+    def _evict(self):
+        # 已过期的会话及超出上限的最久未访问会话
+        self.redis_client.zremrangebyscore(self.INDEX, "-inf", time.time() - self.ttl)
+        overflow = self.redis_client.zcard(self.INDEX) - self.max_sessions
+        if overflow <= 0:
+            return
+        victims = self.redis_client.zrange(self.INDEX, 0, overflow - 1)
+        if victims:
+            pipe = self.redis_client.pipeline()
+            pipe.delete(*[self.key(session_id) for session_id in victims])
+            pipe.zrem(self.INDEX, *victims)
+            pipe.execute()
+            print(f"【SessionChat】会话数超过上限，淘汰{len(victims)}个最久未访问的会话")
+
+    def stats(self):
+        return {
+            "sessions": self.redis_client.zcard(self.INDEX),
+            "max_sessions": self.max_sessions,
+            "local_size": len(self.local),
+        }
 
 
 class AnalyticSessionChatException(Exception):
@@ -3,11 +3,13 @@ import traceback
 import typing
 from typing import Iterable
 
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part, GenerationResponse, ChatSession
-from vertexai.language_models import TextEmbeddingModel, TextEmbeddingInput
+from vertexai.generative_models import Content, GenerationResponse, ChatSession
 
 from backgroup_task.analytic_base import AnalyticBase, AnalyticSessionChatException
+from backgroup_task.context_cache import context_cache
+from backgroup_task.model_registry import model_registry
+from backgroup_task.rate_limiter import vertex_rate_limiter
+from backgroup_task.stream_parser import JsonRecordStreamParser
 from settings import setting
 from tools.redis_cache_template import RedisCacheTemplate
 from tools.result import Result
@@ -36,25 +38,60 @@ class AnalyticChat(AnalyticBase):
       - `reason`: 适配理由
     """
 
-    def __init__(self, job_info):
+    def __init__(self, job_info, scope: str = None):
         super().__init__()
         self.model_name = "gemini-1.5-pro-002"
         self.job_info = job_info
-        self.cv_filter_model = GenerativeModel(
-            self.model_name,
-            system_instruction=[self.cv_filter_model_prompt, "## 岗位信息如下：\n" + self.job_info]
-        )
+        self.scope = scope
         self.chat_session: typing.Optional[ChatSession] = None
         self.filter_mode: typing.Literal["Pan-Mode", "Context-Mode", "Overlay-Mode"] = "Pan-Mode"
+        # 从会话存储恢复的对话历史，第一次发送消息时才创建ChatSession
+        self.history: typing.List[Content] = []
+
+    def to_state(self, max_history_turns: int = 5, max_history_bytes: int = 0):
+        """
+        序列化会话状态及最近max_history_turns轮对话历史，供AnalyticSessionChatManager保存
+        文本模式下每轮对话携带完整的简历文本，max_history_bytes>0时从最早的一轮开始丢弃，直到序列化后的历史不超过该字节数
+        """
+        history = self.chat_session.history if self.chat_session else self.history
+        history = history[-max_history_turns * 2:] if max_history_turns > 0 else []
+        history = [content.to_dict() for content in history]
+        if max_history_bytes > 0:
+            sizes = [len(json.dumps(item, ensure_ascii=False).encode("utf-8")) for item in history]
+            dropped = 0
+            while history and sum(sizes) > max_history_bytes:
+                # 按一问一答成对丢弃
+                history, sizes = history[2:], sizes[2:]
+                dropped += 1
+            if dropped:
+                print(f"{self}，对话历史超过{max_history_bytes}字节，丢弃最早的{dropped}轮")
+        state = {"job_info": self.job_info, "scope": self.scope, "filter_mode": self.filter_mode}
+        return state, history
+
+    @classmethod
+    def from_state(cls, state: dict, history: list):
+        chat = cls(state["job_info"], scope=state.get("scope"))
+        chat.filter_mode = state.get("filter_mode") or chat.filter_mode
+        chat.history = [Content.from_dict(item) for item in history]
+        return chat
+
+    @property
+    def cv_filter_model(self):
+        system_instruction = [self.cv_filter_model_prompt, "## 岗位信息如下：\n" + self.job_info]
+        return (
+            context_cache.get_model(self.model_name, system_instruction, scope=self.scope)
+            or model_registry.generative_model(self.model_name, system_instruction)
+        )
 
     def __str__(self):
         return f"AnalyticSessionChat<FilterMode={self.filter_mode}>"
 
-    def filter_cvs_with_mode1(self, special_condition, cvs):
+    def filter_cvs_with_mode1(self, special_condition, cvs, on_record: typing.Callable[[dict], None] = None):
         """
         filter by pan-mode
         pan-mode：Each resume sent to the big model is the batch of resumes passed in at the beginning of the session.
         :param special_condition: the special request condition.
+        :param on_record: called with every matched resume as soon as it is parsed from the stream.
         :return:
         """
         if not special_condition.strip() or len(special_condition.strip()) <= 3:
@@ -65,37 +102,34 @@ class AnalyticChat(AnalyticBase):
         i = 0
         for item in cvs:
             content.append("\n简历ID: {}, 简历:".format(item["cv_id"]))
-            if item["origin"] == "boss":
-                content.append(Part.from_text(item["meta_json"]))
-            else:
-                content.append(Part.from_uri(
-                    mime_type="application/pdf",
-                    uri=item["gcs_path"]))
+            content.append(self.build_cv_part(item))
             i += 1
         content.append("\n请输出评估结果")
-        response_stream = self.cv_filter_model.generate_content(
+        response_stream = self.generate_content(
+            self.cv_filter_model,
             content,
             generation_config=self.generation_config,
             safety_settings=self.safety_settings,
             stream=True,
         )
-        result = self.get_result_from_response_stream(response_stream)
+        result = self.get_result_from_response_stream(response_stream, on_record)
         return Result.ok(data=result)
 
-    def filter_cvs_with_mode2(self, special_condition, cvs):
+    def filter_cvs_with_mode2(self, special_condition, cvs, on_record: typing.Callable[[dict], None] = None):
         """
         filter by overlay mode
         context-mode：Each filtered resume is filtered again based on the previous filtering results.
         the context kept by a chat-session named 'vertexai.generative_models.ChatSession' which implemented historical
         message saving function
         :param special_condition: the special request condition.
+        :param on_record: called with every matched resume as soon as it is parsed from the stream.
         :return:
         """
         if not special_condition.strip() or len(special_condition.strip()) <= 3:
             return Result.fail("请输入有效的内容")
         try:
             if not self.chat_session:
-                chat_session = self.cv_filter_model.start_chat()
+                chat_session = self.cv_filter_model.start_chat(history=self.history)
                 self.chat_session = chat_session
         except Exception as e:
             print(f"创建简历过滤Session异常，{e}")
@@ -103,58 +137,57 @@ class AnalyticChat(AnalyticBase):
         content = []
         for item in cvs:
             content.append("\n简历ID: {}, 简历:".format(item["cv_id"]))
-            content.append("\n简历ID: {}, 简历:".format(item["cv_id"]))
-            if item["origin"] == "boss":
-                content.append(Part.from_text(item["meta_json"]))
-            else:
-                content.append(Part.from_uri(
-                    mime_type="application/pdf",
-                    uri=item["gcs_path"]))
+            content.append(self.build_cv_part(item))
         print(f"{self}，特殊要求Content: {special_condition}")
         content.append(f"\n岗位特殊要求\n{special_condition}")
         content.append("\n请输出评估结果")
-        response_stream: Iterable["GenerationResponse"] = self.chat_session.send_message(
-            content,
-            generation_config=self.generation_config,
-            safety_settings=self.safety_settings,
-            stream=True
-        )
-        result = self.get_result_from_response_stream(response_stream)
+        # 流式响应需要在限流上下文内消费完毕
+        with vertex_rate_limiter.limit(self.model_name):
+            response_stream: Iterable["GenerationResponse"] = self.chat_session.send_message(
+                content,
+                generation_config=self.generation_config,
+                safety_settings=self.safety_settings,
+                stream=True
+            )
+            result = self.get_result_from_response_stream(response_stream, on_record)
         return Result.ok(data=result)
 
-    def get_result_from_response_stream(self, response_stream: Iterable["GenerationResponse"]):
-        result = ""
-        for res in response_stream:
-            result += res.text
-        print(result)
-        # result = response_stream.text
-        try:
-            result = json.loads(result.replace("```json", "").replace("```", "").strip())
-        # except JSONDecodeError:
-        #     result = json.loads(result.replace("```json", "").replace("```", "").strip())
-        except Exception as e:
-            # case1 Expecting property name enclosed in double quotes
-            if "Expecting property name enclosed in double quotes" in str(e):
-                result = result.replace("\'", "\"")
-                result = json.loads(result)
-            else:
-                print(result)
-                print(f"{self} 解析结果异常，{e}")
-                traceback.print_exc()
-                raise AnalyticSessionChatException("会话结果解析异常")
-        # 有可能返回的key值格式有问题，有问题的直接过滤掉
-        result = [i for i in result if len(i["key"]) == 32 and i["suitability"] >= self.suitability_threshold]
-        for i in result:
+    def get_result_from_response_stream(
+        self,
+        response_stream: Iterable["GenerationResponse"],
+        on_record: typing.Callable[[dict], None] = None
+    ):
+        """
+        逐条解析流式输出的评估结果，每解析出一条有效结果立即回调on_record
+        """
+        parser = JsonRecordStreamParser(record_key="key")
+        result = []
+        for i in parser.parse(res.text for res in response_stream):
+            # 有可能返回的key值格式有问题，有问题的直接过滤掉
+            try:
+                if len(i["key"]) != 32 or float(i["suitability"]) < self.suitability_threshold:
+                    continue
+            except (KeyError, TypeError, ValueError):
+                continue
             print(i)
+            result.append(i)
+            if on_record:
+                on_record(i)
+        if parser.records == 0 and (parser.failed > 0 or parser.truncated):
+            print(parser.text)
+            print(f"{self} 解析结果异常")
+            raise AnalyticSessionChatException("会话结果解析异常")
         print("===================================")
         return result
 
-    def analyze(self, msg, cvs):
+    def analyze(self, msg, cvs, on_record: typing.Callable[[dict], None] = None):
         try:
+            # 交互场景不补提取，未提取过文本的简历直接发送PDF
+            self.attach_cv_texts(cvs, backfill=False)
             if self.filter_mode == "Pan-Mode":
-                ret = self.filter_cvs_with_mode1(msg, cvs)
+                ret = self.filter_cvs_with_mode1(msg, cvs, on_record)
             elif self.filter_mode == "Context-Mode":
-                ret = self.filter_cvs_with_mode2(msg, cvs)
+                ret = self.filter_cvs_with_mode2(msg, cvs, on_record)
             else:
                 ret = Result.fail("请求异常")
             return ret
@@ -164,17 +197,6 @@ class AnalyticChat(AnalyticBase):
             traceback.print_exc()
             return Result.fail(msg="服务器异常，{}".format(e))
 
-    def embedding_text(self, msg):
-        try:
-            model = TextEmbeddingModel.from_pretrained(self.embedding_model_id)
-            inputs = [TextEmbeddingInput(msg, "RETRIEVAL_QUERY")]
-            embeddings = model.get_embeddings(texts=inputs, output_dimensionality=768)
-            return embeddings[0].values
-        except Exception as e:
-            print(traceback.format_exc())
-            print(e)
-            return None
-
 
 if __name__ == "__main__":
     ...
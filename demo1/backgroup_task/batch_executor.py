@@ -0,0 +1,81 @@
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RateLimiter:
+    """
+    进程内令牌桶，按每分钟请求数(rpm)限速，rpm<=0时不限速
+    """
+
+    def __init__(self, rpm: int = 0, burst: int = None):
+        self.rpm = rpm
+        self.capacity = (burst or max(1, rpm // 60)) if rpm > 0 else 0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rpm <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rpm / 60)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) * 60 / self.rpm
+            time.sleep(wait)
+
+
+class BatchExecutor:
+    """
+    并发执行分片任务
+    1、最多max_workers个分片同时执行，结果与输入分片顺序一致
+    2、分片失败(抛出异常或返回值被判定为失败)时仅重试该分片，超过max_retries次后结果为None；
+       默认只有返回None才判定为失败，空结果视为有效结果，需要更严格判定时传入is_failed
+    3、每次调用前通过limiter限速
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        max_retries: int = 2,
+        retry_delay: float = 1.0,
+        limiter: RateLimiter = None,
+        is_failed: typing.Callable[[typing.Any], bool] = lambda r: r is None,
+    ):
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.limiter = limiter or RateLimiter()
+        self.is_failed = is_failed
+
+    def _run(self, fn: typing.Callable, index: int, batch):
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                time.sleep(self.retry_delay * attempt)
+            self.limiter.acquire()
+            try:
+                result = fn(batch)
+            except Exception as e:
+                print(f"【BatchExecutor】分片{index}第{attempt + 1}次执行异常，{e}")
+                continue
+            if not self.is_failed(result):
+                return result
+            print(f"【BatchExecutor】分片{index}第{attempt + 1}次执行失败")
+        return None
+
+    def map(self, fn: typing.Callable, batches: typing.Sequence) -> typing.List:
+        if len(batches) <= 1 or self.max_workers <= 1:
+            return [self._run(fn, idx, batch) for idx, batch in enumerate(batches)]
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as executor:
+            futures = [executor.submit(self._run, fn, idx, batch) for idx, batch in enumerate(batches)]
+            return [future.result() for future in futures]
+
+    @staticmethod
+    def split(items: typing.Sequence, size: int) -> typing.List:
+        return [items[i:i + size] for i in range(0, len(items), size)]
@@ -0,0 +1,328 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextvars
+import os
+import random
+import threading
+import time
+import typing
+
+from google.api_core import exceptions as google_exceptions
+
+from settings import setting
+
+# 可重试：限流、服务端暂时不可用、超时、网络中断
+RETRYABLE_EXCEPTIONS = (
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.Aborted,
+    ConnectionError,
+    TimeoutError,
+    concurrent.futures.TimeoutError,
+)
+
+
+class CallDeadlineExceeded(TimeoutError):
+    pass
+
+
+class CallHandle:
+    """
+    在线程池中执行的一次调用；调用被放弃(对冲失败或等待超时)时立即执行登记的回调，如释放限流名额
+    被放弃的调用本身仍会执行到SDK请求超时为止
+    """
+
+    def __init__(self):
+        self.abandoned = False
+        self._callbacks: typing.List[typing.Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def on_abandon(self, callback: typing.Callable[[], None]):
+        with self._lock:
+            if not self.abandoned:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def discard(self, callback: typing.Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def abandon(self):
+        with self._lock:
+            if self.abandoned:
+                return
+            self.abandoned = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+# 当前线程正在执行的调用，供限流器登记放弃时的回调
+current_call: contextvars.ContextVar[typing.Optional[CallHandle]] = contextvars.ContextVar("current_call", default=None)
+
+
+class CallPolicy:
+    """
+    模型调用策略
+    1、deadline：单次调用(含重试)的总截止时间(秒)，为空时不限制；每次尝试以timeout关键字参数把剩余时间传给fn，
+       由fn设置为SDK的请求超时，超时后请求在gRPC层取消，不占用后台线程
+    2、失败时按错误分类处理：RETRYABLE_EXCEPTIONS及retryable中的异常按指数退避+全抖动重试，其余异常直接抛出
+    3、hedge=True时，请求在p95耗时内未返回则再发送一个相同请求，取先返回的结果；样本不足hedge_min_samples时不对冲
+       只能用于无副作用的请求，ChatSession等有状态的调用不能开启；对冲会增加请求量，服务变慢时请求量随之翻倍，
+       Embedding等高QPS的调用不开启
+    4、只有对冲请求在线程池中执行，被淘汰的请求立即释放限流名额(见CallHandle)，并在SDK请求超时后结束
+    5、流式调用(analytic_cv_batch、会话筛选)不经过调用策略：响应开始输出后无法透明重试，由调用方处理异常及截断
+    """
+
+    def __init__(
+        self,
+        name: str,
+        deadline: float = None,
+        max_attempts: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        hedge_min_samples: int = 20,
+        hedge_min_delay: float = 0.5,
+        retryable: typing.Tuple[typing.Type[BaseException], ...] = (),
+    ):
+        self.name = name
+        self.deadline = deadline
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self.retryable = RETRYABLE_EXCEPTIONS + tuple(retryable)
+        self.latencies = collections.deque(maxlen=200)
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    def is_retryable(self, e: BaseException) -> bool:
+        return isinstance(e, self.retryable)
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def hedge_delay(self) -> typing.Optional[float]:
+        with self._lock:
+            if not self.hedge or len(self.latencies) < self.hedge_min_samples:
+                return None
+            values = sorted(self.latencies)
+        return max(self.hedge_min_delay, values[int(len(values) * self.hedge_quantile) - 1])
+
+    def _record(self, latency: float = None, **counters):
+        with self._lock:
+            if latency is not None:
+                self.latencies.append(latency)
+            self.counters.update(counters)
+
+    def _remaining(self, deadline_at: typing.Optional[float]) -> typing.Optional[float]:
+        if deadline_at is None:
+            return None
+        remaining = deadline_at - time.monotonic()
+        if remaining <= 0:
+            self._record(timeouts=1)
+            raise CallDeadlineExceeded(f"{self.name} exceeded deadline {self.deadline}s")
+        return remaining
+
+    @staticmethod
+    def _submit(fn, args, kwargs) -> typing.Tuple[concurrent.futures.Future, CallHandle]:
+        handle = CallHandle()
+
+        def run():
+            token = current_call.set(handle)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                current_call.reset(token)
+
+        return get_executor().submit(run), handle
+
+    def _call_once(self, fn, args, kwargs, remaining: typing.Optional[float]):
+        kwargs = {**kwargs, "timeout": remaining}
+        hedge_delay = self.hedge_delay()
+        if hedge_delay is None or (remaining is not None and hedge_delay >= remaining):
+            # 截止时间由SDK的请求超时保证，直接在当前线程执行
+            return fn(*args, **kwargs)
+        started = time.monotonic()
+        primary = self._submit(fn, args, kwargs)
+        pending = {primary[0]: primary[1]}
+        try:
+            done, _ = concurrent.futures.wait([primary[0]], timeout=hedge_delay)
+            if done:
+                pending.pop(primary[0])
+                return primary[0].result()
+            hedged = self._submit(fn, args, kwargs)
+            pending[hedged[0]] = hedged[1]
+            self._record(hedges=1)
+            error = None
+            while pending:
+                timeout = None if remaining is None else max(0.0, remaining - (time.monotonic() - started))
+                done, _ = concurrent.futures.wait(
+                    list(pending), timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                if not done:
+                    raise concurrent.futures.TimeoutError()
+                for future in done:
+                    pending.pop(future)
+                    if future.exception() is None:
+                        if future is hedged[0]:
+                            self._record(hedge_wins=1)
+                        return future.result()
+                    error = future.exception()
+            raise error
+        finally:
+            for handle in pending.values():
+                handle.abandon()
+
+    def call(self, fn: typing.Callable, *args, **kwargs):
+        deadline_at = time.monotonic() + self.deadline if self.deadline else None
+        for attempt in range(self.max_attempts):
+            remaining = self._remaining(deadline_at)
+            started = time.monotonic()
+            try:
+                result = self._call_once(fn, args, kwargs, remaining)
+                self._record(time.monotonic() - started, calls=1)
+                return result
+            except Exception as e:
+                if not self.is_retryable(e):
+                    self._record(calls=1, fatal=1)
+                    raise
+                if attempt >= self.max_attempts - 1:
+                    self._record(calls=1, exhausted=1)
+                    raise
+                delay = self.backoff(attempt)
+                print(f"【CallPolicy】{self.name}第{attempt + 1}次调用失败，{delay:.2f}秒后重试，{type(e).__name__}: {e}")
+                self._record(retries=1)
+                if deadline_at is not None:
+                    delay = min(delay, max(0.0, deadline_at - time.monotonic()))
+                time.sleep(delay)
+
+    async def _call_once_async(self, fn, args, kwargs, remaining: typing.Optional[float]):
+        hedge_delay = self.hedge_delay()
+        started = time.monotonic()
+        primary = asyncio.ensure_future(fn(*args, **kwargs))
+        if hedge_delay is None or (remaining is not None and hedge_delay >= remaining):
+            return await asyncio.wait_for(primary, remaining)
+        done, _ = await asyncio.wait([primary], timeout=hedge_delay)
+        if done:
+            return primary.result()
+        hedged = asyncio.ensure_future(fn(*args, **kwargs))
+        self._record(hedges=1)
+        pending = {primary, hedged}
+        error = None
+        try:
+            while pending:
+                timeout = None if remaining is None else max(0.0, remaining - (time.monotonic() - started))
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for future in done:
+                    if future.exception() is None:
+                        if future is hedged:
+                            self._record(hedge_wins=1)
+                        return future.result()
+                    error = future.exception()
+            raise error
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def call_async(self, fn: typing.Callable[..., typing.Awaitable], *args, timeout: float = None, **kwargs):
+        """call的异步版本，fn为协程函数；timeout不为空时覆盖deadline"""
+        deadline = timeout or self.deadline
+        deadline_at = time.monotonic() + deadline if deadline else None
+        for attempt in range(self.max_attempts):
+            remaining = self._remaining(deadline_at)
+            started = time.monotonic()
+            try:
+                result = await self._call_once_async(fn, args, kwargs, remaining)
+                self._record(time.monotonic() - started, calls=1)
+                return result
+            except Exception as e:
+                if not self.is_retryable(e):
+                    self._record(calls=1, fatal=1)
+                    raise
+                if attempt >= self.max_attempts - 1:
+                    self._record(calls=1, exhausted=1)
+                    raise
+                delay = self.backoff(attempt)
+                print(f"【CallPolicy】{self.name}第{attempt + 1}次调用失败，{delay:.2f}秒后重试，{type(e).__name__}: {e}")
+                self._record(retries=1)
+                if deadline_at is not None:
+                    delay = min(delay, max(0.0, deadline_at - time.monotonic()))
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            values = sorted(self.latencies)
+            counters = dict(self.counters)
+        percentile = lambda q: round(values[max(0, int(len(values) * q) - 1)], 3) if values else None
+        hedges = counters.get("hedges", 0)
+        return {
+            **counters,
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "hedge_win_rate": round(counters.get("hedge_wins", 0) / hedges, 3) if hedges else None,
+        }
+
+
+_executor: typing.Optional[concurrent.futures.ThreadPoolExecutor] = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor_pid != os.getpid():
+            # 线程池不会随fork复制到子进程
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=getattr(setting, "CALL_POLICY_MAX_WORKERS", 32), thread_name_prefix="call-policy")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+DEFAULT_CALL_POLICIES = {
+    "analytic_jd": {"deadline": 180, "max_attempts": 3},
+    "resolve_jd": {"deadline": 90, "max_attempts": 2, "hedge": True},
+    "cv_abstract": {"deadline": 300, "max_attempts": 2},
+    "sentence_summary_abstract": {"deadline": 60, "max_attempts": 3, "hedge": True},
+    "split_pdf": {"deadline": 180, "max_attempts": 2},
+    "interview_evaluation": {"deadline": 900, "max_attempts": 2},
+    "embedding": {"deadline": 30, "max_attempts": 3, "base_delay": 0.5},
+    "default": {"deadline": 120, "max_attempts": 3},
+}
+
+_policies: typing.Dict[str, CallPolicy] = {}
+_policies_lock = threading.Lock()
+
+
+def get_call_policy(name: str, **kwargs) -> CallPolicy:
+    """按方法名获取调用策略，参数取自DEFAULT_CALL_POLICIES，可通过setting.CALL_POLICIES按方法覆盖"""
+    with _policies_lock:
+        policy = _policies.get(name)
+        if policy is None:
+            overrides = getattr(setting, "CALL_POLICIES", None) or {}
+            config = {
+                **DEFAULT_CALL_POLICIES.get(name, DEFAULT_CALL_POLICIES["default"]),
+                **overrides.get(name, {}),
+                **kwargs,
+            }
+            policy = _policies[name] = CallPolicy(name, **config)
+        return policy
+
+
+def call_policies_stats():
+    with _policies_lock:
+        return {name: policy.stats() for name, policy in _policies.items()}
@@ -0,0 +1,157 @@
+import atexit
+import os
+import threading
+import typing
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class CeleryCallbackEvent:
+    """
+    批量回调中的单个事件
+    1、与回调请求接口一致：事件名在query_params["event"]中，await json()返回事件数据
+    2、批量回调接口逐个交给CeleryTaskService.dispatch处理，与单事件接口共用同一套分发逻辑
+    """
+
+    def __init__(self, event: str, payload: dict):
+        self.query_params = {"event": event}
+        self._payload = payload or {}
+
+    async def json(self):
+        return self._payload
+
+    def __repr__(self):
+        return f"CeleryCallbackEvent<event={self.query_params['event']}>"
+
+
+class CeleryCallbackClient:
+    """
+    Celery任务回调客户端
+    1、每个Worker进程持有一个keep-alive的连接池(requests.Session)，prefork模式下fork后按进程重新创建
+    2、batch模式下，emit提交的事件在batch_window时间窗口内合并为一次多事件请求；call会捎带尚未发送的事件
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        headers: dict = None,
+        pool_maxsize: int = 10,
+        timeout: float = 60,
+        batch_enable: bool = False,
+        batch_window: float = 0.05,
+        batch_max_size: int = 50,
+    ):
+        self.base_url = base_url
+        self.headers = headers or {}
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.batch_enable = batch_enable
+        self.batch_window = batch_window
+        self.batch_max_size = batch_max_size
+        self._pid = None
+        self._session: typing.Optional[requests.Session] = None
+        self._pending: typing.List[dict] = []
+        self._flush_timer: typing.Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    @property
+    def single_url(self):
+        return self.base_url + "/index/bg/celery/callback"
+
+    @property
+    def batch_url(self):
+        return self.base_url + "/index/bg/celery/callback/batch"
+
+    @property
+    def session(self) -> requests.Session:
+        pid = os.getpid()
+        if self._session is None or self._pid != pid:
+            # 连接池和待发送队列都不能跨进程共享，fork出的子进程需要重新初始化
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update(self.headers)
+            self._session, self._pid = session, pid
+            self._pending = []
+            self._flush_timer = None
+            self._lock = threading.Lock()
+            self._send_lock = threading.Lock()
+        return self._session
+
+    def call(self, event: str, **payload):
+        """
+        同步回调，返回回调接口的data；若存在尚未发送的事件，则与本事件合并为一次批量请求按顺序发送
+        """
+        session = self.session
+        with self._send_lock:
+            pending = self._take_pending()
+            if not pending:
+                return self._post_single(session, event, payload)
+            results = self._post_batch(session, pending + [{"event": event, "payload": payload}])
+            return results[-1]
+
+    def emit(self, event: str, **payload):
+        """
+        不关心返回值的回调，batch模式下进入待发送队列，否则立即发送
+        """
+        if not self.batch_enable:
+            self.call(event, **payload)
+            return
+        session = self.session
+        with self._lock:
+            self._pending.append({"event": event, "payload": payload})
+            full = len(self._pending) >= self.batch_max_size
+            if not full and self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.batch_window, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        if full:
+            self.flush(session)
+
+    def flush(self, session: requests.Session = None):
+        if self._pid != os.getpid():
+            return
+        session = session or self.session
+        with self._send_lock:
+            pending = self._take_pending()
+            if pending:
+                self._post_batch(session, pending)
+
+    def _take_pending(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        return pending
+
+    def _post_single(self, session: requests.Session, event: str, payload: dict):
+        try:
+            res = session.post(self.single_url, params={"event": event}, json=payload, timeout=self.timeout)
+        except requests.RequestException as e:
+            print(f"[Debug]: Event({event}) celery callback request error: {e}")
+            return None
+        print(f"[Debug]: Event({event}) celery callback response code: {res.status_code}, text: {res.text[:512]}")
+        if res.status_code == 200 and res.json()["code"] == 200:
+            return res.json()["data"]
+        return None
+
+    def _post_batch(self, session: requests.Session, events: typing.List[dict]):
+        names = ",".join(i["event"] for i in events)
+        try:
+            res = session.post(self.batch_url, json={"events": events}, timeout=self.timeout)
+        except requests.RequestException as e:
+            print(f"[Debug]: Events({names}) celery batch callback request error: {e}")
+            return [None] * len(events)
+        print(f"[Debug]: Events({names}) celery batch callback response code: {res.status_code}")
+        if res.status_code != 200 or res.json()["code"] != 200:
+            print(f"[Debug]: Events({names}) celery batch callback failed, text: {res.text[:512]}")
+            return [None] * len(events)
+        results = []
+        for item in res.json()["data"]:
+            results.append(item["data"] if item["code"] == 200 else None)
+        return results
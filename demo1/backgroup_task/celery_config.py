@@ -0,0 +1,85 @@
+import sys
+
+from kombu import Queue
+
+from settings import setting
+
+TASK_PREFIX = "backgroup_task.main."
+
+# 任务所属队列，不在列表中的任务进入default队列
+TASK_QUEUE_MAP = {
+    # 用户在websocket上等待结果的任务
+    "interactive": ["text_embedding", "analyze_chat_cvs"],
+    "embedding": ["sentence_embedding", "split_pdf_chunks_and_embedding", "cvs_search_task_via_vector"],
+    # 单次耗时数分钟的批量大模型任务
+    "llm-bulk": ["analytic_jd", "analytic_cv", "abstract_cv"],
+    "media": ["interview_eva"],
+}
+DEFAULT_QUEUE = "default"
+
+
+def task_limit_overrides():
+    """
+    单个任务覆盖所在队列的超时配置
+    analyze_chat_cvs需要流式分析最多200份简历(可能还要回填简历文本)，与API服务等待结果的WS_TASK_TIMEOUT保持一致，
+    text_embedding仍使用interactive队列的60秒
+    """
+    ws_timeout = int(getattr(setting, "WS_TASK_TIMEOUT", 120))
+    return {
+        "analyze_chat_cvs": {"soft_time_limit": ws_timeout, "time_limit": ws_timeout + 30},
+    }
+
+# 每个队列由独立的Worker进程池消费，可通过setting.CELERY_QUEUES按队列覆盖
+DEFAULT_QUEUE_CONFIG = {
+    "interactive": {"concurrency": 8, "prefetch_multiplier": 1, "soft_time_limit": 60, "time_limit": 90},
+    "embedding": {"concurrency": 4, "prefetch_multiplier": 4, "soft_time_limit": 300, "time_limit": 360},
+    "llm-bulk": {"concurrency": 4, "prefetch_multiplier": 1, "soft_time_limit": 1800, "time_limit": 2100},
+    "media": {"concurrency": 2, "prefetch_multiplier": 1, "soft_time_limit": 1800, "time_limit": 2100},
+    "default": {"concurrency": 2, "prefetch_multiplier": 4, "soft_time_limit": 300, "time_limit": 360},
+}
+
+
+def queue_configs():
+    overrides = getattr(setting, "CELERY_QUEUES", None) or {}
+    configs = {}
+    for name, config in DEFAULT_QUEUE_CONFIG.items():
+        configs[name] = {**config, **overrides.get(name, {})}
+    return configs
+
+
+def build_celery_config():
+    configs = queue_configs()
+    overrides = task_limit_overrides()
+    task_routes, task_annotations = {}, {}
+    for queue, tasks in TASK_QUEUE_MAP.items():
+        for task in tasks:
+            task_routes[TASK_PREFIX + task] = {"queue": queue}
+            task_annotations[TASK_PREFIX + task] = {
+                "soft_time_limit": configs[queue]["soft_time_limit"],
+                "time_limit": configs[queue]["time_limit"],
+                **overrides.get(task, {}),
+            }
+    return {
+        "task_queues": [Queue(name) for name in configs],
+        "task_default_queue": DEFAULT_QUEUE,
+        "task_routes": task_routes,
+        "task_annotations": task_annotations,
+        "task_soft_time_limit": configs[DEFAULT_QUEUE]["soft_time_limit"],
+        "task_time_limit": configs[DEFAULT_QUEUE]["time_limit"],
+    }
+
+
+def worker_args(queue: str) -> str:
+    """启动某个队列的Worker时使用的命令行参数"""
+    config = queue_configs()[queue]
+    return "-Q {queue} -n {queue}@%h -c {concurrency} --prefetch-multiplier {prefetch_multiplier}".format(
+        queue=queue, **config)
+
+
+if __name__ == '__main__':
+    # python -m backgroup_task.celery_config            输出全部队列名称
+    # python -m backgroup_task.celery_config <queue>    输出该队列Worker的启动参数
+    if len(sys.argv) > 1:
+        print(worker_args(sys.argv[1]))
+    else:
+        print(" ".join(queue_configs().keys()))
@@ -0,0 +1,189 @@
+import datetime
+import hashlib
+import os
+import threading
+import time
+import typing
+
+import redis
+from vertexai.preview import caching
+from vertexai.preview.generative_models import GenerativeModel
+
+from backgroup_task.token_planner import TOKENIZER
+from settings import setting
+
+
+class ContextCacheManager:
+    """
+    Vertex上下文缓存管理，同一岗位的system_instruction及公共前缀只上传、处理一次
+    1、按hash(model_name, system_instruction, contents)在首次使用时创建CachedContent，句柄记录在Redis中供所有进程共用
+    2、剩余有效期小于refresh_before秒时延长TTL，创建及续期通过Redis锁保证同一时间只有一个进程执行
+    3、缓存内容少于min_tokens(Vertex要求的最小缓存token数)时不创建缓存，调用方使用普通模型；
+       单个岗位的prompt及岗位信息通常只有几千token，默认的32768基本不会达到，只有岗位附件很长、
+       或Vertex降低最小缓存token数后才有收益，此时需同步调低CONTEXT_CACHE_MIN_TOKENS；
+       缓存按存储时长计费，岗位请求不频繁时节省的输入token费用可能抵不上存储费用
+    4、创建时登记到scope(岗位ID)下，岗位更新或删除时调用drop(scope)删除该岗位的全部缓存
+    5、任何异常均返回None，调用方退回普通模型，不影响分析流程
+    """
+    CACHE_PREFIX = "Vertex:ContextCache:"
+    SCOPE_PREFIX = "Vertex:ContextCache:Scope:"
+    LOCK_PREFIX = "Vertex:ContextCache:Lock:"
+
+    def __init__(
+        self,
+        redis_url: str,
+        ttl: int = 3600,
+        refresh_before: int = 300,
+        min_tokens: int = 32768,
+        enable: bool = False,
+    ):
+        self.enable = enable
+        self.ttl = ttl
+        self.refresh_before = refresh_before
+        self.min_tokens = min_tokens
+        self.redis_client = redis.from_url(redis_url)
+        self.hits = 0
+        self.creates = 0
+        self.refreshes = 0
+        self._pid = None
+        self._models: typing.Dict[str, GenerativeModel] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_name: str, system_instruction: typing.List[str], contents: typing.List[str]) -> str:
+        raw = "\x1f".join([model_name, *system_instruction, "\x1e", *contents])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _model(self, cached_content_name: str) -> GenerativeModel:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._models = {}
+            model = self._models.get(cached_content_name)
+            if model is None:
+                cached_content = caching.CachedContent(cached_content_name=cached_content_name)
+                model = self._models[cached_content_name] = GenerativeModel.from_cached_content(cached_content)
+            return model
+
+    def _forget(self, cached_content_name: str):
+        with self._lock:
+            self._models.pop(cached_content_name, None)
+
+    def get_model(
+        self,
+        model_name: str,
+        system_instruction: typing.List[str],
+        contents: typing.List[str] = None,
+        scope: str = None,
+    ) -> typing.Optional[GenerativeModel]:
+        """
+        :param contents: 缓存在system_instruction之后的公共前缀，调用方生成内容时不再需要携带
+        :param scope: 岗位ID，用于岗位更新或删除时清理缓存
+        :return: 绑定了上下文缓存的模型，不满足缓存条件或异常时返回None
+        """
+        if not self.enable:
+            return None
+        contents = contents or []
+        tokens = sum(len(TOKENIZER.encode(text)) for text in [*system_instruction, *contents])
+        if tokens < self.min_tokens:
+            return None
+        key = self.make_key(model_name, system_instruction, contents)
+        try:
+            record = self.redis_client.hgetall(self.CACHE_PREFIX + key)
+            if record:
+                name = record[b"name"].decode()
+                if float(record[b"expire_at"]) - time.time() > self.refresh_before:
+                    self.hits += 1
+                    return self._model(name)
+                if self._refresh(key, name, scope):
+                    return self._model(name)
+            return self._create(key, model_name, system_instruction, contents, scope)
+        except Exception as e:
+            print(f"【ContextCache】获取上下文缓存异常，使用普通模型，{e}")
+            return None
+
+    def _acquire(self, key: str) -> bool:
+        return bool(self.redis_client.set(self.LOCK_PREFIX + key, os.getpid(), nx=True, ex=60))
+
+    def _save(self, key: str, name: str, scope: str = None):
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.hset(self.CACHE_PREFIX + key, mapping={"name": name, "expire_at": time.time() + self.ttl})
+        pipe.expire(self.CACHE_PREFIX + key, self.ttl)
+        if scope:
+            pipe.sadd(self.SCOPE_PREFIX + scope, key)
+            pipe.expire(self.SCOPE_PREFIX + scope, self.ttl)
+        pipe.execute()
+
+    def _refresh(self, key: str, name: str, scope: str = None) -> bool:
+        if not self._acquire(key):
+            # 其他进程正在续期，缓存仍在有效期内，直接使用
+            return True
+        try:
+            caching.CachedContent(cached_content_name=name).update(ttl=datetime.timedelta(seconds=self.ttl))
+            self._save(key, name, scope)
+            self.refreshes += 1
+            return True
+        except Exception as e:
+            print(f"【ContextCache】上下文缓存续期失败，重新创建，{name}，{e}")
+            self.redis_client.delete(self.CACHE_PREFIX + key)
+            self._forget(name)
+            return False
+        finally:
+            self.redis_client.delete(self.LOCK_PREFIX + key)
+
+    def _create(self, key, model_name, system_instruction, contents, scope=None) -> typing.Optional[GenerativeModel]:
+        if not self._acquire(key):
+            # 其他进程正在创建，本次请求使用普通模型
+            return None
+        try:
+            cached_content = caching.CachedContent.create(
+                model_name=model_name,
+                system_instruction=list(system_instruction),
+                contents=list(contents) or None,
+                ttl=datetime.timedelta(seconds=self.ttl),
+                display_name=f"ctx-{key[:16]}",
+            )
+            self._save(key, cached_content.name, scope)
+            self.creates += 1
+            print(f"【ContextCache】创建上下文缓存成功，{cached_content.name}，scope={scope}")
+            return self._model(cached_content.name)
+        finally:
+            self.redis_client.delete(self.LOCK_PREFIX + key)
+
+    def drop(self, scope: str) -> int:
+        """删除scope(岗位ID)下的全部上下文缓存，返回删除数量"""
+        keys = self.redis_client.smembers(self.SCOPE_PREFIX + scope)
+        count = 0
+        for key in keys:
+            key = key.decode()
+            name = self.redis_client.hget(self.CACHE_PREFIX + key, "name")
+            self.redis_client.delete(self.CACHE_PREFIX + key)
+            if not name:
+                continue
+            name = name.decode()
+            self._forget(name)
+            try:
+                caching.CachedContent(cached_content_name=name).delete()
+                count += 1
+            except Exception as e:
+                print(f"【ContextCache】删除上下文缓存失败，{name}，{e}")
+        self.redis_client.delete(self.SCOPE_PREFIX + scope)
+        return count
+
+    def stats(self):
+        return {
+            "enable": self.enable,
+            "hits": self.hits,
+            "creates": self.creates,
+            "refreshes": self.refreshes,
+            "models": len(self._models),
+        }
+
+
+context_cache = ContextCacheManager(
+    redis_url=setting.REDIS_URL,
+    ttl=getattr(setting, "CONTEXT_CACHE_TTL", 3600),
+    refresh_before=getattr(setting, "CONTEXT_CACHE_REFRESH_BEFORE", 300),
+    min_tokens=getattr(setting, "CONTEXT_CACHE_MIN_TOKENS", 32768),
+    enable=getattr(setting, "CONTEXT_CACHE_ENABLE", False),
+)
@@ -0,0 +1,141 @@
+import asyncio
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+from settings import setting
+
+
+class CvTextStore:
+    """
+    PDF简历文本存储，开启后分析简历时以文本Part代替PDF发送给模型
+    1、上传简历时提取一次文本，写入GCS同目录下的同名.txt文件(持久化)及Redis(读缓存)
+    2、读取顺序：Redis mget -> GCS .txt文件 -> 下载PDF重新提取(功能上线前已上传的简历)，提取结果回写
+    3、扫描件等文本层为空(少于min_chars个字符)的简历记为空字符串，分析时仍发送PDF
+    4、Redis未命中的简历以最多load_concurrency个线程并发读取；会话筛选等交互场景不补提取，未提取过的简历直接发送PDF
+    """
+    CACHE_PREFIX = "CV:Text:"
+
+    def __init__(
+        self,
+        redis_url: str,
+        expire: int = 7 * 24 * 3600,
+        min_chars: int = 50,
+        backfill: bool = True,
+        load_concurrency: int = 8,
+        enable: bool = False,
+    ):
+        self.enable = enable
+        self.expire = expire
+        self.min_chars = min_chars
+        self.backfill = backfill
+        self.load_concurrency = max(1, load_concurrency)
+        self.redis_client = redis.from_url(redis_url)
+        self._gcs_client = None
+
+    @property
+    def gcs_client(self):
+        if self._gcs_client is None:
+            from tools.gcs import GCSClient
+            self._gcs_client = GCSClient()
+        return self._gcs_client
+
+    @staticmethod
+    def text_blob_name(blob_name: str) -> str:
+        return blob_name.rsplit(".", 1)[0] + ".txt"
+
+    def normalize(self, text: typing.Optional[str]) -> str:
+        text = (text or "").strip()
+        return text if len(text) >= self.min_chars else ""
+
+    def extract(self, pdf_stream: bytes) -> str:
+        from tools.pdf_extract import extract_pdf_text
+        try:
+            return self.normalize(extract_pdf_text(pdf_stream=pdf_stream))
+        except Exception as e:
+            print(f"【CvTextStore】提取PDF文本异常，{e}")
+            return ""
+
+    def save(self, gcs_path: str, text: str):
+        """保存提取结果，text为空表示该简历需要发送PDF"""
+        text = self.normalize(text)
+        try:
+            blob_name = self.text_blob_name(self.gcs_client.get_filename_from_gcs_path(gcs_path))
+            self.gcs_client.bucket.blob(blob_name).upload_from_string(text, content_type="text/plain; charset=utf-8")
+        except Exception as e:
+            print(f"【CvTextStore】上传简历文本异常，{gcs_path}，{e}")
+        try:
+            self.redis_client.setex(self.CACHE_PREFIX + gcs_path, self.expire, text)
+        except redis.RedisError as e:
+            print(f"【CvTextStore】写入Redis缓存异常，{e}")
+
+    async def save_from_pdf_async(self, gcs_path: str, pdf_stream: bytes):
+        """供上传接口使用，提取及上传在线程中执行，不阻塞事件循环"""
+        if not self.enable:
+            return
+        text = await asyncio.to_thread(self.extract, pdf_stream)
+        await asyncio.to_thread(self.save, gcs_path, text)
+
+    def _load(self, gcs_path: str, backfill: bool = True) -> typing.Optional[str]:
+        blob_name = self.gcs_client.get_filename_from_gcs_path(gcs_path)
+        try:
+            blob = self.gcs_client.bucket.get_blob(self.text_blob_name(blob_name))
+            if blob is not None:
+                text = self.normalize(blob.download_as_bytes().decode("utf-8"))
+                self.redis_client.setex(self.CACHE_PREFIX + gcs_path, self.expire, text)
+                return text
+            if not backfill:
+                return None
+            text = self.extract(self.gcs_client.download(blob_name).getvalue())
+            self.save(gcs_path, text)
+            return text
+        except Exception as e:
+            print(f"【CvTextStore】读取简历文本异常，{gcs_path}，{e}")
+            return None
+
+    def get_many(self, gcs_paths: typing.List[str], backfill: bool = None) -> typing.List[typing.Optional[str]]:
+        """
+        返回None表示未能获取文本，空字符串表示文本层为空，两者都应发送PDF
+        :param backfill: 是否下载PDF补提取，为空时使用CV_TEXT_BACKFILL配置
+        """
+        if not self.enable or not gcs_paths:
+            return [None] * len(gcs_paths)
+        try:
+            values = self.redis_client.mget([self.CACHE_PREFIX + path for path in gcs_paths])
+        except redis.RedisError as e:
+            print(f"【CvTextStore】读取Redis缓存异常，{e}")
+            values = [None] * len(gcs_paths)
+        backfill = self.backfill if backfill is None else (backfill and self.backfill)
+        results = [value.decode("utf-8") if value is not None else None for value in values]
+        missing = [idx for idx, value in enumerate(values) if value is None]
+        if len(missing) == 1:
+            results[missing[0]] = self._load(gcs_paths[missing[0]], backfill)
+        elif missing:
+            with ThreadPoolExecutor(max_workers=min(self.load_concurrency, len(missing))) as executor:
+                loaded = executor.map(lambda idx: self._load(gcs_paths[idx], backfill), missing)
+                for idx, text in zip(missing, loaded):
+                    results[idx] = text
+        return results
+
+    def attach(self, cvs: typing.List[dict], backfill: bool = None) -> typing.List[dict]:
+        """为PDF简历设置text字段，build_cv_part据此决定发送文本还是PDF"""
+        pdf_cvs = [item for item in cvs if item.get("origin") != "boss" and item.get("gcs_path") and "text" not in item]
+        if not self.enable or not pdf_cvs:
+            return cvs
+        texts = self.get_many([item["gcs_path"] for item in pdf_cvs], backfill=backfill)
+        for item, text in zip(pdf_cvs, texts):
+            if text:
+                item["text"] = text
+        print(f"【CvTextStore】文本模式简历数量：{sum(1 for text in texts if text)}/{len(pdf_cvs)}")
+        return cvs
+
+
+cv_text_store = CvTextStore(
+    redis_url=setting.REDIS_URL,
+    expire=getattr(setting, "CV_TEXT_CACHE_EXPIRE", 7 * 24 * 3600),
+    min_chars=getattr(setting, "CV_TEXT_MIN_CHARS", 50),
+    backfill=getattr(setting, "CV_TEXT_BACKFILL", True),
+    load_concurrency=getattr(setting, "CV_TEXT_LOAD_CONCURRENCY", 8),
+    enable=getattr(setting, "CV_PDF_TEXT_MODE", False),
+)
@@ -8,6 +8,8 @@ from vertexai.language_models import TextEmbeddingModel, TextEmbeddingInput
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity, euclidean_distances
 
+from backgroup_task.rate_limiter import vertex_rate_limiter
+
 
 credentials = Credentials.from_service_account_info({...})
 project_id = "wonder-ai1"
@@ -34,7 +36,8 @@ class EmbeddingVectorGenerator(object):
         ]
 
         try:
-            response = endpoint.predict(instances=instances)
+            with vertex_rate_limiter.limit(endpoint_name):
+                response = endpoint.predict(instances=instances)
             # 提取嵌入向量
             return response.predictions
         except Exception as e:
@@ -46,7 +49,8 @@ def embedding_text(msg):
     try:
         model = TextEmbeddingModel.from_pretrained(embedding_model)
         inputs = [TextEmbeddingInput(msg, "RETRIEVAL_DOCUMENT")]
-        embeddings = model.get_embeddings(texts=inputs, output_dimensionality=768)
+        with vertex_rate_limiter.limit(embedding_model):
+            embeddings = model.get_embeddings(texts=inputs, output_dimensionality=768)
         return embeddings[0].values
     except Exception as e:
         print(traceback.format_exc())
@@ -61,7 +65,8 @@ def tuning_embedding_text(msg, endpoint_id="1300452875310202880"):
     ]
 
     try:
-        response = endpoint.predict(instances=instances)
+        with vertex_rate_limiter.limit(endpoint.resource_name):
+            response = endpoint.predict(instances=instances)
         # 提取嵌入向量
         embeddings = response.predictions[0]
         return embeddings
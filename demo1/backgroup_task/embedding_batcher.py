@@ -0,0 +1,128 @@
+import os
+import queue
+import threading
+import time
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class EmbeddingMicroBatcher:
+    """
+    进程内Embedding微批服务
+    同一进程内并发任务(threads/gevent池、分片并发)提交的Embedding请求，在window秒内或文本数达到max_batch_size时
+    合并为一次远端请求，再按提交顺序把向量分发回各调用方
+    1、文本数不少于bypass_size的请求(如已按EMBEDDING_BATCH_SIZE切好的分片)直接请求，不参与合并
+    2、合并后的请求在concurrency个线程中并发执行，分发线程只负责攒批，多个批次之间不会串行等待
+    """
+
+    def __init__(
+        self,
+        compute: typing.Callable[[typing.List[str]], typing.List[typing.List[float]]],
+        window: float = 0.005,
+        max_batch_size: int = 250,
+        bypass_size: int = None,
+        concurrency: int = 4,
+    ):
+        self.compute = compute
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.bypass_size = min(bypass_size or max_batch_size, max_batch_size)
+        self.concurrency = max(1, concurrency)
+        self.requests = 0
+        self.batches = 0
+        self._pid = None
+        self._queue: typing.Optional[queue.Queue] = None
+        self._carry = None
+        self._executor: typing.Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            # 分发线程不会随fork复制到子进程，需要在子进程中重新启动
+            self._queue = queue.Queue()
+            self._carry = None
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="embedding-micro-batch")
+            self.requests = self.batches = 0
+            threading.Thread(target=self._run, name="embedding-micro-batcher", daemon=True).start()
+            self._pid = pid
+
+    def embed(self, texts: typing.List[str]) -> typing.List[typing.List[float]]:
+        if not texts:
+            return []
+        if len(texts) >= self.bypass_size:
+            return self.compute(texts)
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((texts, future))
+        return future.result()
+
+    def _collect(self):
+        if self._carry is not None:
+            pending, self._carry = [self._carry], None
+        else:
+            pending = [self._queue.get()]
+        size = len(pending[0][0])
+        deadline = time.monotonic() + self.window
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if size + len(item[0]) > self.max_batch_size:
+                # 超出上限的请求留到下一批的开头
+                self._carry = item
+                break
+            pending.append(item)
+            size += len(item[0])
+        return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            self.requests += len(pending)
+            self.batches += 1
+            self._executor.submit(self._compute_batch, pending)
+
+    def _compute_batch(self, pending):
+        texts = [text for item in pending for text in item[0]]
+        try:
+            values = self.compute(texts)
+            if len(values) != len(texts):
+                raise ValueError(f"embedding result size {len(values)} != input size {len(texts)}")
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        offset = 0
+        for item_texts, future in pending:
+            future.set_result(values[offset:offset + len(item_texts)])
+            offset += len(item_texts)
+
+    def stats(self):
+        return {"requests": self.requests, "batches": self.batches}
+
+
+_batchers: typing.Dict[tuple, EmbeddingMicroBatcher] = {}
+_batchers_lock = threading.Lock()
+
+
+def get_embedding_batcher(key: tuple, compute: typing.Callable, **kwargs) -> EmbeddingMicroBatcher:
+    """相同(model_id, task_type, output_dimensionality)的请求共用一个微批服务"""
+    with _batchers_lock:
+        batcher = _batchers.get(key)
+        if batcher is None:
+            batcher = _batchers[key] = EmbeddingMicroBatcher(compute, **kwargs)
+        return batcher
+
+
+def embedding_batchers_stats():
+    with _batchers_lock:
+        return {"/".join(str(i) for i in key): batcher.stats() for key, batcher in _batchers.items()}
@@ -0,0 +1,128 @@
+import hashlib
+import threading
+import typing
+
+import numpy as np
+import redis
+from cachetools import LRUCache
+
+from settings import setting
+
+
+class EmbeddingCache:
+    """
+    内容寻址的Embedding缓存，key为hash(model_id, task_type, output_dimensionality, text)
+    1、优先命中进程内LRU
+    2、其次命中Redis，向量以float32小端字节存储
+    进程内LRU同样保存float32数组(768维约3KB/条)，返回给调用方时再转换为list
+    3、仅未命中的文本请求远端Embedding接口，结果按输入顺序合并
+    """
+    CACHE_PREFIX = "Embedding:Vector:"
+
+    def __init__(self, redis_url: str, local_maxsize: int = 4096, expire: int = 30 * 24 * 3600, enable: bool = True):
+        self.enable = enable
+        self.expire = expire
+        self.local = LRUCache(maxsize=local_maxsize)
+        self.redis_client = redis.from_url(redis_url)
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_id: str, task_type: str, dimensionality: int, text: str) -> str:
+        raw = "\x1f".join([model_id, task_type, str(dimensionality), text])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def pack(vector: typing.Sequence[float]) -> bytes:
+        return np.asarray(vector, dtype="<f4").tobytes()
+
+    @staticmethod
+    def unpack(data: bytes) -> np.ndarray:
+        return np.frombuffer(data, dtype="<f4")
+
+    def get_many(self, keys: typing.List[str]) -> typing.List[typing.Optional[typing.List[float]]]:
+        results = [None] * len(keys)
+        remote_indexes = []
+        with self._lock:
+            for idx, key in enumerate(keys):
+                vector = self.local.get(key)
+                if vector is not None:
+                    results[idx] = vector.tolist()
+                    self.local_hits += 1
+                else:
+                    remote_indexes.append(idx)
+        if not remote_indexes:
+            return results
+        try:
+            values = self.redis_client.mget([self.CACHE_PREFIX + keys[idx] for idx in remote_indexes])
+        except redis.RedisError as e:
+            print(f"【EmbeddingCache】读取Redis缓存异常，{e}")
+            values = [None] * len(remote_indexes)
+        with self._lock:
+            for idx, value in zip(remote_indexes, values):
+                if value is None:
+                    self.misses += 1
+                    continue
+                vector = self.unpack(value)
+                results[idx] = vector.tolist()
+                self.local[keys[idx]] = vector
+                self.redis_hits += 1
+        return results
+
+    def set_many(self, mapping: typing.Dict[str, typing.List[float]]):
+        with self._lock:
+            for key, vector in mapping.items():
+                self.local[key] = np.asarray(vector, dtype=np.float32)
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key, vector in mapping.items():
+                pipe.setex(self.CACHE_PREFIX + key, self.expire, self.pack(vector))
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"【EmbeddingCache】写入Redis缓存异常，{e}")
+
+    def get_or_compute(
+        self,
+        model_id: str,
+        task_type: str,
+        dimensionality: int,
+        texts: typing.List[str],
+        compute: typing.Callable[[typing.List[str]], typing.List[typing.List[float]]],
+    ) -> typing.List[typing.List[float]]:
+        """
+        compute仅会收到去重后的未命中文本，返回空列表表示计算失败
+        """
+        if not self.enable:
+            return compute(texts)
+        keys = [self.make_key(model_id, task_type, dimensionality, text) for text in texts]
+        results = self.get_many(keys)
+        missing: typing.Dict[str, str] = {}
+        for key, text, vector in zip(keys, texts, results):
+            if vector is None:
+                missing.setdefault(key, text)
+        if missing:
+            values = compute(list(missing.values()))
+            if not values:
+                return []
+            computed = dict(zip(missing.keys(), values))
+            self.set_many(computed)
+            results = [vector if vector is not None else computed[key] for key, vector in zip(keys, results)]
+        return results
+
+    def stats(self):
+        return {
+            "local_size": len(self.local),
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+        }
+
+
+embedding_cache = EmbeddingCache(
+    redis_url=setting.REDIS_URL,
+    local_maxsize=getattr(setting, "EMBEDDING_CACHE_LOCAL_SIZE", 4096),
+    expire=getattr(setting, "EMBEDDING_CACHE_EXPIRE", 30 * 24 * 3600),
+    enable=getattr(setting, "EMBEDDING_CACHE_ENABLE", True),
+)
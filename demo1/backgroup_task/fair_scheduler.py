@@ -0,0 +1,279 @@
+import asyncio
+import contextlib
+import json
+import time
+import typing
+import uuid
+
+import redis
+from celery import Celery
+
+
+class FairScheduler:
+    """
+    大模型任务的多租户加权公平调度
+    1、每个公司(租户)一个Redis虚拟队列，submit只入队，按加权差额轮询(DRR)出队后才真正投递到Celery
+    2、全局同时运行的任务数不超过max_inflight，任务结束(task_postrun)时释放名额并继续出队
+    3、交互请求(websocket会话、/index/analytic/*)进入优先通道：存在进行中的交互请求时，批量任务最多只能占用
+       max_inflight - interactive_reserved个名额，为交互请求让出模型配额；优先通道只预留名额、不抢占，
+       登记前已投递的批量任务继续运行直至结束。交互请求结束时仅在有等待的批量任务时出队，异步路由中在后台执行，不延迟响应
+    4、Worker异常退出未释放的名额在slot_timeout秒后回收；队列中有等待的任务时每隔tick_interval秒投递一次tick任务，
+       回收超时名额并出队，避免没有新的提交或任务结束时等待的任务一直得不到投递
+    5、权重按最小权重归一化，每个租户每轮至少积累1个差额，权重小于1的租户也能按比例出队
+    6、submit及jd_tenant会访问Redis锁及数据库，异步路由中使用submit_async、jd_tenant_async
+    """
+    PREFIX = "FairScheduler:"
+    QUEUE_PREFIX = PREFIX + "Queue:"
+    RING = PREFIX + "Ring"
+    DEFICIT = PREFIX + "Deficit"
+    RUNNING = PREFIX + "Running"
+    INTERACTIVE = PREFIX + "Interactive"
+    JD_TENANT = PREFIX + "JdTenant"
+    LOCK = PREFIX + "Lock"
+    TICK_TIMER = PREFIX + "TickTimer"
+    DEFAULT_TENANT = "default"
+
+    def __init__(
+        self,
+        app: Celery,
+        redis_url: str,
+        max_inflight: int = 8,
+        interactive_reserved: int = 4,
+        weights: typing.Dict[str, float] = None,
+        slot_timeout: int = 2100,
+        tick_task_name: str = None,
+        tick_interval: int = 60,
+        enable: bool = True,
+    ):
+        self.app = app
+        self.enable = enable
+        self.max_inflight = max_inflight
+        self.interactive_reserved = min(interactive_reserved, max_inflight - 1)
+        self.weights = weights or {}
+        self.slot_timeout = slot_timeout
+        self.tick_task_name = tick_task_name
+        self.tick_interval = tick_interval
+        self.redis_client = redis.from_url(redis_url, decode_responses=True)
+        # 交互请求结束后在后台执行的出队任务，保留引用避免被回收
+        self._background_tasks = set()
+
+    def weight(self, tenant: str) -> float:
+        return float(self.weights.get(tenant, 1))
+
+    def quantum(self, tenant: str) -> float:
+        """每轮增加的差额，按最小权重归一化后不小于1"""
+        min_weight = min([1.0, *[float(i) for i in self.weights.values() if float(i) > 0]])
+        return max(self.weight(tenant), min_weight) / min_weight
+
+    def submit(self, tenant: typing.Optional[str], task, kwargs: dict = None):
+        """task为Celery任务对象，调度关闭或Redis异常时直接投递"""
+        kwargs = kwargs or {}
+        if not self.enable:
+            return task.apply_async(kwargs=kwargs)
+        tenant = str(tenant or self.DEFAULT_TENANT)
+        try:
+            pipe = self.redis_client.pipeline()
+            pipe.rpush(self.QUEUE_PREFIX + tenant, json.dumps({"task": task.name, "kwargs": kwargs}, default=str))
+            pipe.lrem(self.RING, 0, tenant)
+            pipe.rpush(self.RING, tenant)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"【FairScheduler】任务入队异常，直接投递，{e}")
+            return task.apply_async(kwargs=kwargs)
+        self.dispatch()
+
+    async def submit_async(self, tenant: typing.Optional[str], task, kwargs: dict = None):
+        return await asyncio.to_thread(self.submit, tenant, task, kwargs)
+
+    def _rotate(self):
+        tenant = self.redis_client.lpop(self.RING)
+        if tenant is not None:
+            self.redis_client.rpush(self.RING, tenant)
+
+    def _next_tenant(self) -> typing.Optional[str]:
+        ring_size = self.redis_client.llen(self.RING)
+        # 归一化后每次访问至少积累1个差额，每个租户最多访问两轮即可出队
+        for _ in range(ring_size * 2 + 1):
+            tenant = self.redis_client.lindex(self.RING, 0)
+            if tenant is None:
+                return None
+            if self.redis_client.llen(self.QUEUE_PREFIX + tenant) == 0:
+                self.redis_client.lpop(self.RING)
+                self.redis_client.hdel(self.DEFICIT, tenant)
+                continue
+            deficit = float(self.redis_client.hget(self.DEFICIT, tenant) or 0)
+            if deficit < 1:
+                deficit = self.redis_client.hincrbyfloat(self.DEFICIT, tenant, self.quantum(tenant))
+                if deficit < 1:
+                    self._rotate()
+                    continue
+            deficit = self.redis_client.hincrbyfloat(self.DEFICIT, tenant, -1)
+            if deficit < 1:
+                self._rotate()
+            return tenant
+        return None
+
+    def _reap(self):
+        now = time.time()
+        for task_id, value in self.redis_client.hgetall(self.RUNNING).items():
+            if now - json.loads(value)["ts"] > self.slot_timeout:
+                print(f"【FairScheduler】回收超时名额，TaskId={task_id}")
+                self.redis_client.hdel(self.RUNNING, task_id)
+
+    def capacity(self) -> int:
+        limit = self.max_inflight
+        if self.interactive_count() > 0:
+            limit -= self.interactive_reserved
+        running = self.redis_client.hlen(self.RUNNING)
+        if running >= limit:
+            self._reap()
+            running = self.redis_client.hlen(self.RUNNING)
+        return limit - running
+
+    def dispatch(self) -> int:
+        """在有空闲名额时按DRR顺序出队投递，返回本次投递的任务数"""
+        if not self.enable:
+            return 0
+        count = 0
+        try:
+            with self.redis_client.lock(self.LOCK, timeout=10, blocking_timeout=5):
+                for _ in range(max(0, self.capacity())):
+                    tenant = self._next_tenant()
+                    if tenant is None:
+                        break
+                    item = self.redis_client.lpop(self.QUEUE_PREFIX + tenant)
+                    if item is None:
+                        continue
+                    item = json.loads(item)
+                    task_id = uuid.uuid4().hex
+                    # 先占用名额再投递，避免任务在登记前就已执行完成
+                    self.redis_client.hset(
+                        self.RUNNING, task_id, json.dumps({"tenant": tenant, "task": item["task"], "ts": time.time()}))
+                    self.app.send_task(item["task"], kwargs=item["kwargs"], task_id=task_id)
+                    count += 1
+        except redis.exceptions.LockError as e:
+            print(f"【FairScheduler】获取调度锁失败，{e}")
+        except redis.RedisError as e:
+            print(f"【FairScheduler】调度异常，{e}")
+        self._schedule_tick()
+        return count
+
+    def _schedule_tick(self):
+        """队列中仍有等待的任务时投递一个延迟tick_interval秒的tick任务，同一时间最多一个"""
+        if not self.tick_task_name:
+            return
+        try:
+            if self.redis_client.llen(self.RING) and self.redis_client.set(
+                    self.TICK_TIMER, 1, nx=True, ex=self.tick_interval * 2 + 60):
+                self.app.send_task(self.tick_task_name, countdown=self.tick_interval)
+        except redis.RedisError as e:
+            print(f"【FairScheduler】投递tick任务异常，{e}")
+
+    def tick(self) -> int:
+        """定时回收超时名额并出队"""
+        if not self.enable:
+            return 0
+        try:
+            self.redis_client.delete(self.TICK_TIMER)
+            self._reap()
+        except redis.RedisError as e:
+            print(f"【FairScheduler】回收名额异常，{e}")
+        return self.dispatch()
+
+    def release(self, task_id: str):
+        """任务结束时调用，释放名额并继续出队"""
+        if not self.enable or not task_id:
+            return
+        try:
+            if self.redis_client.hdel(self.RUNNING, task_id):
+                self.dispatch()
+        except redis.RedisError as e:
+            print(f"【FairScheduler】释放名额异常，{e}")
+
+    def interactive_count(self) -> int:
+        return self.redis_client.zcount(self.INTERACTIVE, time.time(), "+inf")
+
+    def _interactive_enter(self, ttl: int) -> str:
+        token = uuid.uuid4().hex
+        try:
+            self.redis_client.zremrangebyscore(self.INTERACTIVE, "-inf", time.time())
+            self.redis_client.zadd(self.INTERACTIVE, {token: time.time() + ttl})
+        except redis.RedisError as e:
+            print(f"【FairScheduler】登记交互请求异常，{e}")
+        return token
+
+    def _interactive_exit(self, token: str) -> bool:
+        """注销交互请求，返回是否有等待出队的批量任务"""
+        try:
+            pipe = self.redis_client.pipeline()
+            pipe.zrem(self.INTERACTIVE, token)
+            pipe.llen(self.RING)
+            return pipe.execute()[1] > 0
+        except redis.RedisError as e:
+            print(f"【FairScheduler】注销交互请求异常，{e}")
+            return False
+
+    @contextlib.contextmanager
+    def interactive(self, ttl: int = 120):
+        if not self.enable:
+            yield
+            return
+        token = self._interactive_enter(ttl)
+        try:
+            yield
+        finally:
+            # 交互请求结束后预留名额归还给批量任务
+            if self._interactive_exit(token):
+                self.dispatch()
+
+    @contextlib.asynccontextmanager
+    async def interactive_async(self, ttl: int = 120):
+        if not self.enable:
+            yield
+            return
+        token = await asyncio.to_thread(self._interactive_enter, ttl)
+        try:
+            yield
+        finally:
+            if await asyncio.to_thread(self._interactive_exit, token):
+                # 出队需要等待调度锁，在后台执行，不阻塞交互请求返回
+                task = asyncio.create_task(asyncio.to_thread(self.dispatch))
+                self._background_tasks.add(task)
+                task.add_done_callback(self._background_tasks.discard)
+
+    async def jd_tenant_async(self, jd_id, session) -> str:
+        return await asyncio.to_thread(self.jd_tenant, jd_id, session)
+
+    def jd_tenant(self, jd_id, session) -> str:
+        """根据岗位ID获取所属公司，结果缓存在Redis中"""
+        jd_id = str(jd_id)
+        try:
+            tenant = self.redis_client.hget(self.JD_TENANT, jd_id)
+            if tenant:
+                return tenant
+        except redis.RedisError:
+            pass
+        from model import JobDataModel
+        company_id = session.query(JobDataModel.company_id).filter(JobDataModel.id == jd_id).scalar()
+        tenant = str(company_id or self.DEFAULT_TENANT)
+        try:
+            self.redis_client.hset(self.JD_TENANT, jd_id, tenant)
+        except redis.RedisError:
+            pass
+        return tenant
+
+    def stats(self):
+        tenants = {}
+        for key in self.redis_client.scan_iter(self.QUEUE_PREFIX + "*"):
+            tenant = key[len(self.QUEUE_PREFIX):]
+            tenants[tenant] = {"queued": self.redis_client.llen(key), "running": 0, "weight": self.weight(tenant)}
+        for value in self.redis_client.hvals(self.RUNNING):
+            tenant = json.loads(value)["tenant"]
+            tenants.setdefault(tenant, {"queued": 0, "running": 0, "weight": self.weight(tenant)})
+            tenants[tenant]["running"] += 1
+        return {
+            "enable": self.enable,
+            "max_inflight": self.max_inflight,
+            "interactive": self.interactive_count(),
+            "tenants": tenants,
+        }
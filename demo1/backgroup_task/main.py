@@ -1,22 +1,91 @@
 import typing
 
 from celery import Celery
-import requests
+from celery.signals import task_postrun, worker_process_init, worker_process_shutdown
 
 from settings import setting
+from tools.jd_vector_cache import jd_vector_cache
 from tools.pdf_extract import process_resume_pdf
+from .abstract_batcher import AbstractCvBatcher
 from .analytic import Analytic
 from .analytic_base import AnalyticSessionChatManager, AnalyticSessionChatException
 from .analytic_session_chat import AnalyticChat
+from .batch_executor import BatchExecutor, RateLimiter
+from .callback_client import CeleryCallbackClient
+from .celery_config import build_celery_config
+from .context_cache import context_cache
+from .fair_scheduler import FairScheduler
+from .repository import create_task_repository
+from .result_channel import TaskResultChannel
 
 ai_analytic = Analytic()
-ai_analytic_chat_manager = AnalyticSessionChatManager()
+embedding_batch_size = getattr(setting, "EMBEDDING_BATCH_SIZE", 150)
+embedding_executor = BatchExecutor(
+    max_workers=getattr(setting, "EMBEDDING_BATCH_CONCURRENCY", 4),
+    max_retries=getattr(setting, "EMBEDDING_BATCH_RETRIES", 2),
+    limiter=RateLimiter(rpm=getattr(setting, "EMBEDDING_RPM", 0)),
+    # embedding_texts异常时返回空列表，分片非空时空结果也视为失败
+    is_failed=lambda r: not r,
+)
+# Context-Mode会话保存在Redis中，websocket的每条消息可以由任意Worker进程处理
+ai_analytic_chat_manager = AnalyticSessionChatManager(
+    setting.REDIS_URL,
+    factory=AnalyticChat.from_state,
+    ttl=getattr(setting, "CHAT_SESSION_TTL", 1800),
+    max_sessions=getattr(setting, "CHAT_SESSION_MAX_SESSIONS", 1000),
+    max_history_turns=getattr(setting, "CHAT_SESSION_MAX_HISTORY_TURNS", 5),
+    max_history_bytes=getattr(setting, "CHAT_SESSION_MAX_HISTORY_BYTES", 1024 * 1024),
+    local_size=getattr(setting, "CHAT_SESSION_LOCAL_SIZE", 64),
+)
 url = "http://localhost:8080/api/v1"
 
 app = Celery('tasks', broker=setting.REDIS_URL, backend=setting.REDIS_URL)
+# 按任务类型路由到interactive/embedding/llm-bulk/media队列，各队列由独立Worker消费
+app.conf.update(**build_celery_config())
+# 大模型批量任务经过多租户公平调度后再投递到Celery
+fair_scheduler = FairScheduler(
+    app,
+    redis_url=setting.REDIS_URL,
+    max_inflight=getattr(setting, "FAIR_SCHEDULER_MAX_INFLIGHT", 8),
+    interactive_reserved=getattr(setting, "FAIR_SCHEDULER_INTERACTIVE_RESERVED", 4),
+    weights=getattr(setting, "FAIR_SCHEDULER_WEIGHTS", None),
+    tick_task_name="backgroup_task.main.fair_scheduler_tick",
+    tick_interval=getattr(setting, "FAIR_SCHEDULER_TICK_INTERVAL", 60),
+    enable=getattr(setting, "FAIR_SCHEDULER_ENABLE", True),
+)
+# 上传接口提交的单份简历信息提取请求在Redis中聚合为批次后再投递
+abstract_cv_batcher = AbstractCvBatcher(
+    fair_scheduler,
+    redis_url=setting.REDIS_URL,
+    task_name="backgroup_task.main.abstract_cv",
+    flush_task_name="backgroup_task.main.flush_abstract_cv",
+    max_size=getattr(setting, "ABSTRACT_CV_BATCH_SIZE", 20),
+    max_wait=getattr(setting, "ABSTRACT_CV_BATCH_WAIT", 30),
+    max_retries=getattr(setting, "ABSTRACT_CV_MAX_RETRIES", 1),
+    enable=getattr(setting, "ABSTRACT_CV_BATCH_ENABLE", True),
+)
+# websocket等待的交互任务完成时主动推送结果，API服务不再轮询result backend
+task_result_channel = TaskResultChannel(
+    redis_url=setting.REDIS_URL,
+    tasks=["backgroup_task.main.text_embedding", "backgroup_task.main.analyze_chat_cvs"],
+    expire=getattr(setting, "TASK_RESULT_CHANNEL_EXPIRE", 300),
+    enable=getattr(setting, "TASK_RESULT_CHANNEL_ENABLE", True),
+)
 headers = {
     "x-api-key": setting.X_API_KEY,
 }
+callback_client = CeleryCallbackClient(
+    url,
+    headers=headers,
+    pool_maxsize=getattr(setting, "CELERY_CALLBACK_POOL_MAXSIZE", 10),
+    timeout=getattr(setting, "CELERY_CALLBACK_TIMEOUT", 60),
+    batch_enable=getattr(setting, "CELERY_CALLBACK_BATCH_ENABLE", False),
+    batch_window=getattr(setting, "CELERY_CALLBACK_BATCH_WINDOW", 0.05),
+    batch_max_size=getattr(setting, "CELERY_CALLBACK_BATCH_MAX_SIZE", 50),
+)
+# callback: 结果回调API服务写库；direct: Worker内直接写库
+task_repository = create_task_repository(
+    getattr(setting, "CELERY_TASK_PERSISTENCE_MODE", "callback"), callback_client)
 
 
 celery_task_event_literal = typing.Literal[
@@ -37,12 +106,42 @@ celery_task_event_literal = typing.Literal[
 
 
 def celery_task_callback(event: celery_task_event_literal, **payload):
-    _url = url + "/index/bg/celery/callback?event=" + event
-    res = requests.post(_url, headers=headers, json=payload)
-    print(f"[Debug]: Event({event}) celery callback response code: {res.status_code}, text: {res.text}")
-    if res.status_code == 200 and res.json()["code"] == 200:
-        return res.json()["data"]
-    return None
+    return task_repository.call(event, **payload)
+
+
+def celery_task_emit(event: celery_task_event_literal, **payload):
+    """不需要回调结果的事件，batch模式下会与同一时间窗口内的其他事件合并发送"""
+    task_repository.emit(event, **payload)
+
+
+@worker_process_init.connect
+def init_task_repository(**kwargs):
+    task_repository.process_init()
+
+
+@worker_process_init.connect
+def warmup_model_registry(**kwargs):
+    if getattr(setting, "MODEL_REGISTRY_WARMUP", True):
+        try:
+            ai_analytic.warmup()
+        except Exception as e:
+            print(f"【ModelRegistry】预热模型句柄失败，{e}")
+
+
+@worker_process_shutdown.connect
+def flush_celery_task_callback(**kwargs):
+    task_repository.flush()
+
+
+@task_postrun.connect
+def release_fair_scheduler_slot(task_id=None, **kwargs):
+    fair_scheduler.release(task_id)
+
+
+@task_postrun.connect
+def publish_task_result(task_id=None, task=None, retval=None, state=None, **kwargs):
+    if task is not None and task_result_channel.accepts(task.name):
+        task_result_channel.publish_result(task_id, state, retval)
 
 
 @app.task
@@ -66,6 +165,12 @@ def analytic_jd(jd_id):
                 print("创建JD分析结果成功")
 
 
+@app.task
+def drop_jd_context_cache(jd_id):
+    count = context_cache.drop(str(jd_id))
+    print(f"【ContextCache】JobId={jd_id}，删除上下文缓存数量：{count}")
+
+
 @app.task
 def analytic_cv(task_id, jd_id, **kwargs):
     # t1 = time.time()
@@ -84,42 +189,39 @@ def analytic_cv(task_id, jd_id, **kwargs):
         })
 
     print(f"获取【TaskId={task_id}，JobId={jd_id}，quota={kwargs.get('quota')}】获取未分析简历成功，数量：{len(cvs)}")
-    ret = celery_task_callback("cv_analytic_status_update", cvs=v)
-    print(f"【TaskId={task_id}，JobId={jd_id}】批量更新简历分析状态{'成功' if ret else '失败'}")
-    result = ai_analytic.analytic_cv(cvs=cvs, job_info=data["job_info"])
-    if result:
-        payload = {"analyzes": result, "task_id": task_id}
+    celery_task_emit("cv_analytic_status_update", cvs=v)
+    print(f"【TaskId={task_id}，JobId={jd_id}】提交批量更新简历分析状态")
+
+    def save_analyzes(analyzes):
+        # 每个子批次分析完成后立即保存，无需等待全部简历分析完成
+        payload = {"analyzes": analyzes, "task_id": task_id}
         if celery_task_callback("cv_analytic_attach_create", **payload):
-            print(f"【TaskId={task_id}，JobId={jd_id}】数据库保存分析记录成功")
+            print(f"【TaskId={task_id}，JobId={jd_id}】数据库保存分析记录成功，数量：{len(analyzes)}")
         else:
-            print(f"【TaskId={task_id}，JobId={jd_id}】数据库保存分析记录失败")
+            print(f"【TaskId={task_id}，JobId={jd_id}】数据库保存分析记录失败，数量：{len(analyzes)}")
+
+    result = ai_analytic.analytic_cv(cvs=cvs, job_info=data["job_info"], on_result=save_analyzes, scope=str(jd_id))
+    print(f"【TaskId={task_id}，JobId={jd_id}】简历分析完成，数量：{len(result)}/{len(cvs)}")
 
 
 def cv_texts_embedding(cv_id, texts):
-    texts_len = len(texts)
-    d, v = divmod(texts_len, 150)
-    if v > 0:
-        d += 1
+    batches = embedding_executor.split(texts, embedding_batch_size)
+    results = embedding_executor.map(ai_analytic.embedding_texts, batches)
+    failed = [idx for idx, values in enumerate(results) if values is None]
+    if failed:
+        print(f"【简历Embedding】OriginCV[cv_id={cv_id}]分片{failed}重试后仍失败，共{len(batches)}个分片")
+        return False, []
 
     embeddings = []
-    embedding_result = True
-    for i in range(d):
-        tmp_texts = texts[i * 150:(i + 1) * 150]
-        values = ai_analytic.embedding_texts(tmp_texts)
-        if values:
-            for idx, text in enumerate(tmp_texts):
-                embedding_item = {
-                    "cv_id": cv_id,
-                    "sentence": text,
-                    "embedding": values[idx]
-                }
-                embeddings.append(embedding_item)
-        else:
-            embedding_result = False
-            break
-    if embedding_result:
-        return True, embeddings
-    return False, []
+    for tmp_texts, values in zip(batches, results):
+        for idx, text in enumerate(tmp_texts):
+            embedding_item = {
+                "cv_id": cv_id,
+                "sentence": text,
+                "embedding": values[idx]
+            }
+            embeddings.append(embedding_item)
+    return True, embeddings
 
 
 @app.task
@@ -132,6 +234,7 @@ def sentence_embedding(cv_id, texts):
         ret = celery_task_callback("cv_sentence_embeddings_create", embeddings=embeddings)
         if ret:
             print(f"生成简历SentenceEmbedding, OriginCV[cv_id={cv_id}]记录成功，保存记录结果：{ret}")
+            jd_vector_cache.notify([cv_id])
         else:
             print(f"生成简历SentenceEmbedding, OriginCV[cv_id={cv_id}]记录失败，{ret}")
 
@@ -145,9 +248,38 @@ def sentence_embedding(cv_id, texts):
 
 
 @app.task
-def analyze_chat_cvs(msg: str, cvs, job_info: str):
-    analyze_chat = AnalyticChat(job_info)
-    ret = analyze_chat.analyze(msg, cvs)
+def analyze_chat_cvs(
+    msg: str,
+    cvs,
+    job_info: str,
+    jd_id: str = None,
+    session_id: str = None,
+    owner: str = None,
+    mode: str = "Pan-Mode",
+    stream: bool = False,
+):
+    """stream=True时每解析出一份匹配的简历立即通过结果推送通道发送给websocket"""
+    on_record = None
+    task_id = analyze_chat_cvs.request.id
+    if stream and task_id:
+        on_record = lambda record: task_result_channel.publish(task_id, {"type": "record", "data": record})
+    analyze_chat = None
+    # Context-Mode在上一轮的对话历史上继续筛选
+    stateful = mode == "Context-Mode" and session_id
+    if stateful:
+        try:
+            analyze_chat = ai_analytic_chat_manager.get_session(session_id, owner)
+        except Exception as e:
+            print(f"【SessionChat】读取会话{session_id}异常，重新创建会话，{e}")
+    if analyze_chat is None:
+        analyze_chat = AnalyticChat(job_info, scope=jd_id)
+    analyze_chat.filter_mode = mode
+    ret = analyze_chat.analyze(msg, cvs, on_record)
+    if stateful and ret.is_ok:
+        try:
+            ai_analytic_chat_manager.register_session(session_id, analyze_chat, owner)
+        except Exception as e:
+            print(f"【SessionChat】保存会话{session_id}异常，{e}")
     return ret.serialize()
 
 
@@ -156,28 +288,50 @@ def text_embedding(text):
     return ai_analytic.embedding_text(text)
 
 
+def keywords_embedding(results) -> typing.Dict[str, typing.List[float]]:
+    """整批简历的关键字去重后合并计算Embedding，返回关键字到向量的映射，计算失败的关键字不在结果中"""
+    keywords = list(dict.fromkeys(text for item in results for text in item["keywords"]))
+    if not keywords:
+        return {}
+    batches = embedding_executor.split(keywords, embedding_batch_size)
+    print(f"【Abstract-CV】开始计算Keywords-Embedding，简历数量：{len(results)}，去重后关键字数量：{len(keywords)}，"
+          f"分片数量：{len(batches)}")
+    values = embedding_executor.map(
+        lambda batch: ai_analytic.embedding_texts([f"tag: {text}" for text in batch]), batches)
+    vectors = {}
+    for batch, embeddings in zip(batches, values):
+        if embeddings:
+            vectors.update(zip(batch, embeddings))
+    print(f"【Abstract-CV】计算Keywords-Embedding完成，成功数量：{len(vectors)}/{len(keywords)}")
+    return vectors
+
+
 @app.task
-def abstract_cv(cvs):
+def abstract_cv(cvs, tenant=None, retry=0):
     if not isinstance(cvs, list):
         cvs = [cvs]
     print(f"【Abstract-CV】开始提取简历信息及关键字，本次简历批次数量：{len(cvs)}")
     results = ai_analytic.cv_abstract(cvs)
+    returned = {str(item.get("key")) for item in results or []}
+    missing = [item for item in cvs if str(item["cv_id"]) not in returned]
+    if missing:
+        print(f"【Abstract-CV】以下简历未返回提取结果：{[str(item['cv_id']) for item in missing]}")
+        if abstract_cv_batcher.resubmit(tenant, missing, retry):
+            print(f"【Abstract-CV】重新投递未返回结果的简历，第{retry + 1}次重试")
     _results = []
     if results:
-        print(f"【Abstract-CV】提取简历信息及关键字成功，数量：{len(cvs)}")
+        print(f"【Abstract-CV】提取简历信息及关键字成功，数量：{len(results)}/{len(cvs)}")
+        keyword_vectors = keywords_embedding(results)
         for item in results:
             keywords_embedding_list = []
-            print(f"【Abstract-CV】开始计算Keywords-Embedding, keywords={item['keywords']}")
-            keywords = [f"tag: {text}" for text in item["keywords"]]
-            embeddings = ai_analytic.embedding_texts(keywords)
-            if embeddings:
-                for idx, text in enumerate(item["keywords"]):
+            # 同一份简历的关键字全部计算成功才保存
+            if all(text in keyword_vectors for text in item["keywords"]):
+                for text in item["keywords"]:
                     embedding_item = {
                         "keyword": text,
-                        "embedding": embeddings[idx]
+                        "embedding": keyword_vectors[text]
                     }
                     keywords_embedding_list.append(embedding_item)
-                print(f"【Abstract-CV】计算Keywords-Embedding, keywords={item['keywords']}成功")
             else:
                 print(f"【Abstract-CV】计算Keywords-Embedding, keywords={item['keywords']}失败")
             _results.append({
@@ -192,17 +346,29 @@ def abstract_cv(cvs):
             print(f"【Abstract-CV】提取简历信息及关键字数据库保存分析记录失败")
 
 
+@app.task
+def flush_abstract_cv(tenant):
+    abstract_cv_batcher.flush(tenant)
+
+
+@app.task
+def fair_scheduler_tick():
+    count = fair_scheduler.tick()
+    if count:
+        print(f"【FairScheduler】定时出队，投递任务数量：{count}")
+
+
 @app.task
 def cvs_search_task_via_vector(task_id):
     try:
         payload = {"search_task_id": task_id, "status": "Starting", "reason": "Starting"}
-        celery_task_callback("search_task_status_update", **payload)
+        celery_task_emit("search_task_status_update", **payload)
         payload = {"search_task_id": task_id}
         task = celery_task_callback("search_task_detail_get", **payload)
         if not task:
             print(f"【Search-Vector-CV】获取搜索任务详情失败")
             payload = {"search_task_id": task_id, "status": "Failed", "reason": "Server error"}
-            celery_task_callback("search_task_status_update", **payload)
+            celery_task_emit("search_task_status_update", **payload)
             return
         keyword = task["keyword"]
         jd_id = task["jd_id"]
@@ -213,22 +379,22 @@ def cvs_search_task_via_vector(task_id):
         if not embedding:
             print(f"【Search-Vector-CV】Embedding计算失败")
             payload = {"search_task_id": task_id, "status": "Failed", "reason": "Server error"}
-            celery_task_callback("search_task_status_update", **payload)
+            celery_task_emit("search_task_status_update", **payload)
             return
         payload = {"search_task_id": task_id, "jd_id": jd_id, "limit": limit, "zone": zone, "embedding": embedding}
         ret = celery_task_callback("search_task_vector_cvs_retrieval", **payload)
         if ret:
             print(f"【Search-Vector-CV】检索向量英才建立数据库成功，{ret}")
             payload = {"search_task_id": task_id, "status": "Completed", "reason": "search task completed"}
-            celery_task_callback("search_task_status_update", **payload)
+            celery_task_emit("search_task_status_update", **payload)
         else:
             print(f"【Search-Vector-CV】检索向量英才建立数据库失败")
             payload = {"search_task_id": task_id, "status": "Failed", "reason": "Server error"}
-            celery_task_callback("search_task_status_update", **payload)
+            celery_task_emit("search_task_status_update", **payload)
     except Exception as e:
         print(f"【Search-Vector-CV】检索向量英才建立数据库异常, {e}")
         payload = {"search_task_id": task_id, "status": "Failed", "reason": "Celery task error"}
-        celery_task_callback("search_task_status_update", **payload)
+        celery_task_emit("search_task_status_update", **payload)
 
 
 @app.task
@@ -243,6 +409,7 @@ def split_pdf_chunks_and_embedding(cv_id, chunks):
             ret = celery_task_callback("cv_sentence_embeddings_create", embeddings=embeddings)
             if ret:
                 print(f"【简历Embedding】, OriginCV[cv_id={cv_id}]记录成功，保存记录结果：{ret}")
+                jd_vector_cache.notify([cv_id])
             else:
                 print(f"【简历Embedding】, OriginCV[cv_id={cv_id}]记录失败，{ret}")
     else:
@@ -259,5 +426,5 @@ def interview_eva(task_id, template_save_path, content_save_path):
     else:
         payload = {"result": result, "status": 0, "task_id": task_id}
         print(f"【面试评价】AI面评失败")
-    celery_task_callback("interview_eva_result_update", **payload)
+    celery_task_emit("interview_eva_result_update", **payload)
 
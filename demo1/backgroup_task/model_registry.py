@@ -0,0 +1,103 @@
+import os
+import threading
+import typing
+from collections import OrderedDict
+
+import vertexai
+from vertexai.generative_models import GenerativeModel
+from vertexai.language_models import TextEmbedding, TextEmbeddingModel
+
+
+class ModelRegistry:
+    """
+    进程级Vertex模型句柄缓存
+    1、vertexai.init在每个进程内仅执行一次
+    2、GenerativeModel按(model_name, system_instruction)缓存，数量超过max_generative_models时按LRU淘汰
+    3、TextEmbeddingModel按model_id缓存
+    4、prefork模式下fork后的子进程会丢弃父进程的缓存句柄，重新创建
+    """
+
+    def __init__(self, max_generative_models: int = 256):
+        self.max_generative_models = max_generative_models
+        self.initialized = False
+        self.hits = 0
+        self.misses = 0
+        self._pid = os.getpid()
+        self._lock = threading.RLock()
+        self._generative_models: "OrderedDict[tuple, GenerativeModel]" = OrderedDict()
+        self._embedding_models: typing.Dict[str, TextEmbeddingModel] = {}
+
+    def _check_pid(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            self._generative_models = OrderedDict()
+            self._embedding_models = {}
+            self.hits = self.misses = 0
+
+    def init_vertexai(self, project: str, location: str, credentials_factory: typing.Callable):
+        with self._lock:
+            if self.initialized:
+                return
+            vertexai.init(project=project, location=location, credentials=credentials_factory())
+            self.initialized = True
+
+    def generative_model(self, model_name: str, system_instruction: typing.List[str] = None) -> GenerativeModel:
+        key = (model_name, tuple(system_instruction or ()))
+        with self._lock:
+            self._check_pid()
+            model = self._generative_models.get(key)
+            if model is not None:
+                self.hits += 1
+                self._generative_models.move_to_end(key)
+                return model
+            self.misses += 1
+            model = GenerativeModel(model_name, system_instruction=list(key[1]) or None)
+            self._generative_models[key] = model
+            while len(self._generative_models) > self.max_generative_models:
+                self._generative_models.popitem(last=False)
+            return model
+
+    def embedding_model(self, model_id: str) -> TextEmbeddingModel:
+        with self._lock:
+            self._check_pid()
+            model = self._embedding_models.get(model_id)
+            if model is not None:
+                self.hits += 1
+                return model
+            self.misses += 1
+            # from_pretrained会请求一次模型信息，仅在首次获取时调用
+            model = TextEmbeddingModel.from_pretrained(model_id)
+            self._embedding_models[model_id] = model
+            return model
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "generative_models": len(self._generative_models),
+                "embedding_models": list(self._embedding_models.keys()),
+            }
+
+
+def generate_content_with_timeout(model: GenerativeModel, contents, timeout: float, **kwargs):
+    """
+    带请求超时的非流式generate_content，超时后gRPC取消请求并抛出DeadlineExceeded
+    GenerativeModel.generate_content不支持timeout参数，这里复用SDK的请求构造及响应解析，只替换底层客户端调用；
+    依赖SDK内部方法(vertexai==1.71.1)，升级SDK时需确认
+    """
+    request = model._prepare_request(contents=contents, **kwargs)
+    response = model._prediction_client.generate_content(request=request, timeout=timeout)
+    return model._parse_response(response)
+
+
+def get_embeddings_with_timeout(model: TextEmbeddingModel, texts, timeout: float, **kwargs):
+    """带请求超时的get_embeddings，说明同generate_content_with_timeout；响应解析方法只在TextEmbedding上定义"""
+    request = model._prepare_text_embedding_request(texts=texts, **kwargs)
+    response = model._endpoint.predict(instances=request.instances, parameters=request.parameters, timeout=timeout)
+    return [TextEmbedding._parse_text_embedding_response(response, idx) for idx, _ in enumerate(response.predictions)]
+
+
+model_registry = ModelRegistry()
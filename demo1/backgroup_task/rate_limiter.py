@@ -0,0 +1,240 @@
+import asyncio
+import contextlib
+import os
+import threading
+import time
+import typing
+
+import redis
+from google.api_core import exceptions as google_exceptions
+
+from backgroup_task.call_policy import current_call
+from settings import setting
+
+# 令牌桶状态保存在Redis中，所有Worker共享同一个桶；返回需要等待的秒数，0表示已获取令牌
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 60)
+return tostring(wait)
+"""
+
+
+class RedisTokenBucket:
+    """集群共享的令牌桶，rpm为每分钟请求数，Redis异常时放行，不影响业务调用"""
+
+    def __init__(self, redis_client: redis.Redis, key: str, rpm: int, burst: int = None):
+        self.redis_client = redis_client
+        self.key = key
+        self.rate = rpm / 60
+        self.capacity = burst or max(1, rpm // 60)
+        self._script = redis_client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def try_acquire(self, tokens: int = 1) -> float:
+        try:
+            return float(self._script(keys=[self.key], args=[self.rate, self.capacity, tokens]))
+        except redis.RedisError as e:
+            print(f"【RateLimiter】访问Redis令牌桶异常，本次放行，{e}")
+            return 0
+
+    def acquire(self, tokens: int = 1):
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait <= 0:
+                return
+            time.sleep(min(wait, 1))
+
+    async def acquire_async(self, tokens: int = 1):
+        while True:
+            wait = await asyncio.to_thread(self.try_acquire, tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(min(wait, 1))
+
+
+class AdaptiveConcurrency:
+    """
+    AIMD自适应并发控制(进程内)
+    1、连续成功的请求数达到当前并发上限时，并发上限+1(加性增)
+    2、出现限流错误时，并发上限乘以decrease_ratio(乘性减)，cooldown秒内只减一次，避免同一波429把并发降到最低
+    """
+
+    def __init__(
+        self,
+        initial: int = 4,
+        minimum: int = 1,
+        maximum: int = 16,
+        decrease_ratio: float = 0.5,
+        cooldown: float = 1.0,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_ratio = decrease_ratio
+        self.cooldown = cooldown
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.inflight = 0
+        self.successes = 0
+        self.throttles = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self.inflight >= int(self.limit):
+                return False
+            self.inflight += 1
+            return True
+
+    def acquire(self):
+        with self._cond:
+            while self.inflight >= int(self.limit):
+                self._cond.wait()
+            self.inflight += 1
+
+    async def acquire_async(self):
+        while not self.try_acquire():
+            await asyncio.sleep(0.05)
+
+    def release(self, throttled: bool = False):
+        with self._cond:
+            self.inflight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.throttles += 1
+                self.successes = 0
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease_ratio)
+                    self._last_decrease = now
+            else:
+                self.successes += 1
+                if self.successes >= int(self.limit):
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self.successes = 0
+            self._cond.notify_all()
+
+    def stats(self):
+        return {"limit": int(self.limit), "inflight": self.inflight, "throttles": self.throttles}
+
+
+class VertexRateLimiter:
+    """
+    Vertex调用限流，按模型名称区分
+    1、Redis令牌桶限制所有Worker合计的请求速率(rpm为0时不限制)
+    2、进程内AIMD控制并发数，遇到429/ResourceExhausted时退避，之后逐步探测回升
+    所有Vertex调用都应包在limit/limit_async中，流式调用需要在上下文内消费完整个响应
+    调用策略放弃的调用(对冲失败)立即归还并发名额，不等后台线程中的请求结束
+    """
+    BUCKET_PREFIX = "Vertex:RateLimit:"
+    THROTTLE_EXCEPTIONS = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)
+    DEFAULT_LIMIT = {"rpm": 0, "burst": None, "initial_concurrency": 4, "max_concurrency": 16}
+
+    def __init__(self, redis_url: str, limits: typing.Dict[str, dict] = None, enable: bool = True):
+        self.enable = enable
+        self.limits = limits or {}
+        self.redis_client = redis.from_url(redis_url)
+        self._pid = None
+        self._controllers: typing.Dict[str, typing.Tuple[typing.Optional[RedisTokenBucket], AdaptiveConcurrency]] = {}
+        self._lock = threading.Lock()
+
+    def _controller(self, model_name: str):
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork后的子进程不能沿用父进程的Condition及并发计数
+                self._pid = os.getpid()
+                self._controllers = {}
+            controller = self._controllers.get(model_name)
+            if controller is None:
+                config = {**self.DEFAULT_LIMIT, **self.limits.get(model_name, {})}
+                bucket = None
+                if config["rpm"] > 0:
+                    bucket = RedisTokenBucket(
+                        self.redis_client, self.BUCKET_PREFIX + model_name, config["rpm"], config["burst"])
+                concurrency = AdaptiveConcurrency(
+                    initial=config["initial_concurrency"], maximum=config["max_concurrency"])
+                controller = self._controllers[model_name] = (bucket, concurrency)
+            return controller
+
+    @classmethod
+    def is_throttled(cls, e: BaseException) -> bool:
+        return isinstance(e, cls.THROTTLE_EXCEPTIONS)
+
+    @contextlib.contextmanager
+    def limit(self, model_name: str):
+        if not self.enable:
+            yield
+            return
+        bucket, concurrency = self._controller(model_name)
+        if bucket:
+            bucket.acquire()
+        concurrency.acquire()
+        lock = threading.Lock()
+        released = []
+
+        def release(throttled: bool = False):
+            # 放弃回调与正常结束都会调用，只释放一次
+            with lock:
+                if released:
+                    return
+                released.append(True)
+            concurrency.release(throttled)
+
+        handle = current_call.get()
+        if handle is not None:
+            handle.on_abandon(release)
+        throttled = False
+        try:
+            yield
+        except Exception as e:
+            throttled = self.is_throttled(e)
+            raise
+        finally:
+            if handle is not None:
+                handle.discard(release)
+            release(throttled)
+
+    @contextlib.asynccontextmanager
+    async def limit_async(self, model_name: str):
+        if not self.enable:
+            yield
+            return
+        bucket, concurrency = self._controller(model_name)
+        if bucket:
+            await bucket.acquire_async()
+        await concurrency.acquire_async()
+        throttled = False
+        try:
+            yield
+        except Exception as e:
+            throttled = self.is_throttled(e)
+            raise
+        finally:
+            concurrency.release(throttled)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "enable": self.enable,
+                "models": {name: controller[1].stats() for name, controller in self._controllers.items()},
+            }
+
+
+vertex_rate_limiter = VertexRateLimiter(
+    redis_url=setting.REDIS_URL,
+    limits=getattr(setting, "VERTEX_RATE_LIMITS", None),
+    enable=getattr(setting, "VERTEX_RATE_LIMIT_ENABLE", True),
+)
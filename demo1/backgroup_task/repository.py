@@ -0,0 +1,94 @@
+import abc
+import asyncio
+import traceback
+import typing
+
+from .callback_client import CeleryCallbackClient, CeleryCallbackEvent
+
+persistence_mode_literal = typing.Literal["callback", "direct"]
+
+
+class CeleryTaskRepository(abc.ABC):
+    """
+    Celery任务的数据读写接口，事件名称及payload与`/index/bg/celery/callback`保持一致
+    call: 需要返回结果的读写
+    emit: 不关心返回结果的写入
+    """
+
+    @abc.abstractmethod
+    def call(self, event: str, **payload):
+        ...
+
+    def emit(self, event: str, **payload):
+        self.call(event, **payload)
+
+    def flush(self):
+        ...
+
+    def process_init(self):
+        """Worker子进程fork后的初始化"""
+        ...
+
+
+class CallbackTaskRepository(CeleryTaskRepository):
+    """通过HTTP回调API服务，由API服务写库"""
+
+    def __init__(self, client: CeleryCallbackClient):
+        self.client = client
+
+    def call(self, event: str, **payload):
+        return self.client.call(event, **payload)
+
+    def emit(self, event: str, **payload):
+        self.client.emit(event, **payload)
+
+    def flush(self):
+        self.client.flush()
+
+
+class DatabaseTaskRepository(CeleryTaskRepository):
+    """
+    Worker内直接通过SessionLocal和CeleryTaskService写库，省去结果的JSON编解码及HTTP回调
+    """
+
+    def __init__(self):
+        self._service = None
+
+    @property
+    def service(self):
+        if self._service is None:
+            from services.service_celery_task import CeleryTaskService
+            self._service = CeleryTaskService()
+        return self._service
+
+    def call(self, event: str, **payload):
+        from fastapi.encoders import jsonable_encoder
+        from model.database import SessionLocal
+        from model.vector_index import VECTOR_SEARCH_EVENTS, apply_vector_search_params
+
+        with SessionLocal() as session:
+            try:
+                if event in VECTOR_SEARCH_EVENTS:
+                    apply_vector_search_params(session)
+                ret = asyncio.run(self.service.dispatch(CeleryCallbackEvent(event, payload), session))
+            except Exception as e:
+                session.rollback()
+                print(traceback.format_exc())
+                print(f"[Debug]: Event({event}) celery direct persistence error: {e}")
+                return None
+            if ret.is_fail:
+                print(f"[Debug]: Event({event}) celery direct persistence failed: {ret.msg}")
+                return None
+            # 与HTTP回调返回的数据结构保持一致，需在Session关闭前完成序列化
+            return jsonable_encoder(ret.data)
+
+    def process_init(self):
+        from model.database import engine
+        # 父进程中创建的连接不能在fork后的子进程中复用
+        engine.dispose(close=False)
+
+
+def create_task_repository(mode: persistence_mode_literal, client: CeleryCallbackClient) -> CeleryTaskRepository:
+    if mode == "direct":
+        return DatabaseTaskRepository()
+    return CallbackTaskRepository(client)
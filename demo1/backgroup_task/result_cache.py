@@ -0,0 +1,165 @@
+import hashlib
+import json
+import threading
+import typing
+
+import redis
+from cachetools import TTLCache
+
+from settings import setting
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+class AnalyticResultCache:
+    """
+    大模型分析结果缓存，key为hash(prompt版本, 模型名称, 岗位信息hash, 简历内容hash)
+    1、prompt版本由prompt文本、生成参数及Redis中的代数计数组成，修改prompt后旧结果自动失效，
+       也可以调用invalidate(name)显式递增代数使某个prompt的全部结果失效
+    2、简历内容hash：boss简历使用meta_json，文本模式的PDF简历使用提取的文本，其余PDF简历使用GCS对象的md5，同一份简历重复投递时可以命中
+    3、命中时仅需一次Redis mget，未命中及Redis异常时按原流程请求模型
+    """
+    CACHE_PREFIX = "Analytic:Result:"
+    GENERATION_PREFIX = "Analytic:PromptGeneration:"
+    GCS_MD5_PREFIX = "Analytic:GcsMd5:"
+
+    def __init__(self, redis_url: str, expire: int = 30 * 24 * 3600, enable: bool = True, generation_ttl: int = 10):
+        self.enable = enable
+        self.expire = expire
+        self.redis_client = redis.from_url(redis_url)
+        # 代数计数在进程内缓存generation_ttl秒，避免每次查询多一次Redis往返
+        self._generations = TTLCache(maxsize=64, ttl=generation_ttl)
+        self._gcs_client = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def generation(self, name: str) -> int:
+        with self._lock:
+            value = self._generations.get(name)
+        if value is not None:
+            return value
+        try:
+            value = int(self.redis_client.get(self.GENERATION_PREFIX + name) or 0)
+        except redis.RedisError as e:
+            print(f"【ResultCache】读取prompt代数异常，{e}")
+            return 0
+        with self._lock:
+            self._generations[name] = value
+        return value
+
+    def invalidate(self, name: str) -> int:
+        """显式使某个prompt的全部缓存结果失效，返回新的代数"""
+        value = int(self.redis_client.incr(self.GENERATION_PREFIX + name))
+        with self._lock:
+            self._generations[name] = value
+        return value
+
+    def prompt_version(self, name: str, prompt: str, generation_config: dict = None) -> str:
+        raw = json.dumps([prompt, generation_config or {}], ensure_ascii=False, sort_keys=True, default=str)
+        return f"{name}:{self.generation(name)}:{text_hash(raw)[:16]}"
+
+    @staticmethod
+    def make_key(prompt_version: str, model_name: str, *parts: str) -> str:
+        raw = "\x1f".join([prompt_version, model_name, *parts])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @property
+    def gcs_client(self):
+        if self._gcs_client is None:
+            from tools.gcs import GCSClient
+            self._gcs_client = GCSClient()
+        return self._gcs_client
+
+    def gcs_md5_many(self, gcs_paths: typing.List[str]) -> typing.List[typing.Optional[str]]:
+        if not gcs_paths:
+            return []
+        try:
+            values = self.redis_client.mget([self.GCS_MD5_PREFIX + path for path in gcs_paths])
+        except redis.RedisError as e:
+            print(f"【ResultCache】读取GCS对象md5缓存异常，{e}")
+            values = [None] * len(gcs_paths)
+        results = []
+        for path, value in zip(gcs_paths, values):
+            results.append(value.decode() if value else self._fetch_gcs_md5(path))
+        return results
+
+    def _fetch_gcs_md5(self, gcs_path: str) -> typing.Optional[str]:
+        try:
+            blob = self.gcs_client.bucket.get_blob(self.gcs_client.get_filename_from_gcs_path(gcs_path))
+            if blob is None or not blob.md5_hash:
+                return None
+            # GCS对象上传后不再修改，md5可以长期缓存
+            self.redis_client.setex(self.GCS_MD5_PREFIX + gcs_path, self.expire, blob.md5_hash)
+            return blob.md5_hash
+        except Exception as e:
+            print(f"【ResultCache】获取GCS对象md5异常，{gcs_path}，{e}")
+            return None
+
+    def cv_content_hashes(self, cvs: typing.List[dict]) -> typing.List[typing.Optional[str]]:
+        results = [None] * len(cvs)
+        pdf_indexes = []
+        for idx, item in enumerate(cvs):
+            if item.get("content_hash"):
+                results[idx] = item["content_hash"]
+            elif item.get("text"):
+                # 文本模式与PDF模式的输入不同，结果分开缓存
+                results[idx] = "text:" + text_hash(item["text"])
+            elif item.get("origin") == "boss":
+                results[idx] = text_hash(item.get("meta_json"))
+            elif item.get("gcs_path"):
+                pdf_indexes.append(idx)
+        if self.enable and pdf_indexes:
+            md5_list = self.gcs_md5_many([cvs[idx]["gcs_path"] for idx in pdf_indexes])
+            for idx, md5 in zip(pdf_indexes, md5_list):
+                results[idx] = "md5:" + md5 if md5 else None
+        return results
+
+    def get_many(self, keys: typing.List[typing.Optional[str]]) -> typing.List[typing.Any]:
+        results = [None] * len(keys)
+        indexes = [idx for idx, key in enumerate(keys) if key]
+        if not self.enable or not indexes:
+            return results
+        try:
+            values = self.redis_client.mget([self.CACHE_PREFIX + keys[idx] for idx in indexes])
+        except redis.RedisError as e:
+            print(f"【ResultCache】读取Redis缓存异常，{e}")
+            values = [None] * len(indexes)
+        for idx, value in zip(indexes, values):
+            if value is not None:
+                results[idx] = json.loads(value)
+        hits = sum(1 for value in values if value is not None)
+        with self._lock:
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return results
+
+    def get(self, key: typing.Optional[str]) -> typing.Any:
+        return self.get_many([key])[0]
+
+    def set_many(self, mapping: typing.Dict[str, typing.Any]):
+        mapping = {key: value for key, value in mapping.items() if key}
+        if not self.enable or not mapping:
+            return
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key, value in mapping.items():
+                pipe.setex(self.CACHE_PREFIX + key, self.expire, json.dumps(value, ensure_ascii=False))
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"【ResultCache】写入Redis缓存异常，{e}")
+
+    def set(self, key: typing.Optional[str], value: typing.Any):
+        self.set_many({key: value})
+
+    def stats(self):
+        return {"enable": self.enable, "hits": self.hits, "misses": self.misses}
+
+
+result_cache = AnalyticResultCache(
+    redis_url=setting.REDIS_URL,
+    expire=getattr(setting, "ANALYTIC_RESULT_CACHE_EXPIRE", 30 * 24 * 3600),
+    enable=getattr(setting, "ANALYTIC_RESULT_CACHE_ENABLE", True),
+)
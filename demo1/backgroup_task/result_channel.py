@@ -0,0 +1,80 @@
+import asyncio
+import json
+import os
+import typing
+
+import redis
+import redis.asyncio as aioredis
+
+from settings import setting
+
+
+class TaskResultChannel:
+    """
+    Celery任务结果推送通道，替代轮询AsyncResult.ready()
+    1、任务结束时(task_postrun)Worker把结果RPUSH到该任务专属的Redis列表，列表expire秒后过期
+    2、API服务用BLPOP异步等待结果，任务完成后立即返回；使用列表而不是pub/sub，先于等待方写入的结果不会丢失
+    3、只有tasks中的任务会推送结果，其余任务仍通过result backend获取
+    """
+    KEY_PREFIX = "Celery:ResultChannel:"
+    SUCCESS = "SUCCESS"
+
+    def __init__(self, redis_url: str, tasks: typing.Iterable[str] = (), expire: int = 300, enable: bool = True):
+        self.redis_url = redis_url
+        self.tasks = set(tasks)
+        self.expire = expire
+        self.enable = enable
+        self.redis_client = redis.from_url(redis_url)
+        self._async_client = None
+        self._async_pid = None
+
+    @property
+    def async_client(self) -> aioredis.Redis:
+        if self._async_pid != os.getpid():
+            # 连接不能跨进程复用，uvicorn多Worker时每个进程单独创建
+            self._async_client = aioredis.from_url(self.redis_url)
+            self._async_pid = os.getpid()
+        return self._async_client
+
+    def key(self, task_id: str) -> str:
+        return self.KEY_PREFIX + task_id
+
+    def accepts(self, task_name: str) -> bool:
+        return self.enable and task_name in self.tasks
+
+    def publish(self, task_id: str, message: dict):
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.rpush(self.key(task_id), json.dumps(message, ensure_ascii=False, default=str))
+            pipe.expire(self.key(task_id), self.expire)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"【ResultChannel】推送任务结果异常，TaskId={task_id}，{e}")
+
+    def publish_result(self, task_id: str, state: str, result: typing.Any = None):
+        self.publish(task_id, {"type": "result", "state": state, "result": result if state == self.SUCCESS else None})
+
+    async def listen(self, task_id: str, timeout: float) -> typing.AsyncIterator[dict]:
+        """按顺序返回任务推送的消息，收到结果消息后结束；timeout为整个等待过程的超时时间，超时抛出asyncio.TimeoutError"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            # BLPOP超时参数最小精度为秒
+            item = await self.async_client.blpop([self.key(task_id)], timeout=max(1, int(remaining)))
+            if item is None:
+                continue
+            message = json.loads(item[1])
+            yield message
+            if message.get("type") == "result":
+                await self.async_client.delete(self.key(task_id))
+                return
+
+    async def wait(self, task_id: str, timeout: float) -> dict:
+        """等待任务结束，返回结果消息{"type": "result", "state": ..., "result": ...}"""
+        async for message in self.listen(task_id, timeout):
+            if message.get("type") == "result":
+                return message
+        raise asyncio.TimeoutError()
@@ -0,0 +1,84 @@
+import json
+import typing
+
+
+class JsonRecordStreamParser:
+    """
+    增量解析大模型流式输出中的JSON记录
+    1、每当一个包含record_key字段的JSON对象闭合时立即返回该记录，无需等待完整响应
+    2、忽略```json代码块标记及对象以外的说明文字
+    3、输出被截断时，已闭合的记录正常返回，未闭合的尾部直接丢弃
+    4、对象不是合法JSON时，尝试将单引号替换为双引号后再解析
+    """
+
+    def __init__(self, record_key: str = "key"):
+        self.record_key = record_key
+        self.text = ""
+        self.records = 0
+        self.failed = 0
+        self._buf = ""
+        self._pos = 0
+        self._stack: typing.List[int] = []
+        self._in_string = False
+        self._quote = ""
+        self._escape = False
+
+    @property
+    def truncated(self):
+        return len(self._stack) > 0
+
+    def feed(self, chunk: str) -> typing.List[dict]:
+        if not chunk:
+            return []
+        self.text += chunk
+        self._buf += chunk
+        records = []
+        buf = self._buf
+        for i in range(self._pos, len(buf)):
+            ch = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == self._quote:
+                    self._in_string = False
+                continue
+            if ch == '"' or (ch == "'" and self._stack):
+                self._in_string, self._quote = True, ch
+            elif ch == "{":
+                self._stack.append(i)
+            elif ch == "}" and self._stack:
+                start = self._stack.pop()
+                record = self._load(buf[start:i + 1])
+                if record is not None:
+                    records.append(record)
+        if self._stack:
+            # 仅保留最外层未闭合对象开始之后的内容
+            offset = self._stack[0]
+            self._buf = buf[offset:]
+            self._stack = [i - offset for i in self._stack]
+            self._pos = len(self._buf)
+        else:
+            self._buf, self._pos = "", 0
+        self.records += len(records)
+        return records
+
+    def _load(self, raw: str) -> typing.Optional[dict]:
+        if f'"{self.record_key}"' not in raw and f"'{self.record_key}'" not in raw:
+            return None
+        try:
+            obj = json.loads(raw)
+        except json.JSONDecodeError:
+            try:
+                obj = json.loads(raw.replace("'", '"'))
+            except json.JSONDecodeError:
+                self.failed += 1
+                return None
+        if isinstance(obj, dict) and self.record_key in obj:
+            return obj
+        return None
+
+    def parse(self, chunks: typing.Iterable[str]) -> typing.Iterator[dict]:
+        for chunk in chunks:
+            yield from self.feed(chunk)
@@ -0,0 +1,75 @@
+import typing
+
+import tiktoken
+
+TOKENIZER = tiktoken.get_encoding("cl100k_base")
+
+
+class TokenBudgetPlanner:
+    """
+    按token预算切分简历批次，保证每个子批次的输入及输出都不会超过模型限制
+    1、输入token：boss简历按meta_json、文本模式的PDF简历按提取的文本本地估算；其余PDF简历使用pdf_input_tokens估算；
+       传入count_tokens时使用模型count_tokens接口精确计算(每份简历一次请求)，失败时退回本地估算
+    2、输出token：每份简历的评估结果按output_tokens_per_cv估算
+    3、子批次的输出token总和不超过max_output_tokens * safety_ratio，输入token总和不超过max_input_tokens
+    """
+
+    def __init__(
+        self,
+        max_output_tokens: int = 8192,
+        max_input_tokens: int = 200000,
+        output_tokens_per_cv: int = 600,
+        pdf_input_tokens: int = 3000,
+        safety_ratio: float = 0.85,
+        token_ratio: float = 1.2,
+    ):
+        self.max_output_tokens = max_output_tokens
+        self.max_input_tokens = max_input_tokens
+        self.output_tokens_per_cv = output_tokens_per_cv
+        self.pdf_input_tokens = pdf_input_tokens
+        self.safety_ratio = safety_ratio
+        # cl100k_base与Gemini分词结果不同，本地估算时放大一定比例
+        self.token_ratio = token_ratio
+
+    def estimate_text_tokens(self, text: str) -> int:
+        return int(len(TOKENIZER.encode(text or "")) * self.token_ratio)
+
+    def estimate_input_tokens(self, item: dict, count_tokens: typing.Callable[[dict], int] = None) -> int:
+        if count_tokens:
+            try:
+                return count_tokens(item)
+            except Exception as e:
+                print(f"【TokenPlanner】count_tokens计算失败，使用本地估算，{e}")
+        if item.get("origin") == "boss":
+            return self.estimate_text_tokens(item.get("meta_json"))
+        if item.get("text"):
+            return self.estimate_text_tokens(item["text"])
+        return self.pdf_input_tokens
+
+    def plan(
+        self,
+        cvs: typing.List[dict],
+        prefix_tokens: int = 0,
+        count_tokens: typing.Callable[[dict], int] = None,
+    ) -> typing.List[typing.List[dict]]:
+        """
+        :param cvs: 待分析的简历
+        :param prefix_tokens: 每个子批次都会携带的公共前缀(如岗位信息)的token数
+        :param count_tokens: 计算单份简历输入token数的方法，为空时使用本地估算
+        :return: 子批次列表，保持输入顺序
+        """
+        output_budget = int(self.max_output_tokens * self.safety_ratio)
+        input_budget = self.max_input_tokens - prefix_tokens
+        max_cvs = max(1, output_budget // self.output_tokens_per_cv)
+
+        batches, current, current_input = [], [], 0
+        for item in cvs:
+            tokens = self.estimate_input_tokens(item, count_tokens)
+            if current and (len(current) >= max_cvs or current_input + tokens > input_budget):
+                batches.append(current)
+                current, current_input = [], 0
+            current.append(item)
+            current_input += tokens
+        if current:
+            batches.append(current)
+        return batches
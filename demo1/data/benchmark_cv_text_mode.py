@@ -0,0 +1,69 @@
+"""
+PDF简历发送方式对比：PDF文件Part vs 上传时提取的文本Part
+在项目根目录执行：python -m data.benchmark_cv_text_mode gs://bucket/a.pdf gs://bucket/b.pdf ... [--rounds 3]
+1、逐份简历调用count_tokens，对比输入token数
+2、使用简历分析(cv_model)prompt按两种方式分别请求rounds次，对比usage_metadata及耗时
+"""
+import argparse
+import statistics
+import time
+
+from backgroup_task.analytic import Analytic
+from backgroup_task.cv_text_store import cv_text_store
+
+
+def run_generate(analytic, job_info, cvs):
+    content = ["岗位信息\n{}".format(job_info)]
+    for item in cvs:
+        content.extend(analytic.build_cv_contents(item))
+    content.append("\n请输出评估结果")
+    started = time.monotonic()
+    response = analytic.generate_content(analytic.cv_model, content, stream=False)
+    latency = time.monotonic() - started
+    usage = response.usage_metadata
+    return latency, usage.prompt_token_count, usage.candidates_token_count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("gcs_paths", nargs="+")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--job-info", default="岗位名称：Python后端开发工程师\n岗位要求：3年以上Python开发经验，熟悉FastAPI、Celery、PostgreSQL")
+    args = parser.parse_args()
+
+    analytic = Analytic()
+    # 基准测试不受CV_PDF_TEXT_MODE开关影响
+    cv_text_store.enable = True
+    pdf_cvs = [{"cv_id": f"cv{idx}", "gcs_path": path, "origin": "upload"} for idx, path in enumerate(args.gcs_paths)]
+    texts = cv_text_store.get_many(args.gcs_paths)
+    text_cvs = [{**item, "text": text} for item, text in zip(pdf_cvs, texts) if text]
+    empty = [item["gcs_path"] for item, text in zip(pdf_cvs, texts) if not text]
+    if empty:
+        print(f"文本层为空，文本模式下仍发送PDF：{empty}")
+
+    print("\n==== count_tokens ====")
+    pdf_total, text_total = 0, 0
+    for pdf_item, text in zip(pdf_cvs, texts):
+        pdf_tokens = analytic.count_cv_tokens(pdf_item)
+        text_tokens = analytic.count_cv_tokens({**pdf_item, "text": text}) if text else pdf_tokens
+        pdf_total += pdf_tokens
+        text_total += text_tokens
+        print(f"{pdf_item['gcs_path']}: pdf={pdf_tokens}, text={text_tokens}, 文本字符数={len(text or '')}")
+    print(f"合计: pdf={pdf_total}, text={text_total}, 节省{(1 - text_total / max(pdf_total, 1)) * 100:.1f}%")
+
+    print(f"\n==== generate_content x {args.rounds} ====")
+    text_mode_cvs = [{**item, "text": text} if text else item for item, text in zip(pdf_cvs, texts)]
+    for name, cvs in (("pdf", pdf_cvs), ("text", text_mode_cvs)):
+        latencies, prompt_tokens, output_tokens = [], [], []
+        for _ in range(args.rounds):
+            latency, prompt, output = run_generate(analytic, args.job_info, cvs)
+            latencies.append(latency)
+            prompt_tokens.append(prompt)
+            output_tokens.append(output)
+        print(f"{name}: 耗时中位数={statistics.median(latencies):.2f}s, 最大={max(latencies):.2f}s, "
+              f"输入token={statistics.mean(prompt_tokens):.0f}, 输出token={statistics.mean(output_tokens):.0f}")
+    print(f"文本模式简历数量：{len(text_cvs)}/{len(pdf_cvs)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""
+紧凑向量召回率对比：原始float向量 vs halfvec vs int8(+float重排)
+在项目根目录执行：python -m data.benchmark_vector_recall [--table sentence] [--queries 100] [--k 10] [--max-rows 50000]
+需先执行data.migrate_compact_vectors
+1、本地：抽取max-rows行向量，以其中queries行作为查询向量(排除自身)，精确余弦top-k作为基准，
+   对比halfvec精确内积、int8扫描、int8扫描取k * oversample后float重排的recall@k
+2、数据库：以关闭索引的顺序扫描结果为基准，对比原embedding列索引与halfvec索引(+float重排)的recall@k及耗时
+3、输出各列平均占用字节数
+"""
+import argparse
+import statistics
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+from model import OriginCVSentenceEmbeddingModel, OriginCVKeywordEmbeddingModel
+from model.database import SessionLocal
+from model.vector_compact import HALF_COLUMN, INT8_COLUMN, compact_vector_config, compact_search, \
+    compact_vector_stats, decode_int8, vector_literal
+from model.vector_index import apply_vector_search_params
+from tools.cv_rerank import normalize_rows
+
+MODELS = {"sentence": OriginCVSentenceEmbeddingModel, "keyword": OriginCVKeywordEmbeddingModel}
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def recall(expected, actual) -> float:
+    return len(set(expected) & set(actual)) / max(len(expected), 1)
+
+
+def local_benchmark(session, table: str, args, oversample: int):
+    rows = session.execute(text(
+        f"SELECT id, embedding::real[], {HALF_COLUMN}::real[], {INT8_COLUMN} FROM {table} "
+        f"WHERE {HALF_COLUMN} IS NOT NULL AND {INT8_COLUMN} IS NOT NULL ORDER BY random() LIMIT :limit"
+    ), {"limit": args.max_rows}).all()
+    if len(rows) <= args.k:
+        print("数据量不足")
+        return
+    floats = normalize_rows(np.array([row[1] for row in rows], dtype=np.float32))
+    halves = np.array([row[2] for row in rows], dtype=np.float16)
+    int8s = decode_int8([row[3] for row in rows])
+    print(f"样本行数：{len(rows)}，内存占用 float32={floats.nbytes / 2 ** 20:.1f}MB，"
+          f"halfvec={halves.nbytes / 2 ** 20:.1f}MB，int8={int8s.nbytes / 2 ** 20:.1f}MB")
+
+    results = {"halfvec": [], "int8": [], f"int8+rescore(x{oversample})": []}
+    latencies = {name: [] for name in ["float32", *results]}
+    for idx in np.random.default_rng(0).choice(len(rows), min(args.queries, len(rows)), replace=False):
+        query = floats[idx]
+
+        def run(name, func):
+            started = time.perf_counter()
+            scores = func()
+            scores[idx] = -np.inf
+            latencies[name].append(time.perf_counter() - started)
+            return scores
+
+        expected = top_k(run("float32", lambda: floats @ query), args.k)
+        half_scores = run("halfvec", lambda: halves.astype(np.float32) @ query)
+        results["halfvec"].append(recall(expected, top_k(half_scores, args.k)))
+        int8_scores = run("int8", lambda: int8s.astype(np.float32) @ query)
+        results["int8"].append(recall(expected, top_k(int8_scores, args.k)))
+
+        def rescore():
+            candidates = top_k(int8_scores, args.k * oversample)
+            scores = np.full(len(rows), -np.inf, dtype=np.float32)
+            scores[candidates] = floats[candidates] @ query
+            return scores
+        rescored = run(f"int8+rescore(x{oversample})", rescore)
+        results[f"int8+rescore(x{oversample})"].append(recall(expected, top_k(rescored, args.k)))
+
+    print(f"\n==== 本地 recall@{args.k} ====")
+    for name, values in results.items():
+        print(f"{name}: recall={statistics.mean(values):.4f}，耗时中位数={statistics.median(latencies[name]) * 1000:.2f}ms")
+    print(f"float32: 耗时中位数={statistics.median(latencies['float32']) * 1000:.2f}ms")
+
+
+def db_benchmark(session, model, args):
+    table = model.__tablename__
+    queries = session.execute(text(
+        f"SELECT id, embedding::real[] FROM {table} ORDER BY random() LIMIT :limit"), {"limit": args.db_queries}).all()
+    session.commit()
+    recalls = {"float_index": [], "halfvec_index+rescore": []}
+    latencies = {name: [] for name in recalls}
+    for query_id, embedding in queries:
+        query = np.asarray(embedding, dtype=np.float32)
+        params = {"query": vector_literal(query), "id": query_id, "k": args.k}
+        exact_sql = (f"SELECT id FROM {table} WHERE id != :id "
+                     f"ORDER BY embedding <=> CAST(:query AS vector) LIMIT :k")
+        with session.begin():
+            session.execute(text("SET LOCAL enable_indexscan = off"))
+            expected = [row[0] for row in session.execute(text(exact_sql), params)]
+        with session.begin():
+            apply_vector_search_params(session)
+            started = time.perf_counter()
+            actual = [row[0] for row in session.execute(text(exact_sql), params)]
+            latencies["float_index"].append(time.perf_counter() - started)
+        recalls["float_index"].append(recall(expected, actual))
+        with session.begin():
+            apply_vector_search_params(session)
+            started = time.perf_counter()
+            actual = [row[0] for row in compact_search(session, model, query, limit=args.k, where="id != :id",
+                                                       params={"id": query_id})]
+            latencies["halfvec_index+rescore"].append(time.perf_counter() - started)
+        recalls["halfvec_index+rescore"].append(recall(expected, actual))
+
+    print(f"\n==== 数据库 recall@{args.k}，查询数量：{len(queries)} ====")
+    for name, values in recalls.items():
+        print(f"{name}: recall={statistics.mean(values):.4f}，耗时中位数={statistics.median(latencies[name]) * 1000:.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--table", choices=list(MODELS), default="sentence")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--db-queries", type=int, default=20)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--max-rows", type=int, default=50000)
+    args = parser.parse_args()
+
+    model = MODELS[args.table]
+    oversample = compact_vector_config()["oversample"]
+    with SessionLocal() as session:
+        local_benchmark(session, model.__tablename__, args, oversample)
+        session.rollback()
+        db_benchmark(session, model, args)
+        print("\n==== 存储 ====")
+        for item in compact_vector_stats(session)["tables"]:
+            print(item)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+向量表紧凑存储迁移
+在项目根目录执行：python -m data.migrate_compact_vectors [--modes halfvec int8] [--batch-size 2000] [--skip-index]
+1、增加embedding_half(halfvec)及embedding_int8(bytea)列，并创建写入embedding时同步计算的触发器
+2、按批回填已有数据，可中断后重复执行
+3、为embedding_half创建内积(halfvec_ip_ops)HNSW索引
+完成后在settings中配置VECTOR_COMPACT_MODES，确认召回率(data.benchmark_vector_recall)后可删除原embedding列的向量索引
+"""
+import argparse
+
+from model.database import SessionLocal
+from model.vector_compact import COMPACT_VECTOR_MODES, enable_compact_vectors, backfill_compact_vectors, \
+    create_compact_indexes, compact_vector_stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", nargs="+", choices=COMPACT_VECTOR_MODES, default=list(COMPACT_VECTOR_MODES))
+    parser.add_argument("--batch-size", type=int, default=2000)
+    parser.add_argument("--skip-index", action="store_true")
+    args = parser.parse_args()
+
+    enable_compact_vectors(args.modes)
+    result = backfill_compact_vectors(args.modes, batch_size=args.batch_size)
+    print(f"回填完成：{result}")
+    if "halfvec" in args.modes and not args.skip_index:
+        create_compact_indexes()
+    with SessionLocal() as session:
+        for item in compact_vector_stats(session)["tables"]:
+            print(item)
+
+
+if __name__ == '__main__':
+    main()
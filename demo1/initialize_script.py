@@ -1,4 +1,5 @@
 from model import SessionLocal, AdminUserModel
+from model.vector_index import create_vector_indexes
 from services.service_user import UserService
 
 
@@ -13,5 +14,12 @@ def init_admin_user():
     print("添加 admin 超管账号成功")
 
 
+def init_vector_indexes():
+    # 索引类型及参数见settings中的VECTOR_INDEX_*配置
+    create_vector_indexes()
+    print("创建向量索引成功")
+
+
 if __name__ == "__main__":
     init_admin_user()
+    init_vector_indexes()
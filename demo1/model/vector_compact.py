@@ -0,0 +1,189 @@
+import typing
+
+import numpy as np
+from pgvector.sqlalchemy import HALFVEC
+from sqlalchemy import text, literal_column, LargeBinary
+
+from model.database import engine
+from model.vector_index import VECTOR_INDEX_MODELS, vector_index_config
+from settings import setting
+
+COMPACT_VECTOR_MODES = ("halfvec", "int8")
+HALF_COLUMN = "embedding_half"
+INT8_COLUMN = "embedding_int8"
+# 向量已归一化，每一维在[-1, 1]之间，固定按127量化，不需要逐行保存缩放系数
+INT8_SCALE = 127
+
+# 由原始embedding列计算紧凑向量的SQL表达式，{src}为原始向量，触发器与回填共用
+HALF_EXPR = "l2_normalize({src})::halfvec({dim})"
+INT8_EXPR = """(
+    SELECT decode(string_agg(lpad(to_hex(greatest(-127, least(127, round(x * 127)))::int & 255), 2, '0'), ''
+                  ORDER BY i), 'hex')
+    FROM unnest(l2_normalize({src})::real[]) WITH ORDINALITY AS v(x, i)
+)"""
+
+
+def compact_vector_config() -> dict:
+    modes = list(getattr(setting, "VECTOR_COMPACT_MODES", []))
+    for mode in modes:
+        if mode not in COMPACT_VECTOR_MODES:
+            raise ValueError(f"不支持的紧凑向量类型：{mode}")
+    return {
+        "modes": modes,
+        "dim": int(getattr(setting, "VECTOR_COMPACT_DIM", 768)),
+        "oversample": int(getattr(setting, "VECTOR_COMPACT_RESCORE_OVERSAMPLE", 4)),
+    }
+
+
+def compact_columns(modes: typing.Iterable[str], dim: int, src: str = "embedding") -> typing.Dict[str, str]:
+    """返回{列名: 计算表达式}"""
+    columns = {}
+    if "halfvec" in modes:
+        columns[HALF_COLUMN] = HALF_EXPR.format(src=src, dim=dim)
+    if "int8" in modes:
+        columns[INT8_COLUMN] = INT8_EXPR.format(src=src)
+    return columns
+
+
+def quantize_int8(matrix: np.ndarray) -> np.ndarray:
+    """与INT8_EXPR一致的量化，matrix需已按行归一化"""
+    return np.clip(np.round(matrix * INT8_SCALE), -INT8_SCALE, INT8_SCALE).astype(np.int8)
+
+
+def decode_int8(values: typing.Sequence[bytes]) -> np.ndarray:
+    """bytea列转int8矩阵"""
+    return np.frombuffer(b"".join(values), dtype=np.int8).reshape(len(values), -1)
+
+
+def int8_column(model):
+    return literal_column(f"{model.__tablename__}.{INT8_COLUMN}", LargeBinary)
+
+
+def half_column(model):
+    return literal_column(f"{model.__tablename__}.{HALF_COLUMN}", HALFVEC(compact_vector_config()["dim"]))
+
+
+def vector_literal(query: typing.Sequence[float]) -> str:
+    return "[" + ",".join(str(float(i)) for i in query) + "]"
+
+
+def enable_compact_vectors(modes: typing.Iterable[str] = None):
+    """
+    为向量表增加紧凑向量列，并创建触发器在写入embedding时同步计算，原有写入逻辑不需要修改
+    halfvec为归一化后的半精度向量；int8为归一化后按127量化的bytea，每维1字节
+    需要pgvector 0.7.0及以上(halfvec、l2_normalize)
+    """
+    config = compact_vector_config()
+    modes = list(modes or config["modes"])
+    with engine.begin() as conn:
+        for model in VECTOR_INDEX_MODELS:
+            table = model.__tablename__
+            columns = compact_columns(modes, config["dim"], src="NEW.embedding")
+            if not columns:
+                continue
+            if HALF_COLUMN in columns:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {HALF_COLUMN} halfvec({config['dim']})"))
+            if INT8_COLUMN in columns:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {INT8_COLUMN} bytea"))
+            assigns = "\n".join(f"    NEW.{name} := {expr};" for name, expr in columns.items())
+            conn.execute(text(f"""
+                CREATE OR REPLACE FUNCTION {table}_compact_embedding() RETURNS trigger AS $$
+                BEGIN
+                {assigns}
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql
+            """))
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {table}_compact_embedding ON {table}"))
+            conn.execute(text(
+                f"CREATE TRIGGER {table}_compact_embedding BEFORE INSERT OR UPDATE OF embedding ON {table} "
+                f"FOR EACH ROW EXECUTE FUNCTION {table}_compact_embedding()"
+            ))
+            print(f"{table}启用紧凑向量：{list(columns)}")
+
+
+def backfill_compact_vectors(modes: typing.Iterable[str] = None, batch_size: int = 2000) -> typing.Dict[str, int]:
+    """按批回填已有数据的紧凑向量列，每批单独提交，可中断后重复执行"""
+    config = compact_vector_config()
+    modes = list(modes or config["modes"])
+    result = {}
+    for model in VECTOR_INDEX_MODELS:
+        table = model.__tablename__
+        columns = compact_columns(modes, config["dim"])
+        if not columns:
+            continue
+        # embedding为空的行无法计算紧凑向量，排除后才能在回填完成时退出循环
+        missing = "(" + " OR ".join(f"{name} IS NULL" for name in columns) + ") AND embedding IS NOT NULL"
+        assigns = ", ".join(f"{name} = {expr}" for name, expr in columns.items())
+        total = 0
+        while True:
+            with engine.begin() as conn:
+                count = conn.execute(text(
+                    f"UPDATE {table} SET {assigns} WHERE id IN "
+                    f"(SELECT id FROM {table} WHERE {missing} LIMIT :limit FOR UPDATE SKIP LOCKED)"
+                ), {"limit": batch_size}).rowcount
+            total += count
+            if count:
+                print(f"{table}已回填{total}行")
+            if count < batch_size:
+                break
+        result[table] = total
+    return result
+
+
+def create_compact_indexes():
+    """halfvec列按内积建立HNSW索引；int8列只用于进程内扫描，不建索引"""
+    config = vector_index_config()
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for model in VECTOR_INDEX_MODELS:
+            table = model.__tablename__
+            name = f"ix_{table}_{HALF_COLUMN}_hnsw"
+            options = f"m = {config['m']}, ef_construction = {config['ef_construction']}"
+            print(f"创建向量索引{name}，{options}")
+            conn.execute(text(
+                f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} "
+                f"USING hnsw ({HALF_COLUMN} halfvec_ip_ops) WITH ({options})"
+            ))
+
+
+def compact_search(session, model, query: typing.Sequence[float], limit: int = 50, where: str = "",
+                   params: dict = None, rescore: bool = True):
+    """
+    halfvec内积检索：先按halfvec索引取limit * oversample个候选，再用原始float向量按余弦相似度重排
+    :param where: 额外的过滤条件SQL，如"cv_id = ANY(:cv_ids)"，参数通过params传入
+    :return: [(id, cv_id, score)]，score为余弦相似度
+    """
+    config = compact_vector_config()
+    table = model.__tablename__
+    query = np.asarray(query, dtype=np.float32)
+    query = vector_literal(query / (np.linalg.norm(query) or 1))
+    candidates = limit * config["oversample"] if rescore else limit
+    # 向量已归一化，负内积与余弦距离排序一致，halfvec_ip_ops可以直接使用索引
+    inner = (f"SELECT id, cv_id, embedding, {HALF_COLUMN} FROM {table} "
+             f"{'WHERE ' + where if where else ''} "
+             f"ORDER BY {HALF_COLUMN} <#> CAST(:query AS halfvec({config['dim']})) LIMIT :candidates")
+    if rescore:
+        sql = (f"SELECT id, cv_id, 1 - (embedding <=> CAST(:query AS vector)) AS score FROM ({inner}) c "
+               f"ORDER BY embedding <=> CAST(:query AS vector) LIMIT :limit")
+    else:
+        sql = (f"SELECT id, cv_id, -({HALF_COLUMN} <#> CAST(:query AS halfvec({config['dim']}))) AS score "
+               f"FROM ({inner}) c LIMIT :limit")
+    return session.execute(text(sql), {**(params or {}), "query": query, "candidates": candidates,
+                                       "limit": limit}).all()
+
+
+def compact_vector_stats(session) -> dict:
+    config = compact_vector_config()
+    tables = []
+    for model in VECTOR_INDEX_MODELS:
+        table = model.__tablename__
+        exists = {row[0] for row in session.execute(text(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = :table"), {"table": table})}
+        fields = ["count(*) AS rows", "avg(pg_column_size(embedding)) AS embedding_bytes"]
+        for name in (HALF_COLUMN, INT8_COLUMN):
+            if name in exists:
+                fields.append(f"count({name}) AS {name}_rows")
+                fields.append(f"avg(pg_column_size({name})) AS {name}_bytes")
+        row = session.execute(text(f"SELECT {', '.join(fields)} FROM {table}")).mappings().one()
+        tables.append({"table_name": table, **{k: float(v) if v is not None else None for k, v in row.items()}})
+    return {"config": config, "tables": tables}
@@ -0,0 +1,112 @@
+import typing
+
+from sqlalchemy import text
+
+from model import OriginCVSentenceEmbeddingModel, OriginCVKeywordEmbeddingModel
+from model.database import engine
+from settings import setting
+
+# 需要建立向量索引的表，均为embedding列
+VECTOR_INDEX_MODELS = [OriginCVSentenceEmbeddingModel, OriginCVKeywordEmbeddingModel]
+VECTOR_INDEX_METHODS = ("hnsw", "ivfflat")
+# 回调事件中需要设置向量检索参数的事件
+VECTOR_SEARCH_EVENTS = {"search_task_vector_cvs_retrieval"}
+
+
+def vector_index_config() -> dict:
+    return {
+        "methods": getattr(setting, "VECTOR_INDEX_METHODS", ["hnsw"]),
+        "ops": getattr(setting, "VECTOR_INDEX_OPS", "vector_cosine_ops"),
+        "m": int(getattr(setting, "VECTOR_INDEX_HNSW_M", 16)),
+        "ef_construction": int(getattr(setting, "VECTOR_INDEX_HNSW_EF_CONSTRUCTION", 64)),
+        "lists": getattr(setting, "VECTOR_INDEX_IVFFLAT_LISTS", None),
+        "ef_search": getattr(setting, "VECTOR_SEARCH_HNSW_EF_SEARCH", 100),
+        "probes": getattr(setting, "VECTOR_SEARCH_IVFFLAT_PROBES", 10),
+    }
+
+
+def vector_index_name(table: str, method: str) -> str:
+    return f"ix_{table}_embedding_{method}"
+
+
+def ivfflat_lists(rows: int) -> int:
+    # pgvector建议：100万行以内为rows/1000，以上为sqrt(rows)
+    if rows <= 1000000:
+        return max(10, rows // 1000)
+    return int(rows ** 0.5)
+
+
+def create_vector_indexes(methods: typing.Iterable[str] = None):
+    """
+    为向量表创建ANN索引，已存在的索引跳过
+    使用CREATE INDEX CONCURRENTLY，建索引期间不阻塞写入；IVFFlat需要在表中已有数据后创建，lists未配置时按行数计算
+    """
+    config = vector_index_config()
+    methods = list(methods or config["methods"])
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for model in VECTOR_INDEX_MODELS:
+            table = model.__tablename__
+            for method in methods:
+                if method not in VECTOR_INDEX_METHODS:
+                    raise ValueError(f"不支持的向量索引类型：{method}")
+                name = vector_index_name(table, method)
+                if method == "hnsw":
+                    options = f"m = {config['m']}, ef_construction = {config['ef_construction']}"
+                else:
+                    lists = config["lists"]
+                    if not lists:
+                        lists = ivfflat_lists(conn.execute(text(f"SELECT count(*) FROM {table}")).scalar())
+                    options = f"lists = {int(lists)}"
+                print(f"创建向量索引{name}，{options}")
+                conn.execute(text(
+                    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} "
+                    f"USING {method} (embedding {config['ops']}) WITH ({options})"
+                ))
+
+
+def drop_vector_indexes(methods: typing.Iterable[str]):
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for model in VECTOR_INDEX_MODELS:
+            for method in methods:
+                conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {vector_index_name(model.__tablename__, method)}"))
+
+
+def apply_vector_search_params(session):
+    """
+    设置当前事务的向量检索参数，需在同一事务内的向量查询之前调用
+    hnsw.ef_search越大召回率越高、耗时越长；ivfflat.probes同理
+    """
+    config = vector_index_config()
+    if config["ef_search"]:
+        session.execute(text(f"SET LOCAL hnsw.ef_search = {int(config['ef_search'])}"))
+    if config["probes"]:
+        session.execute(text(f"SET LOCAL ivfflat.probes = {int(config['probes'])}"))
+
+
+def vector_index_stats(session) -> dict:
+    tables = [model.__tablename__ for model in VECTOR_INDEX_MODELS]
+    indexes = session.execute(text("""
+        SELECT c.relname AS name, t.relname AS table_name, am.amname AS method,
+               pg_relation_size(c.oid) AS size, i.indisvalid AS valid, i.indisready AS ready,
+               pg_get_indexdef(c.oid) AS definition
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_class t ON t.oid = i.indrelid
+        JOIN pg_am am ON am.oid = c.relam
+        WHERE t.relname = ANY(:tables)
+    """), {"tables": tables}).mappings().all()
+    progress = session.execute(text("""
+        SELECT p.index_relid::regclass::text AS name, p.relid::regclass::text AS table_name, p.phase,
+               p.blocks_done, p.blocks_total, p.tuples_done, p.tuples_total
+        FROM pg_stat_progress_create_index p
+    """)).mappings().all()
+    table_sizes = session.execute(text("""
+        SELECT relname AS table_name, pg_total_relation_size(oid) AS size, reltuples::bigint AS rows
+        FROM pg_class WHERE relname = ANY(:tables)
+    """), {"tables": tables}).mappings().all()
+    return {
+        "config": vector_index_config(),
+        "tables": [dict(i) for i in table_sizes],
+        "indexes": [dict(i) for i in indexes],
+        "building": [dict(i) for i in progress],
+    }
@@ -1,4 +1,9 @@
 sudo ps -ef | grep 'backgroup_task.main worker' |grep -v 'grep'|awk '{print $2}' | xargs kill -9
 echo "kill process successful, waiting restart..."
 sleep 5
-nohup /home/moski/.env/bin/celery -A backgroup_task.main worker > task.log 2>&1 &
+# 每个队列启动独立的Worker，并发数、prefetch等参数见backgroup_task/celery_config.py及setting.CELERY_QUEUES
+for queue in $(/home/moski/.env/bin/python -m backgroup_task.celery_config); do
+  args=$(/home/moski/.env/bin/python -m backgroup_task.celery_config "$queue")
+  nohup /home/moski/.env/bin/celery -A backgroup_task.main worker $args > "task-$queue.log" 2>&1 &
+  echo "worker for queue $queue started: $args"
+done
@@ -1,3 +1,4 @@
+import asyncio
 import hashlib
 import json
 
@@ -12,7 +13,9 @@ from model import OriginCVModel
 from schema.cvinfo_schema import *
 from uuid import uuid4
 from typing import Annotated
-from backgroup_task.main import analytic_cv, sentence_embedding, abstract_cv, split_pdf_chunks_and_embedding
+from backgroup_task.cv_text_store import cv_text_store
+from backgroup_task.main import analytic_cv, sentence_embedding, split_pdf_chunks_and_embedding, fair_scheduler, \
+    abstract_cv_batcher
 from schema.jobdata_schema import CVOriginSchema
 from schema.page_schema import PageInfo
 from schema.user_schemas import CurrentUser
@@ -20,7 +23,7 @@ from services.service_search_task import SearchTaskService
 from settings import setting
 from tools.rest_result import restResult
 from services.service_cvinfo import CvInfoService
-from tools.pdf_extract import process_resume_pdf
+from tools.pdf_extract import extract_pdf_text, process_resume_pdf
 
 cv_route = APIRouter(prefix="/cv")
 
@@ -46,6 +49,9 @@ async def add_spider_cv(
     # step 1、添加数据库
     meta_json = json.loads(meta_json)
     gcs_path = f"gs://{setting.bucket_name}/{file_name}"
+    if cv_text_store.enable:
+        await cv_file.seek(0)
+        await cv_text_store.save_from_pdf_async(gcs_path, await cv_file.read())
     ret = await CvInfoService.add_spider_search_task_cv(
         jd_id=jd_id,
         search_task_id=task_id,
@@ -60,7 +66,8 @@ async def add_spider_cv(
         return restResult.build_from_ret(ret)
     quota = setting.ANALYZE_ADD_WHEN_UPLOAD
     if sn % quota == 0:
-        analytic_cv.apply_async(kwargs={"task_id": task_id, "jd_id": jd_id, "quota": quota})
+        await fair_scheduler.submit_async(
+            await fair_scheduler.jd_tenant_async(jd_id, session), analytic_cv, {"task_id": task_id, "jd_id": jd_id, "quota": quota})
 
     origin_cv_id = ret.data["origin_cv_id"]
     if CvInfoService.cv_dao.count_of_cv_sentence_embeddings(session, cv_id=origin_cv_id) == 0:
@@ -69,7 +76,7 @@ async def add_spider_cv(
             sentence_embedding.apply_async(kwargs={"cv_id": origin_cv_id, "texts": texts})
     if CvInfoService.cv_dao.count_of_cv_keyword_embeddings(session, cv_id=origin_cv_id) == 0:
         cvs = [{"cv_id": origin_cv_id, "gcs_path": gcs_path, "origin": "ehire"}]
-        abstract_cv.apply_async(kwargs={"cvs": cvs})
+        await abstract_cv_batcher.add_async(await fair_scheduler.jd_tenant_async(jd_id, session), cvs)
     return restResult.success()
 
 
@@ -101,7 +108,8 @@ async def add_spider_cv(
         return restResult.build_from_ret(ret)
     quota = setting.ANALYZE_ADD_WHEN_UPLOAD
     if sn % quota == 0:
-        analytic_cv.apply_async(kwargs={"task_id": task_id, "jd_id": jd_id, "quota": quota})
+        await fair_scheduler.submit_async(
+            await fair_scheduler.jd_tenant_async(jd_id, session), analytic_cv, {"task_id": task_id, "jd_id": jd_id, "quota": quota})
 
     origin_cv_id = ret.data["origin_cv_id"]
     if CvInfoService.cv_dao.count_of_cv_sentence_embeddings(session, cv_id=origin_cv_id) == 0:
@@ -110,7 +118,7 @@ async def add_spider_cv(
             sentence_embedding.apply_async(kwargs={"cv_id": origin_cv_id, "texts": texts})
     if CvInfoService.cv_dao.count_of_cv_keyword_embeddings(session, cv_id=origin_cv_id) == 0:
         cvs = [{"cv_id": origin_cv_id, "meta_json": json.dumps(meta_json, ensure_ascii=False), "origin": "boss"}]
-        abstract_cv.apply_async(kwargs={"cvs": cvs})
+        await abstract_cv_batcher.add_async(await fair_scheduler.jd_tenant_async(jd_id, session), cvs)
     return restResult.success()
 
 
@@ -159,14 +167,23 @@ async def upload_cv(
     if ret.is_fail:
         return restResult.build_from_ret(ret)
     origin_cv = ret.data["origin_cv"]
+    await cv_file.seek(0)
     pdf_stream = await cv_file.read()
-    result = process_resume_pdf(pdf_stream=pdf_stream, chunk_size=350, chunk_overlap=40)
+    # 全文只提取一次，同时用于切片及文本模式分析
+    try:
+        full_text = extract_pdf_text(pdf_stream=pdf_stream)
+    except Exception as e:
+        logger.error(f"简历{gs_save_path}提取文本异常，{e}")
+        full_text = ""
+    if cv_text_store.enable:
+        await asyncio.to_thread(cv_text_store.save, gs_save_path, full_text)
+    result = process_resume_pdf(pdf_stream=pdf_stream, chunk_size=350, chunk_overlap=40, full_text=full_text)
     logger.info(f"简历{gs_save_path}切片完成，共生成 {len(result)} 个文本块。")
     if result:
         texts = [i["text"] for i in result]
         split_pdf_chunks_and_embedding.apply_async(kwargs={"cv_id": origin_cv.id, "chunks": texts})
     cvs = [{"cv_id": origin_cv.id, "gcs_path": gs_save_path}]
-    abstract_cv.apply_async(kwargs={"cvs": cvs})
+    await abstract_cv_batcher.add_async(current_user.company_id, cvs)
     return restResult.success()
 
 
@@ -1,24 +1,37 @@
+import asyncio
+
 from sqlalchemy.orm import Session
 from starlette.requests import Request
 
 import depend
-from typing import Annotated
+from typing import Annotated, List
 
-from fastapi import APIRouter, Form, UploadFile, Depends
+from fastapi import APIRouter, Form, UploadFile, Depends, Body
 
 from backgroup_task.analytic import Analytic
+from backgroup_task.callback_client import CeleryCallbackEvent
+from backgroup_task.main import fair_scheduler
+from extentions import logger
+from model.vector_index import VECTOR_SEARCH_EVENTS, apply_vector_search_params
 from services.service_celery_task import CeleryTaskService
+from settings import setting
 from tools.rest_result import restResult
 
 index_route = APIRouter(prefix="/index")
+analytics_client = Analytic()
 
 
 @index_route.post("/analytic/dcp", description="根据岗位描述信息进行大模型AI分析")
 async def index_analytic_description(keywords: Annotated[str, Form()]):
     if not keywords:
         return restResult.fail("岗位描述参数异常")
-    analytics_client = Analytic()
-    analytics_result = analytics_client.resolve_jd(jd_info=keywords, index=2)
+    try:
+        async with fair_scheduler.interactive_async():
+            analytics_result = await analytics_client.resolve_jd_async(
+                jd_info=keywords, index=2, timeout=getattr(setting, "INDEX_ANALYTIC_TEXT_TIMEOUT", 30))
+    except (asyncio.TimeoutError, TimeoutError):
+        logger.warning("岗位描述分析超时")
+        return restResult.fail("岗位描述分析超时，请稍后重试")
     return restResult.success(data=analytics_result)
 
 
@@ -28,9 +41,14 @@ async def index_analytic_description(file: UploadFile):
         return restResult.fail("岗位描述参数异常")
     if not file.filename.endswith(".pdf"):
         return restResult.fail("当前仅支持PDF文件解析")
-    analytics_client = Analytic()
     steam_bytes = await file.read()
-    analytics_result = analytics_client.resolve_jd(jd_file_stream=steam_bytes, index=2)
+    try:
+        async with fair_scheduler.interactive_async():
+            analytics_result = await analytics_client.resolve_jd_async(
+                jd_file_stream=steam_bytes, index=2, timeout=getattr(setting, "INDEX_ANALYTIC_FILE_TIMEOUT", 90))
+    except (asyncio.TimeoutError, TimeoutError):
+        logger.warning(f"岗位描述文件分析超时，{file.filename}")
+        return restResult.fail("岗位描述文件分析超时，请稍后重试")
     return restResult.success(data=analytics_result)
 
 
@@ -40,4 +58,28 @@ celery_task_service = CeleryTaskService()
 @index_route.post("/bg/celery/callback", description="celery后台任务回调接口",
                   dependencies=[Depends(depend.require_api_key)])
 async def celery_callback(request: Request, session: Session = Depends(depend.get_db)):
+    if request.query_params.get("event") in VECTOR_SEARCH_EVENTS:
+        apply_vector_search_params(session)
     return restResult.build_from_ret(await celery_task_service.dispatch(request, session))
+
+
+@index_route.post("/bg/celery/callback/batch", description="celery后台任务批量回调接口，按顺序处理多个事件",
+                  dependencies=[Depends(depend.require_api_key)])
+async def celery_batch_callback(
+    events: Annotated[List[dict], Body(embed=True)],
+    session: Session = Depends(depend.get_db)
+):
+    results = []
+    for item in events:
+        event = CeleryCallbackEvent(item.get("event"), item.get("payload"))
+        try:
+            if item.get("event") in VECTOR_SEARCH_EVENTS:
+                apply_vector_search_params(session)
+            ret = await celery_task_service.dispatch(event, session)
+            results.append(restResult.build_from_ret(ret).__dict__)
+        except Exception as e:
+            # 单个事件失败不影响同批次其他事件
+            session.rollback()
+            logger.error(f"Celery批量回调处理{event}异常, {e}")
+            results.append(restResult.error("服务器异常").__dict__)
+    return restResult.success(data=results)
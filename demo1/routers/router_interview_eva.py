@@ -9,7 +9,7 @@ import depend
 
 from fastapi import APIRouter, Form, UploadFile, Depends
 
-from backgroup_task.main import interview_eva
+from backgroup_task.main import interview_eva, fair_scheduler
 from extentions import logger
 from model.model_interview_evaluation import InterviewEvaTemplateModel, InterviewEvaResultModel
 from schema.page_schema import PageInfo
@@ -142,8 +142,10 @@ async def start_interview_eva(
         session.add(instance)
         session.commit()
         session.refresh(instance)
-        interview_eva.apply_async(
-            kwargs={"task_id": _id, "template_save_path": template.save_path, "content_save_path": gcs_path}
+        await fair_scheduler.submit_async(
+            current_user.company_id,
+            interview_eva,
+            {"task_id": _id, "template_save_path": template.save_path, "content_save_path": gcs_path},
         )
         logger.info(f"{current_user}发起面评任务成功， {instance}")
         return restResult.success(data=_id)
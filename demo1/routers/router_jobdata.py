@@ -1,3 +1,5 @@
+import asyncio
+
 from sqlalchemy.orm import Session
 from starlette.requests import Request
 
@@ -7,7 +9,9 @@ from typing import Annotated
 from fastapi import APIRouter, Depends, Form
 
 from backgroup_task.analytic import Analytic
-from backgroup_task.main import analytic_jd
+from backgroup_task.context_cache import context_cache
+from backgroup_task.main import analytic_jd, drop_jd_context_cache, fair_scheduler
+from extentions import logger
 from model import JobDataModel
 from schema.jobdata_schema import *
 from backgroup_task.main import analytic_cv
@@ -16,10 +20,12 @@ from schema.user_schemas import CurrentUser
 from services.exceptions.custom_exceptions import DataProcessingException
 from services.service_search_task import SearchTaskService
 from services.service_jobdata import JobDataService
+from settings import setting
 
 from tools.rest_result import restResult
 
 jd_router = APIRouter(prefix="/jd")
+analytics_client = Analytic()
 
 
 @jd_router.post("/create", description="创建JobData接口")
@@ -31,7 +37,7 @@ async def create(
     ret = JobDataService.create(schema, session, current_user)
     if ret.is_fail:
         return restResult.fail(ret.msg)
-    analytic_jd.apply_async(kwargs={"jd_id": str(ret.data)})
+    await fair_scheduler.submit_async(current_user.company_id, analytic_jd, {"jd_id": str(ret.data)})
     return restResult.success(data=ret.data)
 
 
@@ -185,8 +191,11 @@ async def analytic_task_callback(
         return restResult.fail(ret.msg)
     # 所有爬取任务结束后
     if "complete" in callback_schema.status.lower() and callback_schema.success_upload != 0:
-        analytic_cv.apply_async(
-            kwargs={"task_id": callback_schema.task_id, "jd_id": callback_schema.jd_id, "quota": False})
+        await fair_scheduler.submit_async(
+            await fair_scheduler.jd_tenant_async(callback_schema.jd_id, session),
+            analytic_cv,
+            {"task_id": callback_schema.task_id, "jd_id": callback_schema.jd_id, "quota": False},
+        )
     return restResult.success()
 
 
@@ -197,14 +206,19 @@ async def analytics_jd_description_file(
 ):
     if not job_description_file and not job_description_str:
         return restResult.fail("岗位描述参数异常")
-    analytics_client = Analytic()
-    if job_description_str:
-        analytics_result = analytics_client.resolve_jd(jd_info=job_description_str, index=1)
-    elif job_description_file:
-        steam_bytes = await job_description_file.read()
-        analytics_result = analytics_client.resolve_jd(jd_file_stream=steam_bytes, index=1)
-    else:
-        return restResult.fail("岗位描述参数异常")
+    try:
+        if job_description_str:
+            analytics_result = await analytics_client.resolve_jd_async(
+                jd_info=job_description_str, index=1, timeout=getattr(setting, "JD_ANALYTIC_TEXT_TIMEOUT", 30))
+        elif job_description_file:
+            steam_bytes = await job_description_file.read()
+            analytics_result = await analytics_client.resolve_jd_async(
+                jd_file_stream=steam_bytes, index=1, timeout=getattr(setting, "JD_ANALYTIC_FILE_TIMEOUT", 90))
+        else:
+            return restResult.fail("岗位描述参数异常")
+    except (asyncio.TimeoutError, TimeoutError):
+        logger.warning("岗位描述分析超时")
+        return restResult.fail("岗位描述分析超时，请稍后重试")
     return restResult.success(data=analytics_result)
 
 
@@ -214,7 +228,11 @@ async def delete_jd(
     session: Session = Depends(depend.get_db),
     current_user: CurrentUser = Depends(depend.current_user)
 ):
-    return restResult.build_from_ret(JobDataService.delete_by_id(jd_id, session, current_user))
+    ret = JobDataService.delete_by_id(jd_id, session, current_user)
+    if ret.is_ok:
+        if context_cache.enable:
+            drop_jd_context_cache.apply_async(kwargs={"jd_id": jd_id})
+    return restResult.build_from_ret(ret)
 
 
 @jd_router.post("/rename", description="对JD进行重命名")
@@ -253,11 +271,13 @@ async def update_jd(
             ret = JobDataService.delete_jd_attachments(jd, session, current_user, commit=False)
             if ret.is_fail:
                 raise DataProcessingException(ret.msg, jd)
-            analytic_jd.apply_async(kwargs={"jd_id": str(schema.jd_id)})
+            await fair_scheduler.submit_async(current_user.company_id, analytic_jd, {"jd_id": str(schema.jd_id)})
             # ret = await JobDataService.sync_analytic_jd(jd, session, commit=False)
             # if ret.is_fail:
             #     raise DataProcessingException(ret.msg, jd)
         session.commit()
+        if context_cache.enable:
+            drop_jd_context_cache.apply_async(kwargs={"jd_id": str(schema.jd_id)})
         return restResult.success()
     except DataProcessingException:
         session.rollback()
@@ -277,7 +297,7 @@ async def analyze_debug(request: Request, session: Session = Depends(depend.get_
     for i in results:
         if i.keyword_summary is not None:
             continue
-        analytic_jd.apply_async(kwargs={"jd_id": i.id})
+        await fair_scheduler.submit_async(i.company_id, analytic_jd, {"jd_id": i.id})
         print(f"添加分析任务，{i}")
         if debug:
             break
@@ -6,21 +6,27 @@ import uuid
 from sqlalchemy import text
 
 import depend
+import redis
 
 from fastapi.security.utils import get_authorization_scheme_param
 from sqlalchemy.orm import Session
 from starlette.exceptions import HTTPException
 from fastapi import WebSocket, APIRouter, Depends, WebSocketDisconnect, WebSocketException, status
 
-from backgroup_task.main import text_embedding, analyze_chat_cvs
+from backgroup_task.main import text_embedding, analyze_chat_cvs, fair_scheduler, task_result_channel, \
+    ai_analytic_chat_manager
 from extentions import logger
 from model import JobDataModel
 from model.database import SessionLocal
+from model.vector_index import apply_vector_search_params
 from schema.cvinfo_schema import CVOriginSchema
 from schema.user_schemas import CurrentUser
 from services.service_cvinfo import CvInfoService
 from services.service_jobdata import JobDataService
 from services.service_user import UserService
+from settings import setting
+from tools.cv_rerank import cv_reranker
+from tools.jd_vector_cache import jd_vector_cache
 
 ws_router = APIRouter(prefix="/ws")
 
@@ -61,22 +67,94 @@ async def ws_authenticate(token: str):
         raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason="Could not validate credentials")
 
 
-async def get_text_embedding(text: str):
-    celery_task = text_embedding.apply_async(args=(text, ))
+async def wait_task_result(celery_task, timeout: float = None):
+    """等待任务结果推送，任务失败或超时返回None；推送通道不可用时退回轮询"""
+    timeout = timeout or getattr(setting, "WS_TASK_TIMEOUT", 120)
+    if task_result_channel.enable:
+        try:
+            message = await task_result_channel.wait(celery_task.id, timeout)
+            return message["result"]
+        except asyncio.TimeoutError:
+            logger.error(f"等待任务结果超时，TaskId={celery_task.id}")
+            return None
+        except redis.RedisError as e:
+            logger.error(f"等待任务结果推送异常，改为轮询，TaskId={celery_task.id}，{e}")
     while not celery_task.ready():
         await asyncio.sleep(0.5)  # 定时检查任务状态
-        # 任务完成，通过 WebSocket 发送结果
-    ret = celery_task.result
-    return ret
+    return celery_task.result if celery_task.successful() else None
 
 
-async def get_analytic_cvs(msg: str, cvs: str, job_info: str):
-    celery_task = analyze_chat_cvs.apply_async(args=(msg, cvs, job_info, ))
-    while not celery_task.ready():
-        await asyncio.sleep(0.5)  # 定时检查任务状态
-        # 任务完成，通过 WebSocket 发送结果
-    ret = celery_task.result
-    return ret
+async def get_text_embedding(text: str):
+    # 交互请求进入优先通道，处理期间批量分析任务让出部分名额
+    async with fair_scheduler.interactive_async():
+        celery_task = text_embedding.apply_async(args=(text, ))
+        return await wait_task_result(celery_task)
+
+
+async def get_analytic_cvs(msg: str, cvs: str, job_info: str, jd_id: str = None, **kwargs):
+    async with fair_scheduler.interactive_async():
+        celery_task = analyze_chat_cvs.apply_async(args=(msg, cvs, job_info, jd_id, ), kwargs=kwargs)
+        return await wait_task_result(celery_task)
+
+
+def cv_key(cv_id) -> str:
+    """模型输出的简历ID为32位hex，数据库中可能是带-的UUID"""
+    try:
+        return uuid.UUID(str(cv_id)).hex
+    except ValueError:
+        return str(cv_id)
+
+
+async def stream_analytic_cvs(websocket: WebSocket, payload: dict, session: Session):
+    """
+    渐进式返回筛选结果：每解析出一份匹配的简历立即发送record帧，任务结束后发送summary帧
+    record: {"type": "record", "data": {"cv_id": "", "name": "", "suitability": 0, "reason": ""}}
+    summary: {"type": "summary", "data": [全部匹配简历], "total": 候选简历数量}
+    error: {"type": "error", "msg": ""}
+    """
+    names = {
+        cv_key(cv.id): cv.origin_cv.name
+        for cv in CvInfoService.cv_dao.get_cvs([i["cv_id"] for i in payload["cvs"]], session)
+    }
+    sent = {}
+
+    async def send_record(item: dict):
+        key = cv_key(item.get("key"))
+        if key in sent:
+            return
+        record = {**{k: v for k, v in item.items() if k != "key"}, "cv_id": item.get("key"), "name": names.get(key)}
+        sent[key] = record
+        await manager.send_personal_json({"type": "record", "data": record}, websocket)
+
+    timeout = getattr(setting, "WS_TASK_TIMEOUT", 120)
+    async with fair_scheduler.interactive_async():
+        celery_task = analyze_chat_cvs.apply_async(kwargs={**payload, "stream": True})
+        ret = None
+        try:
+            if task_result_channel.enable:
+                async for message in task_result_channel.listen(celery_task.id, timeout):
+                    if message.get("type") == "record":
+                        await send_record(message["data"])
+                    elif message.get("type") == "result":
+                        ret = message["result"]
+            else:
+                ret = await wait_task_result(celery_task, timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"等待任务结果超时，TaskId={celery_task.id}")
+        except redis.RedisError as e:
+            logger.error(f"等待任务结果推送异常，改为轮询，TaskId={celery_task.id}，{e}")
+            ret = await wait_task_result(celery_task, timeout)
+    if not ret:
+        await manager.send_personal_json({"type": "error", "msg": "服务器异常"}, websocket)
+        return
+    if not ret["result"]:
+        await manager.send_personal_json({"type": "error", "msg": ret["msg"]}, websocket)
+        return
+    # 推送通道丢失的记录在summary前补发
+    for item in ret["data"] or []:
+        await send_record(item)
+    await manager.send_personal_json(
+        {"type": "summary", "data": list(sent.values()), "total": len(payload["cvs"])}, websocket)
 
 
 @ws_router.websocket("/jd-chat")
@@ -84,6 +162,7 @@ async def websocket_endpoint(
     websocket: WebSocket,
     jd_id: str,
     mode: typing.Literal["Pan-Mode", "Context-Mode", "Overlay-Mode"] = "Pan-Mode",
+    stream: bool = False,
     current_user: CurrentUser = Depends(ws_authenticate),
     session: Session = Depends(depend.get_db)
 ):
@@ -106,8 +185,11 @@ async def websocket_endpoint(
                 await manager.send_personal_message("ERR:" + "服务器异常", websocket)
                 continue
             try:
-                cvs = await get_jd_cvs_via_embedding(embedding, jd.id, session)
+                cvs, vector_entry = await get_jd_cvs_via_embedding(embedding, jd.id, session)
                 logger.info(f"Websocket【ClientId={client_id}】，Msg: {receive_text}，过滤出简历数量: {len(cvs)}")
+                # 按句子及关键字向量本地重排，只把得分最高的简历发送给大模型；查询及打分在线程中执行，不阻塞事件循环
+                cvs = await asyncio.to_thread(cv_reranker.rerank, embedding, cvs, session,
+                                              sentences_loader=vector_entry.sentences if vector_entry else None)
                 if cvs:
                     _c = []
                     for cv in cvs:
@@ -127,9 +209,19 @@ async def websocket_endpoint(
                         "msg": receive_text,
                         "cvs": _c,
                         "job_info": jd.summary.summary if jd.summary and jd.summary.summary else jd.name,
+                        "jd_id": str(jd.id),
+                        # 会话以websocket连接为单位，Context-Mode的对话历史保存在Redis中
+                        "session_id": client_id,
+                        "owner": str(current_user.id),
+                        "mode": mode,
                     }
+                    if stream:
+                        await stream_analytic_cvs(websocket, payload, session)
+                        continue
                     ret = await get_analytic_cvs(**payload)
-                    if ret["result"]:
+                    if not ret:
+                        await manager.send_personal_message("ERR:" + "服务器异常", websocket)
+                    elif ret["result"]:
                         data = ret["data"]
                         cvs_ids = [i["key"] for i in data]
                         s = CvInfoService.cv_dao.get_cvs(cvs_ids, session)
@@ -143,6 +235,8 @@ async def websocket_endpoint(
                         await manager.send_personal_json(data, websocket)
                     else:
                         await manager.send_personal_message("ERR:" + ret["msg"], websocket)
+                elif stream:
+                    await manager.send_personal_json({"type": "summary", "data": [], "total": 0}, websocket)
                 else:
                     await manager.send_personal_json([], websocket)
             except Exception as e:
@@ -150,11 +244,27 @@ async def websocket_endpoint(
                 await manager.send_personal_message("ERR:" + "服务器异常", websocket)
     except WebSocketDisconnect:
         manager.disconnect(websocket, client_id)
+        try:
+            await asyncio.to_thread(ai_analytic_chat_manager.delete_session, client_id, str(current_user.id))
+        except redis.RedisError as e:
+            logger.error(f"删除会话异常，ClientId={client_id}，{e}")
         logger.info(f"{current_user}, websocket={websocket} disconnected")
 
 
 async def get_jd_cvs_via_embedding(embedding: str, jd_id: str, session: Session):
-    return await CvInfoService.get_jd_cvs_via_embedding(embedding, jd_id, session, limit=200)
+    """
+    优先使用进程内的岗位向量缓存检索，缓存不可用时退回数据库向量检索
+    :return: (简历列表, 岗位向量缓存)，退回数据库检索时岗位向量缓存为None
+    """
+    try:
+        cvs, entry = await asyncio.to_thread(jd_vector_cache.search, session, jd_id, embedding, 200)
+        if cvs is not None:
+            return cvs, entry
+    except Exception as e:
+        logger.error(f"岗位向量缓存检索异常，JdId={jd_id}，{e}")
+        session.rollback()
+    apply_vector_search_params(session)
+    return await CvInfoService.get_jd_cvs_via_embedding(embedding, jd_id, session, limit=200), None
 
 
 
@@ -1,7 +1,20 @@
 from fastapi import FastAPI
 
+from extentions import logger
+from settings import setting
+
 
 def register_event_handler(app: FastAPI):
+    @app.on_event("startup")
+    def app_startup_event():
+        if getattr(setting, "MODEL_REGISTRY_WARMUP", True):
+            from backgroup_task.analytic import Analytic
+            try:
+                Analytic().warmup()
+            except Exception as e:
+                # 预热失败不影响服务启动，模型句柄在首次使用时创建
+                logger.error(f"预热模型句柄失败，{e}")
+
     @app.on_event("shutdown")
     def app_shutdown_event():
         ...
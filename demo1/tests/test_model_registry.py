@@ -0,0 +1,56 @@
+"""
+在项目根目录执行：python -m unittest discover -s tests -t .
+"""
+import importlib.util
+import types
+import unittest
+
+HAS_VERTEXAI = importlib.util.find_spec("vertexai") is not None
+
+
+@unittest.skipUnless(HAS_VERTEXAI, "需要安装vertexai")
+class GetEmbeddingsWithTimeoutTest(unittest.TestCase):
+
+    def build_model(self, predictions):
+        calls = []
+
+        def predict(**kwargs):
+            calls.append(kwargs)
+            return types.SimpleNamespace(predictions=predictions)
+
+        model = types.SimpleNamespace(
+            _prepare_text_embedding_request=lambda texts, **kwargs: types.SimpleNamespace(
+                instances=[{"content": text} for text in texts], parameters=kwargs),
+            _endpoint=types.SimpleNamespace(predict=predict),
+        )
+        return model, calls
+
+    def test_timeout_passed_and_response_parsed(self):
+        from vertexai.language_models import TextEmbedding
+        from backgroup_task.model_registry import get_embeddings_with_timeout
+
+        predictions = [
+            {"embeddings": {"values": [0.1, 0.2], "statistics": {"token_count": 3, "truncated": False}}},
+            {"embeddings": {"values": [0.3, 0.4], "statistics": {"token_count": 5, "truncated": True}}},
+        ]
+        model, calls = self.build_model(predictions)
+        embeddings = get_embeddings_with_timeout(model, ["a", "b"], 12.5, output_dimensionality=2)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0]["timeout"], 12.5)
+        self.assertEqual(calls[0]["instances"], [{"content": "a"}, {"content": "b"}])
+        self.assertEqual(calls[0]["parameters"], {"output_dimensionality": 2})
+        self.assertTrue(all(isinstance(item, TextEmbedding) for item in embeddings))
+        self.assertEqual([item.values for item in embeddings], [[0.1, 0.2], [0.3, 0.4]])
+        self.assertEqual([item.statistics.token_count for item in embeddings], [3, 5])
+        self.assertTrue(embeddings[1].statistics.truncated)
+
+    def test_empty_response(self):
+        from backgroup_task.model_registry import get_embeddings_with_timeout
+
+        model, _ = self.build_model([])
+        self.assertEqual(get_embeddings_with_timeout(model, [], 1), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import typing
+
+import numpy as np
+
+from settings import setting
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def group_max(values: np.ndarray, groups: np.ndarray, size: int) -> np.ndarray:
+    """按分组取最大值，groups为每个值所属分组的下标，没有值的分组为-inf"""
+    result = np.full(size, -np.inf, dtype=np.float32)
+    np.maximum.at(result, groups, values)
+    return result
+
+
+def load_embeddings(session, cv_ids: typing.List[str], model):
+    """按简历ID(CVInfo)批量读取model表中的向量，返回(向量所属简历下标, 向量矩阵)"""
+    from model import CVInfoModel
+    index = {str(cv_id): idx for idx, cv_id in enumerate(cv_ids)}
+    rows = session.query(CVInfoModel.id, model.embedding).join(
+        model, model.cv_id == CVInfoModel.origin_cv_id).filter(CVInfoModel.id.in_(cv_ids)).all()
+    groups = np.array([index[str(row[0])] for row in rows], dtype=np.int64)
+    if not rows:
+        return groups, np.empty((0, 0), dtype=np.float32)
+    return groups, normalize_rows(np.array([row[1] for row in rows], dtype=np.float32))
+
+
+def load_cv_embeddings(session, cv_ids: typing.List[str]):
+    """
+    按简历ID(CVInfo)批量读取句子及关键字向量
+    :return: (句子所属简历下标, 句子向量矩阵), (关键字所属简历下标, 关键字向量矩阵)
+    """
+    from model import OriginCVSentenceEmbeddingModel, OriginCVKeywordEmbeddingModel
+    return (load_embeddings(session, cv_ids, OriginCVSentenceEmbeddingModel),
+            load_embeddings(session, cv_ids, OriginCVKeywordEmbeddingModel))
+
+
+class CvReranker:
+    """
+    会话筛选前的本地重排，减少发送给大模型的简历数量
+    1、句子得分：用户消息向量与简历全部句子向量的最大余弦相似度(max-sim)
+    2、关键字得分：相似度不低于keyword_threshold的关键字按相似度加权，除以该简历的关键字数量
+    3、总分 = sentence_weight * 句子得分 + keyword_weight * 关键字得分，保留总分不低于min_score的前top_k份简历；
+       没有任何向量的简历无法在本地评估，排在已评估简历之后
+    """
+
+    def __init__(
+        self,
+        top_k: int = 50,
+        min_score: float = 0.0,
+        sentence_weight: float = 0.7,
+        keyword_weight: float = 0.3,
+        keyword_threshold: float = 0.5,
+        enable: bool = True,
+    ):
+        self.top_k = top_k
+        self.min_score = min_score
+        self.sentence_weight = sentence_weight
+        self.keyword_weight = keyword_weight
+        self.keyword_threshold = keyword_threshold
+        self.enable = enable
+
+    def score(self, query: typing.Sequence[float], sentences, keywords, size: int) -> np.ndarray:
+        """返回每份简历的总分，没有任何向量的简历为nan"""
+        query = np.asarray(query, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        sentence_groups, sentence_matrix = sentences
+        keyword_groups, keyword_matrix = keywords
+
+        sentence_score = np.zeros(size, dtype=np.float32)
+        has_sentence = np.zeros(size, dtype=bool)
+        if len(sentence_groups):
+            max_sim = group_max(sentence_matrix @ query, sentence_groups, size)
+            has_sentence = np.isfinite(max_sim)
+            sentence_score[has_sentence] = max_sim[has_sentence]
+
+        keyword_score = np.zeros(size, dtype=np.float32)
+        has_keyword = np.zeros(size, dtype=bool)
+        if len(keyword_groups):
+            sims = keyword_matrix @ query
+            hits = np.where(sims >= self.keyword_threshold, sims, 0)
+            counts = np.bincount(keyword_groups, minlength=size)
+            has_keyword = counts > 0
+            keyword_score[has_keyword] = (np.bincount(keyword_groups, weights=hits, minlength=size)[has_keyword]
+                                          / counts[has_keyword])
+
+        scores = self.sentence_weight * sentence_score + self.keyword_weight * keyword_score
+        scores[~(has_sentence | has_keyword)] = np.nan
+        return scores
+
+    def rerank(self, query: typing.Sequence[float], cvs: typing.List[dict], session,
+               id_key: str = "v1_cv_id", sentences_loader: typing.Callable = None) -> typing.List[dict]:
+        """
+        :param sentences_loader: 已在内存中的句子向量(如岗位向量缓存)，参数为简历ID列表，返回值格式同load_embeddings
+        """
+        if not self.enable or len(cvs) <= self.top_k and self.min_score <= 0:
+            return cvs
+        cv_ids = [str(item[id_key]) for item in cvs]
+        if sentences_loader:
+            from model import OriginCVKeywordEmbeddingModel
+            sentences = sentences_loader(cv_ids)
+            keywords = load_embeddings(session, cv_ids, OriginCVKeywordEmbeddingModel)
+        else:
+            sentences, keywords = load_cv_embeddings(session, cv_ids)
+        scores = self.score(query, sentences, keywords, len(cvs))
+        scored = np.flatnonzero(~np.isnan(scores))
+        scored = scored[scores[scored] >= self.min_score]
+        order = scored[np.argsort(-scores[scored], kind="stable")]
+        unscored = np.flatnonzero(np.isnan(scores))
+        selected = np.concatenate([order, unscored])[:self.top_k]
+        print(f"【CvReranker】本地重排，候选简历数量：{len(cvs)}，有向量：{len(cvs) - len(unscored)}，"
+              f"达到阈值：{len(order)}，保留：{len(selected)}")
+        return [cvs[idx] for idx in selected]
+
+
+cv_reranker = CvReranker(
+    top_k=getattr(setting, "CV_RERANK_TOP_K", 50),
+    min_score=getattr(setting, "CV_RERANK_MIN_SCORE", 0.0),
+    sentence_weight=getattr(setting, "CV_RERANK_SENTENCE_WEIGHT", 0.7),
+    keyword_weight=getattr(setting, "CV_RERANK_KEYWORD_WEIGHT", 0.3),
+    keyword_threshold=getattr(setting, "CV_RERANK_KEYWORD_THRESHOLD", 0.5),
+    enable=getattr(setting, "CV_RERANK_ENABLE", True),
+)
@@ -0,0 +1,283 @@
+import copy
+import os
+import threading
+import time
+import typing
+
+import numpy as np
+import redis
+from cachetools import LRUCache
+
+from settings import setting
+from tools.cv_rerank import normalize_rows
+
+# 递增变更序号并记录变更的简历，保证读取方看到的序号与变更记录一致
+NOTIFY_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+for i = 2, #ARGV do
+    redis.call('ZADD', KEYS[2], seq, ARGV[i])
+end
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[1]) - 1)
+return seq
+"""
+
+
+class JdVectorEntry:
+    """单个岗位的句子向量矩阵，行按简历连续排列，starts为每份简历第一行的下标；创建后不再修改，增量更新时生成新对象"""
+
+    # int8矩阵分块转换为float32计算，避免一次性生成整个float32副本
+    CHUNK_ROWS = 8192
+
+    def __init__(self, jd_id: str, seq: int, cvs: typing.Dict[str, dict], origins: typing.Dict[str, str],
+                 row_cv_ids: typing.List[str], matrix: np.ndarray):
+        self.jd_id = jd_id
+        self.quantized = matrix.dtype == np.int8
+        self.scale = 1 / 127 if self.quantized else 1
+        self.seq = seq
+        self.loaded_at = time.time()
+        self.cvs = cvs
+        self.origins = origins
+        self.build(row_cv_ids, matrix)
+
+    def build(self, row_cv_ids: typing.List[str], matrix: np.ndarray):
+        order = np.argsort(np.array(row_cv_ids, dtype=object), kind="stable") if row_cv_ids else np.array([], int)
+        row_cv_ids = [row_cv_ids[i] for i in order]
+        self.matrix = np.ascontiguousarray(matrix[order])
+        self.row_cv_ids = row_cv_ids
+        self.cv_ids = list(dict.fromkeys(row_cv_ids))
+        position = {cv_id: idx for idx, cv_id in enumerate(self.cv_ids)}
+        self.row_cv = np.array([position[cv_id] for cv_id in row_cv_ids], dtype=np.int64)
+        self.starts = np.flatnonzero(np.r_[True, self.row_cv[1:] != self.row_cv[:-1]]) if len(row_cv_ids) else \
+            np.array([], dtype=np.int64)
+
+    @property
+    def nbytes(self) -> int:
+        return self.matrix.nbytes + self.row_cv.nbytes + 1024 * len(self.cvs)
+
+    def replace(self, seq: int, origin_cv_ids: typing.Set[str], row_cv_ids: typing.List[str], matrix: np.ndarray,
+                cvs: typing.Dict[str, dict], origins: typing.Dict[str, str]) -> "JdVectorEntry":
+        """增量更新：返回删除这些源简历原有的行、追加新的行后的新对象，当前对象不变，检索中的线程不受影响"""
+        if not origin_cv_ids:
+            entry = copy.copy(self)
+            entry.seq = seq
+            return entry
+        keep = [idx for idx, cv_id in enumerate(self.row_cv_ids) if self.origins.get(cv_id) not in origin_cv_ids]
+        parts = [part for part in (self.matrix[keep], matrix) if len(part)]
+        entry = JdVectorEntry(self.jd_id, seq, {**self.cvs, **cvs}, {**self.origins, **origins},
+                              [self.row_cv_ids[idx] for idx in keep] + row_cv_ids,
+                              np.concatenate(parts) if parts else self.matrix[:0])
+        # 整体重新加载的时间仍以第一次加载为准
+        entry.loaded_at = self.loaded_at
+        return entry
+
+    def similarities(self, query: np.ndarray) -> np.ndarray:
+        if not self.quantized:
+            return self.matrix @ query
+        sims = np.empty(len(self.matrix), dtype=np.float32)
+        for start in range(0, len(self.matrix), self.CHUNK_ROWS):
+            sims[start:start + self.CHUNK_ROWS] = self.matrix[start:start + self.CHUNK_ROWS].astype(np.float32) @ query
+        return sims * self.scale
+
+    def search(self, query: np.ndarray, limit: int) -> typing.List[dict]:
+        if not self.cv_ids:
+            return []
+        scores = np.maximum.reduceat(self.similarities(query), self.starts)
+        k = min(limit, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [self.cvs[self.cv_ids[idx]] for idx in top]
+
+    def sentences(self, cv_ids: typing.List[str]):
+        """返回指定简历的句子向量，格式与cv_rerank.load_cv_embeddings一致"""
+        index = {str(cv_id): idx for idx, cv_id in enumerate(cv_ids)}
+        mask = np.array([cv_id in index for cv_id in self.row_cv_ids], dtype=bool)
+        groups = np.array([index[cv_id] for cv_id in np.array(self.row_cv_ids, dtype=object)[mask]], dtype=np.int64)
+        return groups, self.matrix[mask].astype(np.float32) * self.scale
+
+
+class JdVectorCache:
+    """
+    会话筛选的进程内岗位向量缓存
+    1、第一次访问某个岗位时把该岗位全部简历的句子向量加载为连续的float32矩阵(行已归一化)，检索时矩阵乘法+argpartition取top-k，
+       不再访问数据库
+    2、生成句子向量(cv_sentence_embeddings_create)时在Redis中递增变更序号并记录源简历ID；检索前比较序号，
+       只重新加载发生变更的简历；变更记录被截断或缓存超过max_age秒时整体重新加载(覆盖简历新增到岗位、删除等情况)
+    3、缓存按占用字节数LRU淘汰，超过max_bytes的岗位不缓存并返回None，由调用方退回数据库检索
+    4、quantized为True时读取int8量化列(见model.vector_compact)，内存及读取量为float32的1/4；
+       按int8取limit * oversample份候选简历后，在数据库中用halfvec列(未配置时用原始float向量)重新计算得分排序
+    5、增量更新生成新的JdVectorEntry后在锁内替换，正在使用旧对象检索的线程不受影响
+    """
+    SEQ = "JdVectorCache:Seq"
+    CHANGES = "JdVectorCache:Changes"
+
+    def __init__(self, redis_url: str, max_bytes: int = 512 * 1024 * 1024, max_age: int = 600,
+                 max_changes: int = 10000, quantized: bool = False, oversample: int = 4, enable: bool = True):
+        self.enable = enable
+        self.quantized = quantized
+        self.oversample = oversample
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_changes = max_changes
+        self.redis_client = redis.from_url(redis_url, decode_responses=True)
+        self._notify_script = self.redis_client.register_script(NOTIFY_SCRIPT)
+        self._entries = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.updates = 0
+
+    @property
+    def entries(self) -> LRUCache:
+        if self._pid != os.getpid():
+            self._entries = LRUCache(maxsize=self.max_bytes, getsizeof=lambda entry: entry.nbytes)
+            self._pid = os.getpid()
+        return self._entries
+
+    def notify(self, origin_cv_ids: typing.Iterable[str]):
+        """源简历的句子向量发生变更后调用"""
+        origin_cv_ids = list({str(cv_id) for cv_id in origin_cv_ids if cv_id})
+        if not origin_cv_ids:
+            return
+        try:
+            self._notify_script(keys=[self.SEQ, self.CHANGES], args=[self.max_changes, *origin_cv_ids])
+        except redis.RedisError as e:
+            print(f"【JdVectorCache】记录向量变更异常，{e}")
+
+    def _query(self, session, jd_id: str, origin_cv_ids: typing.Set[str] = None):
+        from model import CVInfoModel, OriginCVModel, OriginCVSentenceEmbeddingModel
+        from model.vector_compact import int8_column, decode_int8
+        info_query = session.query(
+            CVInfoModel.id, CVInfoModel.origin_cv_id, OriginCVModel.save_path, OriginCVModel.origin,
+            OriginCVModel.meta_json,
+        ).join(OriginCVModel, OriginCVModel.id == CVInfoModel.origin_cv_id).filter(CVInfoModel.jd_id == jd_id)
+        column = int8_column(OriginCVSentenceEmbeddingModel) if self.quantized else \
+            OriginCVSentenceEmbeddingModel.embedding
+        row_query = session.query(CVInfoModel.id, column).join(
+            OriginCVSentenceEmbeddingModel, OriginCVSentenceEmbeddingModel.cv_id == CVInfoModel.origin_cv_id
+        ).filter(CVInfoModel.jd_id == jd_id, column.isnot(None))
+        if origin_cv_ids is not None:
+            info_query = info_query.filter(CVInfoModel.origin_cv_id.in_(origin_cv_ids))
+            row_query = row_query.filter(CVInfoModel.origin_cv_id.in_(origin_cv_ids))
+        cvs, origins = {}, {}
+        for cv_id, origin_cv_id, save_path, origin, meta_json in info_query.all():
+            cvs[str(cv_id)] = {"v1_cv_id": cv_id, "gcs_save_path": save_path, "origin": origin, "meta_json": meta_json}
+            origins[str(cv_id)] = str(origin_cv_id)
+        rows = row_query.all()
+        row_cv_ids = [str(row[0]) for row in rows]
+        if not rows:
+            return cvs, origins, row_cv_ids, np.empty((0, 0), dtype=np.int8 if self.quantized else np.float32)
+        if self.quantized:
+            return cvs, origins, row_cv_ids, decode_int8([row[1] for row in rows])
+        return cvs, origins, row_cv_ids, normalize_rows(np.array([row[1] for row in rows], dtype=np.float32))
+
+    def _state(self):
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.get(self.SEQ)
+        pipe.zrange(self.CHANGES, 0, 0, withscores=True)
+        seq, oldest = pipe.execute()
+        return int(seq or 0), int(oldest[0][1]) if oldest else None
+
+    def get(self, session, jd_id) -> typing.Optional[JdVectorEntry]:
+        if not self.enable:
+            return None
+        jd_id = str(jd_id)
+        try:
+            seq, oldest = self._state()
+        except redis.RedisError as e:
+            print(f"【JdVectorCache】读取向量变更序号异常，{e}")
+            return None
+        with self._lock:
+            entry = self.entries.get(jd_id)
+        if entry is not None and time.time() - entry.loaded_at <= self.max_age:
+            if entry.seq == seq:
+                self.hits += 1
+                return entry
+            changed = None
+            if oldest is not None and oldest <= entry.seq + 1:
+                try:
+                    changed = set(self.redis_client.zrangebyscore(self.CHANGES, entry.seq + 1, seq))
+                except redis.RedisError as e:
+                    # 读取变更记录失败时整体重新加载
+                    print(f"【JdVectorCache】读取向量变更记录异常，整体重新加载，{e}")
+            if changed is not None:
+                if changed:
+                    cvs, origins, row_cv_ids, matrix = self._query(session, jd_id, changed)
+                    entry = entry.replace(seq, changed, row_cv_ids, matrix, cvs, origins)
+                else:
+                    entry = entry.replace(seq, changed, [], entry.matrix[:0], {}, {})
+                self.updates += 1
+                return self._put(jd_id, entry)
+        cvs, origins, row_cv_ids, matrix = self._query(session, jd_id)
+        self.loads += 1
+        return self._put(jd_id, JdVectorEntry(jd_id, seq, cvs, origins, row_cv_ids, matrix))
+
+    def _put(self, jd_id: str, entry: JdVectorEntry) -> typing.Optional[JdVectorEntry]:
+        if entry.nbytes > self.max_bytes:
+            print(f"【JdVectorCache】岗位{jd_id}向量数量{len(entry.row_cv_ids)}超过缓存上限，不缓存")
+            with self._lock:
+                self.entries.pop(jd_id, None)
+            return None
+        with self._lock:
+            self.entries[jd_id] = entry
+        return entry
+
+    def search(self, session, jd_id, query: typing.Sequence[float], limit: int = 200):
+        """返回(简历列表, 岗位缓存)，缓存不可用时返回(None, None)"""
+        entry = self.get(session, jd_id)
+        if entry is None:
+            return None, None
+        query = np.asarray(query, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        if not entry.quantized:
+            return entry.search(query, limit), entry
+        return self.rescore(session, query, entry.search(query, limit * self.oversample), limit), entry
+
+    @staticmethod
+    def rescore(session, query: np.ndarray, cvs: typing.List[dict], limit: int) -> typing.List[dict]:
+        """
+        重新计算候选简历的max-sim得分：得分在数据库中按简历聚合，每份简历只返回一个得分，不读取向量到进程内
+        配置了halfvec时使用halfvec列内积，否则使用原始float向量的余弦相似度
+        """
+        from sqlalchemy import func
+        from model import CVInfoModel, OriginCVSentenceEmbeddingModel
+        from model.vector_compact import compact_vector_config, half_column
+        if not cvs:
+            return cvs
+        if "halfvec" in compact_vector_config()["modes"]:
+            score = -half_column(OriginCVSentenceEmbeddingModel).max_inner_product(query)
+        else:
+            score = 1 - OriginCVSentenceEmbeddingModel.embedding.cosine_distance(query)
+        rows = session.query(CVInfoModel.id, func.max(score)).join(
+            OriginCVSentenceEmbeddingModel, OriginCVSentenceEmbeddingModel.cv_id == CVInfoModel.origin_cv_id
+        ).filter(CVInfoModel.id.in_([i["v1_cv_id"] for i in cvs])).group_by(CVInfoModel.id).all()
+        found = {str(cv_id): value for cv_id, value in rows if value is not None}
+        scores = np.array([found.get(str(i["v1_cv_id"]), -np.inf) for i in cvs], dtype=np.float32)
+        order = np.argsort(-scores, kind="stable")[:limit]
+        return [cvs[idx] for idx in order]
+
+    def stats(self):
+        with self._lock:
+            entries = {jd_id: {"rows": len(entry.row_cv_ids), "cvs": len(entry.cv_ids), "bytes": entry.nbytes,
+                               "seq": entry.seq} for jd_id, entry in self.entries.items()}
+        return {
+            "pid": os.getpid(),
+            "enable": self.enable,
+            "quantized": self.quantized,
+            "bytes": sum(i["bytes"] for i in entries.values()),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "loads": self.loads,
+            "updates": self.updates,
+            "jds": entries,
+        }
+
+
+jd_vector_cache = JdVectorCache(
+    redis_url=setting.REDIS_URL,
+    max_bytes=getattr(setting, "JD_VECTOR_CACHE_MAX_BYTES", 512 * 1024 * 1024),
+    max_age=getattr(setting, "JD_VECTOR_CACHE_MAX_AGE", 600),
+    quantized="int8" in getattr(setting, "VECTOR_COMPACT_MODES", []),
+    oversample=getattr(setting, "VECTOR_COMPACT_RESCORE_OVERSAMPLE", 4),
+    enable=getattr(setting, "JD_VECTOR_CACHE_ENABLE", True),
+)
@@ -10,11 +10,30 @@ from typing import List, Dict
 TOKENIZER = tiktoken.get_encoding("cl100k_base")
 
 
+def extract_pdf_text(pdf_path: str = "", pdf_stream: typing.Union[bytes] = None) -> str:
+    """
+    使用PyMuPDF提取PDF全文，合并多余的换行及空白；扫描件等没有文本层的PDF返回空字符串
+    """
+    if pdf_stream is None and pdf_path:
+        doc = fitz.open(pdf_path)
+    else:
+        doc = fitz.open(stream=pdf_stream)
+    full_text = ""
+    for page_num in range(len(doc)):
+        page = doc.load_page(page_num)
+        full_text += page.get_text("text")
+        full_text += "\n\n"
+    full_text = re.sub(r'\n+', ' ', full_text).strip()
+    full_text = re.sub(r'\s+', ' ', full_text).strip()
+    return full_text
+
+
 def process_resume_pdf(
         pdf_path: str = "",
         pdf_stream: typing.Union[bytes] = None,
         chunk_size: int = 512,
-        chunk_overlap: int = 64
+        chunk_overlap: int = 64,
+        full_text: str = None,
 ) -> List[Dict[str, any]]:
     """
     使用PyMuPDF进行布局感知解析，然后进行智能语义切片，确保不切断句子。
@@ -24,6 +43,7 @@ def process_resume_pdf(
         pdf_stream (bytes): PDF文件流.
         chunk_size (int): 每个文本块的【目标】token大小.
         chunk_overlap (int): 相邻文本块之间重叠的【目标】token数量.
+        full_text (str): 已通过extract_pdf_text提取的全文，传入时不再重复解析PDF.
 
     Returns:
         List[Dict[str, any]]: 高质量的、有意义的文本块列表。
@@ -35,18 +55,9 @@ def process_resume_pdf(
     print(f"--- 开始使用 PyMuPDF 智能解析PDF文件: {pdf_path} ---")
 
     try:
-        # 1. & 2. PDF解析与文本提取 (这部分逻辑保持不变)
-        if pdf_stream is None and pdf_path:
-            doc = fitz.open(pdf_path)
-        else:
-            doc = fitz.open(stream=pdf_stream)
-        full_text = ""
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            full_text += page.get_text("text")
-            full_text += "\n\n"
-        full_text = re.sub(r'\n+', ' ', full_text).strip()
-        full_text = re.sub(r'\s+', ' ', full_text).strip()
+        # 1. & 2. PDF解析与文本提取
+        if full_text is None:
+            full_text = extract_pdf_text(pdf_path, pdf_stream)
 
     except Exception as e:
         print(f"使用PyMuPDF解析PDF时发生错误: {e}")